@@ -0,0 +1,209 @@
+"""
+Response compression negotiated by Accept-Encoding.
+
+Analysis responses and history pages carry several kilobytes of text that
+compress 3-5x, and they were sent to the frontend uncompressed.
+CompressionMiddleware compresses a response with brotli or gzip, whichever
+the client accepts and prefers. Brotli is used only when the optional
+brotli package is installed. Responses smaller than min_size, already
+encoded ones, and Server-Sent Events (which must reach the browser without
+buffering) are passed through untouched. Streamed bodies are compressed
+chunk by chunk and flushed after each one, so streaming still works.
+"""
+
+import zlib
+from typing import Any, Dict, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:  # optional: without it only gzip is offered
+    brotli = None
+
+# Content types that gain nothing from compression or must not be buffered
+SKIP_CONTENT_TYPES = ("text/event-stream", "image/", "video/", "audio/", "application/zip", "application/pdf")
+
+
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    """
+    Encodings listed in an Accept-Encoding header, with their q-values
+    """
+    encodings: Dict[str, float] = {}
+    for item in header.split(","):
+        name, _, params = item.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        encodings[name] = quality
+    return encodings
+
+
+def choose_encoding(header: str, brotli_available: bool = True) -> Optional[str]:
+    """
+    The encoding to use for a client sending this Accept-Encoding, or None
+    """
+    encodings = parse_accept_encoding(header)
+    candidates = ["br", "gzip"] if brotli_available else ["gzip"]
+    best, best_quality = None, 0.0
+    for name in candidates:
+        quality = encodings.get(name, encodings.get("*", 0.0))
+        # Ties go to the earlier (better compressing) candidate
+        if quality > best_quality:
+            best, best_quality = name, quality
+    return best
+
+
+class _Compressor:
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int):
+        self.encoding = encoding
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=brotli_quality)
+        else:
+            # wbits 16+ writes a gzip header and trailer
+            self._zlib = zlib.compressobj(gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes, flush: bool = False, finish: bool = False) -> bytes:
+        if self.encoding == "br":
+            out = self._brotli.process(data)
+            if finish:
+                out += self._brotli.finish()
+            elif flush:
+                out += self._brotli.flush()
+            return out
+        out = self._zlib.compress(data)
+        if finish:
+            out += self._zlib.flush()
+        elif flush:
+            out += self._zlib.flush(zlib.Z_SYNC_FLUSH)
+        return out
+
+
+class CompressionStats:
+    """
+    Counters shared with /api/stats (the middleware instance itself is built by Starlette)
+    """
+
+    def __init__(self):
+        self.compressed = {"br": 0, "gzip": 0}
+        self.passed_through = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "brotli_available": brotli is not None,
+            "compressed": dict(self.compressed),
+            "passed_through": self.passed_through,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing responses of at least min_size bytes with brotli or gzip
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        min_size: int = 1024,
+        gzip_level: int = 6,
+        brotli_quality: int = 4,
+        stats: Optional[CompressionStats] = None,
+    ):
+        self.app = app
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.stats = stats or CompressionStats()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""), brotli is not None)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await _CompressedResponder(self, encoding)(self.app, scope, receive, send)
+
+
+class _CompressedResponder:
+    """
+    Wraps send for one response, deciding from its headers and first body chunk whether to compress
+    """
+
+    def __init__(self, middleware: CompressionMiddleware, encoding: str):
+        self.middleware = middleware
+        self.encoding = encoding
+        self.start: Optional[Message] = None
+        self.compressor: Optional[_Compressor] = None
+        self.passthrough = False
+
+    async def __call__(self, app: ASGIApp, scope: Scope, receive: Receive, send: Send) -> None:
+        self.send = send
+        await app(scope, receive, self.send_wrapper)
+
+    async def send_wrapper(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            # Held back until the first body chunk shows whether to compress
+            self.start = message
+            headers = Headers(raw=message["headers"])
+            content_type = headers.get("content-type", "")
+            self.passthrough = (
+                "content-encoding" in headers
+                or any(content_type.startswith(skip) for skip in SKIP_CONTENT_TYPES)
+            )
+            return
+        if message["type"] != "http.response.body":
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.start is not None:
+            start, self.start = self.start, None
+            if self.passthrough or (not more_body and len(body) < self.middleware.min_size):
+                self.passthrough = True
+                self.middleware.stats.passed_through += 1
+                await self.send(start)
+                await self.send(message)
+                return
+            self.compressor = _Compressor(self.encoding, self.middleware.gzip_level, self.middleware.brotli_quality)
+            self.middleware.stats.compressed[self.encoding] += 1
+            headers = MutableHeaders(raw=start["headers"])
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            if more_body:
+                del headers["Content-Length"]
+            else:
+                body = self._compress(body, finish=True)
+                headers["Content-Length"] = str(len(body))
+                await self.send(start)
+                await self.send({"type": "http.response.body", "body": body})
+                return
+            await self.send(start)
+            await self.send({"type": "http.response.body", "body": self._compress(body, flush=True), "more_body": True})
+            return
+
+        if self.passthrough:
+            await self.send(message)
+            return
+        body = self._compress(body, flush=more_body, finish=not more_body)
+        await self.send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+    def _compress(self, body: bytes, flush: bool = False, finish: bool = False) -> bytes:
+        out = self.compressor.compress(body, flush=flush, finish=finish)
+        self.middleware.stats.bytes_in += len(body)
+        self.middleware.stats.bytes_out += len(out)
+        return out
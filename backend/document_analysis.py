@@ -0,0 +1,132 @@
+"""
+Gemini prompts and calls for analyzing uploaded medical documents.
+
+A document analysis produces a summary and the 3-5 key facts that are kept
+in the user's session. There are three ways to get them (DOCUMENT_ANALYSIS_MODE):
+
+- single: one call returns a JSON object holding both the summary and the
+  key facts.
+- background: one call for the summary, which is returned right away; the
+  key facts are extracted from it afterwards, off the critical path.
+- sequential: the summary call followed by a key-facts call, one after the
+  other (the original behaviour, about twice the latency of a single call).
+"""
+
+import json
+import logging
+from typing import Any, List, Optional
+
+from llm_client import LLMClient
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_MODES = ("single", "background", "sequential")
+
+# Prompt used for every document analysis (also part of the analysis cache key)
+DOCUMENT_ANALYSIS_PROMPT = """
+            Please analyze this document from a medical/health perspective. Look for:
+
+            1. **Medical History**: Any relevant past medical history, surgeries, or treatments
+            2. **Current Medications**: List of current medications and dosages
+            3. **Allergies**: Any known allergies or adverse reactions
+            4. **Symptoms**: Description of any current symptoms or health concerns
+            5. **Lifestyle Factors**: Information on diet, exercise, alcohol, tobacco use, etc.
+
+            User's specific request: Extract health insights from this document.
+
+            Important Guidelines:
+            - Provide observations but emphasize that this is NOT a medical diagnosis
+            - Recommend consulting healthcare professionals for any concerns
+            - Be thorough but avoid causing unnecessary alarm
+            - Focus on objective observations rather than definitive conclusions
+            - If you see concerning symptoms, advise seeking medical attention
+
+            Please provide a structured analysis with your observations and recommendations.
+            """
+
+SINGLE_PASS_INSTRUCTIONS = """
+            Return a JSON object with two fields:
+            - "summary": the full structured analysis described above
+            - "key_facts": the 3-5 most important facts, findings, or recommendations from it,
+              each as a single, clear sentence
+            """
+
+DOCUMENT_ANALYSIS_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "object",
+        "properties": {
+            "summary": {"type": "string"},
+            "key_facts": {"type": "array", "items": {"type": "string"}},
+        },
+        "required": ["summary", "key_facts"],
+    },
+}
+
+KEY_FACTS_PROMPT = """
+            Extract the 3-5 most important facts, findings, or recommendations from the following medical document summary.
+            Format each as a single, clear sentence.
+
+            Summary:
+            {summary}
+            """
+
+
+class DocumentAnalysis:
+    """
+    Summary of a document and its key facts (None while they are still to be extracted)
+    """
+
+    def __init__(self, summary: str, key_facts: Optional[List[str]]):
+        self.summary = summary
+        self.key_facts = key_facts
+
+
+async def summarize(llm: LLMClient, document: Any) -> str:
+    response = await llm.generate([document, DOCUMENT_ANALYSIS_PROMPT])
+    if not response.text:
+        raise ValueError("Failed to generate document analysis")
+    return response.text
+
+
+async def extract_key_facts(llm: LLMClient, summary: str) -> List[str]:
+    response = await llm.generate(KEY_FACTS_PROMPT.format(summary=summary))
+    return [fact.strip() for fact in response.text.split('\n') if fact.strip()]
+
+
+async def analyze_single_pass(llm: LLMClient, document: Any) -> DocumentAnalysis:
+    """
+    Summary and key facts from one structured Gemini call
+    """
+    response = await llm.generate(
+        [document, DOCUMENT_ANALYSIS_PROMPT + SINGLE_PASS_INSTRUCTIONS],
+        generation_config=DOCUMENT_ANALYSIS_CONFIG,
+    )
+    if not response.text:
+        raise ValueError("Failed to generate document analysis")
+    try:
+        data = json.loads(response.text)
+        summary = str(data["summary"])
+        key_facts = [str(fact).strip() for fact in data["key_facts"] if str(fact).strip()]
+    except (ValueError, KeyError, TypeError) as parse_error:
+        # Keep the analysis Gemini did produce and get the key facts the old way
+        logger.warning(f"Structured document analysis could not be parsed ({parse_error}), extracting key facts separately")
+        return DocumentAnalysis(response.text, await extract_key_facts(llm, response.text))
+    return DocumentAnalysis(summary, key_facts)
+
+
+async def analyze_document(llm: LLMClient, document: Any, mode: str = "single") -> DocumentAnalysis:
+    """
+    Analyze an uploaded document (a Gemini file handle) in the given mode.
+
+    In background mode the returned key_facts is None; the caller extracts
+    them with extract_key_facts once the summary has been delivered.
+    """
+    if mode == "single":
+        return await analyze_single_pass(llm, document)
+    summary = await summarize(llm, document)
+    if mode == "background":
+        return DocumentAnalysis(summary, None)
+    if mode == "sequential":
+        return DocumentAnalysis(summary, await extract_key_facts(llm, summary))
+    raise ValueError(f"Unknown document analysis mode: {mode}")
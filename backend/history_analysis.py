@@ -0,0 +1,140 @@
+"""
+Incremental diagnosis extraction for /api/chat/analyze-history.
+
+The frontend re-posts the whole transcript every time it asks for diagnoses.
+HistoryAnalysisTracker remembers, per conversation, how many messages have
+already been analyzed (with a digest of that prefix, so an edited or
+different conversation is detected) and the diagnoses they produced. The
+next request only has to send the new messages plus a compact summary of
+the earlier diagnoses to Gemini, and the results are merged by diagnosis name.
+"""
+
+import hashlib
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from cache import LRUCache
+
+Diagnosis = Dict[str, Any]
+
+
+def transcript_digest(messages: Sequence[Any]) -> str:
+    """
+    Digest of a list of chat messages (anything with type, content and timestamp)
+    """
+    digest = hashlib.sha256()
+    for message in messages:
+        for part in (message.type, message.content, message.timestamp):
+            digest.update(str(part).encode())
+            digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def conversation_key(user_id: Optional[str], messages: Sequence[Any]) -> str:
+    """
+    Identify a conversation by its user and its first message
+    """
+    return f"{user_id or ''}:{transcript_digest(messages[:1])}"
+
+
+def _diagnosis_key(diagnosis: Diagnosis) -> str:
+    return " ".join(str(diagnosis.get("diagnosis", "")).lower().split())
+
+
+def _union(first: List[Any], second: List[Any]) -> List[Any]:
+    merged = list(first)
+    merged.extend(item for item in second if item not in merged)
+    return merged
+
+
+def merge_diagnoses(previous: List[Diagnosis], new: List[Diagnosis]) -> List[Diagnosis]:
+    """
+    Combine earlier diagnoses with newly extracted ones, deduplicated by diagnosis name.
+
+    A repeated diagnosis takes the newer assessment (confidence, follow-up, ...)
+    and keeps the symptoms and recommendations from both.
+    """
+    merged: Dict[str, Diagnosis] = {_diagnosis_key(diagnosis): diagnosis for diagnosis in previous}
+    for diagnosis in new:
+        key = _diagnosis_key(diagnosis)
+        earlier = merged.get(key)
+        if earlier is not None:
+            diagnosis = {
+                **earlier,
+                **diagnosis,
+                "symptoms": _union(earlier.get("symptoms", []), diagnosis.get("symptoms", [])),
+                "aiRecommendations": _union(
+                    earlier.get("aiRecommendations", []), diagnosis.get("aiRecommendations", [])
+                ),
+            }
+        merged[key] = diagnosis
+    return list(merged.values())
+
+
+def summarize_diagnoses(diagnoses: List[Diagnosis]) -> str:
+    """
+    One line per diagnosis, compact enough to send instead of the transcript that produced it
+    """
+    lines = []
+    for diagnosis in diagnoses:
+        details = f"symptoms: {', '.join(diagnosis.get('symptoms', [])) or 'none recorded'}"
+        if diagnosis.get("followUpNeeded"):
+            details += "; follow-up needed"
+        lines.append(f"- {diagnosis.get('diagnosis')} ({details})")
+    return "\n".join(lines) or "- none"
+
+
+class AnalysisState:
+    """
+    What has already been extracted from one conversation
+    """
+
+    __slots__ = ("analyzed", "digest", "diagnoses")
+
+    def __init__(self, analyzed: int, digest: str, diagnoses: List[Diagnosis]):
+        self.analyzed = analyzed  # number of leading messages already sent to Gemini
+        self.digest = digest  # transcript_digest of those messages
+        self.diagnoses = diagnoses
+
+
+class HistoryAnalysisTracker:
+    """
+    Bounded per-conversation memory of analyzed messages and their diagnoses
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 2 * 3600):
+        self._states = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.full = 0
+        self.incremental = 0
+        self.unchanged = 0
+        self.messages_skipped = 0
+
+    def plan(self, key: str, messages: Sequence[Any]) -> Tuple[Optional[AnalysisState], int]:
+        """
+        The earlier state for this conversation (or None) and the index of the first message still to analyze
+        """
+        state = self._states.get(key)
+        if (
+            state is None
+            or state.analyzed > len(messages)
+            or transcript_digest(messages[:state.analyzed]) != state.digest
+        ):
+            self.full += 1
+            return None, 0
+        if state.analyzed == len(messages):
+            self.unchanged += 1
+        else:
+            self.incremental += 1
+        self.messages_skipped += state.analyzed
+        return state, state.analyzed
+
+    def save(self, key: str, messages: Sequence[Any], diagnoses: List[Diagnosis]) -> None:
+        self._states.set(key, AnalysisState(len(messages), transcript_digest(messages), diagnoses))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "conversations": len(self._states),
+            "full_analyses": self.full,
+            "incremental_analyses": self.incremental,
+            "unchanged": self.unchanged,
+            "messages_skipped": self.messages_skipped,
+        }
@@ -0,0 +1,360 @@
+"""
+Async data access for the medical history collection.
+
+The history endpoints used the synchronous MongoClient, so each call held
+one of the threadpool slots the rest of the app shares, and the client ran
+with default pool settings and no timeouts. A slow Mongo node could tie up
+every slot. HistoryRepository uses pymongo's AsyncMongoClient (stable from
+pymongo 4.13; requirements.txt pins 4.13.2) with an explicit pool size and
+server-selection, connect, socket and pool-wait timeouts. Requests wait on
+the event loop instead of in threads and fail fast once the pool is
+exhausted. PoolMetrics records connection pool events for /api/stats, and
+CommandTimer reports how long each command (find, getMore, insert, ...)
+took, for /metrics.
+
+Listing is backed by indexes on (user_id, created_at, _id) and
+(created_at, _id), which ensure_indexes() creates at startup, and pages
+with a keyset token instead of an offset. Every page is then one index
+range scan, however large the collection grows. The summary view projects
+away the large recommendation and vision/voice fields. iter_entries()
+walks a user's whole history through a server-side cursor, one batch at a
+time, for exports.
+"""
+
+import base64
+import binascii
+import logging
+from datetime import datetime
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ASCENDING, DESCENDING, AsyncMongoClient, IndexModel, monitoring
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+HISTORY_INDEXES = [
+    IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)], name="user_id_created_at"),
+    IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)], name="created_at"),
+]
+# Newest first; _id breaks ties between entries created in the same millisecond
+HISTORY_SORT = [("created_at", DESCENDING), ("_id", DESCENDING)]
+# Fields returned by the summary (list) view
+SUMMARY_PROJECTION = {
+    field: 1 for field in
+    ("user_id", "diagnosis", "date", "duration", "symptoms", "confidence", "followUpNeeded", "created_at")
+}
+
+
+class InvalidPageToken(ValueError):
+    pass
+
+
+def encode_page_token(document: Dict[str, Any]) -> str:
+    """
+    Opaque token pointing just past document in HISTORY_SORT order
+    """
+    created_at = document.get("created_at")
+    # Entries saved before created_at existed have an empty date part
+    raw = f"{created_at.isoformat() if created_at is not None else ''}|{document['_id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_page_token(token: str) -> Tuple[Optional[datetime], ObjectId]:
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        created_at, object_id = raw.split("|")
+        return datetime.fromisoformat(created_at) if created_at else None, ObjectId(object_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError, InvalidId):
+        raise InvalidPageToken(f"Invalid page token: {token}")
+
+
+def after_token_query(created_at: Optional[datetime], object_id: ObjectId) -> Dict[str, Any]:
+    """
+    Filter for the entries after a page token in HISTORY_SORT order
+
+    Entries without created_at sort after every dated one (null is the lowest
+    value), ordered among themselves by _id.
+    """
+    if created_at is None:
+        return {"created_at": None, "_id": {"$lt": object_id}}
+    return {"$or": [
+        {"created_at": {"$lt": created_at}},
+        {"created_at": created_at, "_id": {"$lt": object_id}},
+        {"created_at": None},
+    ]}
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    Connection pool gauges and counters, fed by pymongo's CMAP events
+    """
+
+    def __init__(self):
+        self.open = 0
+        self.checked_out = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.pool_clears = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.pool_clears += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.open += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.open -= 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        self.checked_out += 1
+        self.checkouts += 1
+        # Time spent waiting for a free connection (or establishing one)
+        wait = getattr(event, "duration", 0.0) or 0.0
+        self.checkout_wait_total += wait
+        self.checkout_wait_max = max(self.checkout_wait_max, wait)
+
+    def connection_checked_in(self, event):
+        self.checked_out -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "connections_open": self.open,
+            "checked_out": self.checked_out,
+            "checkouts": self.checkouts,
+            "checkout_failures": self.checkout_failures,
+            "pool_clears": self.pool_clears,
+            "avg_checkout_wait_ms": round(self.checkout_wait_total / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+            "max_checkout_wait_ms": round(self.checkout_wait_max * 1000, 3),
+        }
+
+
+class CommandTimer(monitoring.CommandListener):
+    """
+    Calls observe(command_name, seconds) for every command the client completes, successful or not
+    """
+
+    def __init__(self, observe: Callable[[str, float], None]):
+        self.observe = observe
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.observe(event.command_name, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        self.observe(event.command_name, event.duration_micros / 1e6)
+
+
+class HistoryRepository:
+    """
+    Async reads and writes of medical history entries
+    """
+
+    def __init__(self, collection: Any, client: Optional[AsyncMongoClient] = None, pool_metrics: Optional[PoolMetrics] = None):
+        self.collection = collection
+        self.client = client
+        self.pool_metrics = pool_metrics
+        self.max_pool_size: Optional[int] = None
+
+    @classmethod
+    def from_url(
+        cls,
+        url: str,
+        database: str,
+        collection: str,
+        max_pool_size: int = 50,
+        min_pool_size: int = 0,
+        server_selection_timeout_ms: int = 3000,
+        connect_timeout_ms: int = 5000,
+        socket_timeout_ms: int = 10000,
+        wait_queue_timeout_ms: int = 2000,
+        event_listeners: Sequence[Any] = (),
+        **client_options: Any,
+    ) -> "HistoryRepository":
+        """
+        Repository backed by a new AsyncMongoClient; no connection is made until first use
+        """
+        pool_metrics = PoolMetrics()
+        client = AsyncMongoClient(
+            url,
+            maxPoolSize=max_pool_size,
+            minPoolSize=min_pool_size,
+            serverSelectionTimeoutMS=server_selection_timeout_ms,
+            connectTimeoutMS=connect_timeout_ms,
+            socketTimeoutMS=socket_timeout_ms,
+            waitQueueTimeoutMS=wait_queue_timeout_ms,
+            event_listeners=[pool_metrics, *event_listeners],
+            **client_options,
+        )
+        repo = cls(client[database][collection], client=client, pool_metrics=pool_metrics)
+        repo.max_pool_size = max_pool_size
+        return repo
+
+    async def ping(self) -> bool:
+        """
+        Check the server is reachable; logs instead of raising so the app can start without Mongo
+        """
+        if self.client is None:
+            return True
+        try:
+            await self.client.admin.command("ping")
+        except Exception as e:
+            logger.error(f"Failed to reach MongoDB: {e}")
+            return False
+        logger.info("MongoDB connection initialized successfully")
+        return True
+
+    async def ensure_indexes(self) -> None:
+        """
+        Create the indexes listing relies on (a no-op when they already exist)
+        """
+        try:
+            await self.collection.create_indexes(HISTORY_INDEXES)
+        except Exception as e:
+            logger.error(f"Failed to create history indexes: {e}")
+
+    async def insert(self, document: Dict[str, Any]) -> str:
+        """
+        Store a history entry, stamping created_at/updated_at; returns its id
+        """
+        now = datetime.now()
+        document = {**document, "created_at": now, "updated_at": now}
+        result = await self.collection.insert_one(document)
+        return str(result.inserted_id)
+
+    async def delete(self, object_id: ObjectId) -> bool:
+        result = await self.collection.delete_one({"_id": object_id})
+        return result.deleted_count == 1
+
+    async def insert_many(self, documents: List[Dict[str, Any]], batch_size: int = 500) -> List[Dict[str, Any]]:
+        """
+        Store many entries with one unordered insert_many per batch; returns one result per document.
+
+        A document that fails (e.g. a duplicate key) doesn't stop the others.
+        Connection errors propagate, leaving earlier batches stored.
+        """
+        now = datetime.now()
+        results: List[Dict[str, Any]] = []
+        for start in range(0, len(documents), batch_size):
+            batch = [
+                {**document, "_id": ObjectId(), "created_at": now, "updated_at": now}
+                for document in documents[start:start + batch_size]
+            ]
+            errors: Dict[int, str] = {}
+            try:
+                await self.collection.insert_many(batch, ordered=False)
+            except BulkWriteError as e:
+                errors = {error["index"]: error.get("errmsg", "write error") for error in e.details.get("writeErrors", [])}
+            for index, document in enumerate(batch):
+                if index in errors:
+                    results.append({"index": start + index, "success": False, "error": errors[index]})
+                else:
+                    results.append({"index": start + index, "success": True, "id": str(document["_id"])})
+        return results
+
+    async def delete_many(self, document_ids: List[str], batch_size: int = 500) -> List[Dict[str, Any]]:
+        """
+        Delete entries by id with one delete_many per batch; returns one result per id
+        """
+        results: Dict[int, Dict[str, Any]] = {}
+        valid: List[Tuple[int, ObjectId]] = []
+        for index, document_id in enumerate(document_ids):
+            try:
+                valid.append((index, ObjectId(document_id)))
+            except (InvalidId, TypeError):
+                results[index] = {"id": document_id, "success": False, "error": "Invalid document ID format"}
+        for start in range(0, len(valid), batch_size):
+            batch = valid[start:start + batch_size]
+            object_ids = [object_id for _, object_id in batch]
+            # delete_many only reports a count, so look up which ids exist first
+            existing = {
+                document["_id"]
+                async for document in self.collection.find({"_id": {"$in": object_ids}}, {"_id": 1})
+            }
+            if existing:
+                await self.collection.delete_many({"_id": {"$in": list(existing)}})
+            for index, object_id in batch:
+                if object_id in existing:
+                    results[index] = {"id": document_ids[index], "success": True}
+                else:
+                    results[index] = {"id": document_ids[index], "success": False, "error": "Document not found"}
+        return [results[index] for index in range(len(document_ids))]
+
+    async def find_page(
+        self,
+        user_id: Optional[str] = None,
+        limit: int = 50,
+        before: Optional[str] = None,
+        summary: bool = False,
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        One page of entries (optionally for one user), newest first, as raw documents.
+
+        before is the token returned with the previous page; the second value
+        returned is the token for the next page, or None after the last one.
+        """
+        query: Dict[str, Any] = {}
+        if user_id:
+            query["user_id"] = user_id
+        if before:
+            query.update(after_token_query(*decode_page_token(before)))
+        projection = SUMMARY_PROJECTION if summary else None
+        cursor = self.collection.find(query, projection).sort(HISTORY_SORT).limit(limit)
+        # ObjectIds are left in place; serialization.FastJSONResponse encodes them
+        history = [document async for document in cursor]
+        next_before = None
+        if len(history) == limit:
+            next_before = encode_page_token(history[-1])
+        return history, next_before
+
+    async def iter_entries(
+        self,
+        user_id: str,
+        batch_size: int = 500,
+        summary: bool = False,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Every entry of one user, newest first, fetched batch_size documents per round trip
+        """
+        query: Dict[str, Any] = {"user_id": user_id}
+        projection = SUMMARY_PROJECTION if summary else None
+        cursor = self.collection.find(query, projection).sort(HISTORY_SORT).batch_size(batch_size)
+        try:
+            async for document in cursor:
+                yield document
+        finally:
+            # Frees the server-side cursor when the consumer stops early (e.g. a client disconnect)
+            await cursor.close()
+
+    def stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = {"max_pool_size": self.max_pool_size}
+        if self.pool_metrics is not None:
+            stats.update(self.pool_metrics.stats())
+        return stats
+
+    async def close(self) -> None:
+        if self.client is not None:
+            await self.client.close()
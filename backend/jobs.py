@@ -0,0 +1,272 @@
+"""
+Background job runner for long media-analysis work.
+
+Video and document analysis can take tens of seconds (upload, Gemini-side
+processing, generation). Instead of holding the HTTP request open, the
+endpoints submit a job and return its id right away; a fixed pool of worker
+tasks runs the jobs and clients read the outcome from the job status endpoint.
+
+Jobs run in the worker process that accepted them. With several uvicorn
+workers, a status poll can land on any of them, so the JobManager can also
+write every job's state to a SQLiteJobStore shared by all the processes,
+and look up jobs it doesn't know there.
+"""
+
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+JobFn = Callable[[], Awaitable[Any]]
+DropFn = Callable[[], None]
+
+
+class JobQueueFull(Exception):
+    """Raised when a job is submitted while the queue is at capacity"""
+
+
+class Job:
+    """
+    A single unit of background work and its outcome
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+    def __init__(self, kind: str, fn: JobFn, on_drop: Optional[DropFn] = None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.fn = fn
+        self.on_drop = on_drop  # releases what fn would have cleaned up (e.g. a temp file) if it never runs
+        self.status = Job.PENDING
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in (Job.COMPLETED, Job.FAILED)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class SQLiteJobStore:
+    """
+    Job states in a SQLite table, readable by every worker process
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )
+            """
+        )
+
+    def save(self, job: Job) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (id, kind, status, result, error, created_at, started_at, finished_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job.id, job.kind, job.status,
+                    json.dumps(job.result, default=str) if job.result is not None else None,
+                    job.error, job.created_at, job.started_at, job.finished_at,
+                ),
+            )
+
+    def load(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT kind, status, result, error, created_at, started_at, finished_at FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        kind, status, result, error, created_at, started_at, finished_at = row
+        job = Job(kind, None)
+        job.id = job_id
+        job.status = status
+        job.result = json.loads(result) if result is not None else None
+        job.error = error
+        job.created_at, job.started_at, job.finished_at = created_at, started_at, finished_at
+        return job
+
+    def prune(self, finished_before: float) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM jobs WHERE finished_at < ?", (finished_before,))
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+class JobManager:
+    """
+    Bounded queue of jobs served by a fixed pool of asyncio worker tasks
+    """
+
+    def __init__(
+        self,
+        workers: int = 4,
+        max_queue: int = 100,
+        retention_seconds: float = 3600,
+        store: Optional[SQLiteJobStore] = None,
+    ):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.retention_seconds = retention_seconds
+        self.store = store  # None: job states are only known to this process
+        self.jobs: Dict[str, Job] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._tasks = [
+            asyncio.create_task(self._worker(i), name=f"job-worker-{i}")
+            for i in range(self.workers)
+        ]
+        logger.info(f"Started {self.workers} job workers")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Jobs still waiting will never run
+        while self._queue is not None and not self._queue.empty():
+            job = self._queue.get_nowait()
+            job.status = Job.FAILED
+            job.error = "Server shut down before the job ran"
+            job.finished_at = time.time()
+            job.fn = None
+            self._save(job)
+            self._drop(job.kind, job.on_drop)
+        if self.store is not None:
+            self.store.close()
+
+    def submit(self, kind: str, fn: JobFn, on_drop: Optional[DropFn] = None) -> Job:
+        """
+        Queue fn to run in the background and return its Job immediately
+
+        on_drop is called instead of fn if the job is never run: when the queue
+        is full (before JobQueueFull is raised) or the manager stops first.
+        """
+        if self._queue is None:
+            raise RuntimeError("JobManager has not been started")
+        self._prune()
+        job = Job(kind, fn, on_drop)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self._drop(kind, on_drop)
+            raise JobQueueFull(f"Job queue is full ({self.max_queue} pending)")
+        self.jobs[job.id] = job
+        self._save(job)
+        logger.info(f"Queued {kind} job {job.id}")
+        return job
+
+    def record(self, kind: str, result: Any) -> Job:
+        """
+        Register an already-finished job (e.g. a cache hit) without queueing it behind real work
+        """
+        self._prune()
+        job = Job(kind, None)
+        job.result = result
+        job.status = Job.COMPLETED
+        job.started_at = job.finished_at = job.created_at
+        self.jobs[job.id] = job
+        self._save(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        job = self.jobs.get(job_id)
+        if job is None and self.store is not None:
+            # Submitted to another worker process
+            job = self.store.load(job_id)
+        return job
+
+    def _drop(self, kind: str, on_drop: Optional[DropFn]) -> None:
+        if on_drop is None:
+            return
+        try:
+            on_drop()
+        except Exception as e:
+            logger.warning(f"Cleanup of dropped {kind} job failed: {e}")
+
+    def _save(self, job: Job) -> None:
+        if self.store is None:
+            return
+        try:
+            self.store.save(job)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to store {job.kind} job {job.id}: {e}")
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _prune(self) -> None:
+        # Forget finished jobs once clients have had time to collect them
+        cutoff = time.time() - self.retention_seconds
+        expired = [
+            job_id for job_id, job in self.jobs.items()
+            if job.done and job.finished_at < cutoff
+        ]
+        for job_id in expired:
+            del self.jobs[job_id]
+        if self.store is not None:
+            self.store.prune(cutoff)
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            job = await self._queue.get()
+            job.status = Job.RUNNING
+            job.started_at = time.time()
+            self._save(job)
+            try:
+                job.result = await job.fn()
+                job.status = Job.COMPLETED
+            except Exception as e:
+                logger.error(f"{job.kind} job {job.id} failed: {str(e)}")
+                job.error = str(e)
+                job.status = Job.FAILED
+            finally:
+                job.fn = job.on_drop = None
+                job.finished_at = time.time()
+                self._save(job)
+                self._queue.task_done()
+            logger.info(f"{job.kind} job {job.id} {job.status} in {job.finished_at - job.started_at:.1f}s")
@@ -0,0 +1,68 @@
+"""
+Incremental parser for a streamed JSON array.
+
+Gemini streams structured output in arbitrary text chunks. JSONArrayStream
+is fed those chunks and hands back the raw JSON text of each top-level
+array element as soon as it is complete, so callers can validate and use
+elements while the rest of the array is still being generated. A malformed
+or truncated tail only loses the elements it contains.
+"""
+
+from typing import List
+
+
+class JSONArrayStream:
+    """
+    Splits a JSON array arriving in chunks into its top-level elements
+    """
+
+    def __init__(self):
+        self.started = False  # saw the opening "["
+        self.finished = False  # saw the closing "]"
+        self._buffer = ""  # text of the element being read
+        self._depth = 0  # nesting depth inside the current element
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, text: str) -> List[str]:
+        """
+        Consume the next chunk; returns the elements it completed, as JSON text
+        """
+        elements: List[str] = []
+        for char in text:
+            if self.finished:
+                break
+            if not self.started:
+                # Skip anything before the array, e.g. a ```json fence
+                self.started = char == "["
+                continue
+
+            if self._in_string:
+                self._buffer += char
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+
+            if self._depth == 0 and char in ",]":
+                # End of a scalar element (or of the array itself)
+                if self._buffer.strip():
+                    elements.append(self._buffer.strip())
+                self._buffer = ""
+                self.finished = char == "]"
+                continue
+
+            self._buffer += char
+            if char == '"':
+                self._in_string = True
+            elif char in "[{":
+                self._depth += 1
+            elif char in "]}":
+                self._depth -= 1
+                if self._depth == 0:
+                    elements.append(self._buffer.strip())
+                    self._buffer = ""
+        return elements
@@ -0,0 +1,416 @@
+"""
+Non-blocking wrapper around the Gemini SDK.
+
+The google-generativeai calls (generate_content, upload_file, get_file) are
+synchronous. Calling them straight from an ``async def`` endpoint blocks the
+uvicorn event loop, so every other request waits behind one slow Gemini call.
+LLMClient runs them on a dedicated, bounded thread pool and caps the number
+of calls that may be in flight at once.
+
+Calls beyond that cap wait in a bounded queue. When max_queue calls are
+already waiting, or a call waits longer than queue_timeout, it fails fast
+with LLMOverloaded (which carries a Retry-After estimate) instead of
+piling more load onto Gemini. Calls made inside ``background()`` (the
+analysis jobs, which are already bounded by the job queue) wait as long as
+needed and don't count against max_queue.
+
+With a Resilience attached, every call also runs under a CallPolicy (see
+resilience.py): a deadline, retries of transient errors and, for chat,
+hedging. Each retry or hedge queues for its own slot.
+
+An attempt that gives up can't stop its SDK call, which keeps its slot
+until it returns, so every call needs a transport timeout of its own.
+genai.upload_file and genai.get_file don't take one (and the upload's
+discovery request has none at all), so the client makes those File API
+requests itself, with the attempt's time left as the socket timeout.
+
+Given the histograms from metrics.py, the client also records how long
+generate calls, uploads and PROCESSING waits take, and the prompt and
+response token counts Gemini reports.
+"""
+
+import asyncio
+import contextvars
+import logging
+import math
+import mimetypes
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+import httplib2
+from google.generativeai.client import GENAI_API_DISCOVERY_URL, get_default_file_client
+from google.generativeai.types import File
+from googleapiclient.discovery import build_from_document
+from googleapiclient.http import HttpRequest, MediaFileUpload
+
+from metrics import Histogram
+from resilience import CallPolicy, Resilience
+
+logger = logging.getLogger(__name__)
+
+_STREAM_END = object()
+
+# Set while running background work, whose calls are exempt from the wait-queue limit
+_background = contextvars.ContextVar("llm_background", default=False)
+
+
+# Socket timeout for File API requests made without a policy deadline
+FILE_REQUEST_TIMEOUT = 120.0
+
+
+def _with_timeout(kwargs: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+    # google-generativeai takes per-request options, including the timeout, in request_options
+    return {**kwargs, "request_options": {**kwargs.get("request_options", {}), "timeout": timeout}}
+
+
+def _request_timeout(request_options: Optional[Dict[str, Any]]) -> float:
+    return (request_options or {}).get("timeout") or FILE_REQUEST_TIMEOUT
+
+
+def get_file(name: str, request_options: Optional[Dict[str, Any]] = None) -> File:
+    """
+    genai.get_file, passing on the timeout the SDK's file client takes
+    """
+    if "/" not in name:
+        name = f"files/{name}"
+    return File(get_default_file_client().get_file(name=name, timeout=_request_timeout(request_options)))
+
+
+_discovery_document: Optional[str] = None
+
+
+def upload_file(
+    api_key: str,
+    path: str,
+    mime_type: Optional[str] = None,
+    display_name: Optional[str] = None,
+    request_options: Optional[Dict[str, Any]] = None,
+) -> File:
+    """
+    genai.upload_file, with a socket timeout on every request it makes
+
+    The timeout bounds each send and receive, not the whole upload, so a
+    stalled connection fails instead of holding its thread forever.
+    """
+    global _discovery_document
+    mime_type = mime_type or mimetypes.guess_type(path)[0]
+    if mime_type is None:
+        raise ValueError(f"Could not determine the MIME type of {path}")
+    timeout = _request_timeout(request_options)
+    http = httplib2.Http(timeout=timeout)
+    try:
+        if _discovery_document is None:
+            # The same document for every upload; genai.upload_file fetches it each time
+            _, content = HttpRequest(
+                http,
+                lambda response, content: (response, content),
+                f"{GENAI_API_DISCOVERY_URL}?version=v1beta&key={api_key}",
+            ).execute()
+            _discovery_document = content.decode("utf-8")
+        api = build_from_document(_discovery_document, developerKey=api_key, http=http)
+        media = MediaFileUpload(path, mimetype=mime_type, resumable=True)
+        body = {"file": {"displayName": display_name or os.path.basename(path)}}
+        result = api.media().upload(body=body, media_body=media).execute()
+    finally:
+        http.close()
+    return get_file(result["file"]["name"], {"timeout": timeout})
+
+
+class LLMOverloaded(Exception):
+    """
+    Too many Gemini calls are already waiting; retry_after is in seconds
+    """
+
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(f"Too many requests waiting for Gemini, retry in {self.retry_after_header}s")
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class LLMClient:
+    """
+    Shared async entry point for every upstream Gemini call
+    """
+
+    def __init__(
+        self,
+        model: Any,
+        max_concurrency: int = 8,
+        max_queue: Optional[int] = None,
+        queue_timeout: Optional[float] = None,
+        resilience: Optional[Resilience] = None,
+        default_policy: Optional[CallPolicy] = None,
+        stage_seconds: Optional[Histogram] = None,
+        token_counts: Optional[Histogram] = None,
+        api_key: Optional[str] = None,
+    ):
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue  # None: unbounded
+        self.queue_timeout = queue_timeout  # None: wait as long as it takes
+        self.resilience = resilience  # None: single attempt, no deadline
+        self.default_policy = default_policy or CallPolicy("default", deadline=120.0)
+        self.stage_seconds = stage_seconds  # labels: stage
+        self.token_counts = token_counts  # labels: direction, policy
+        self.api_key = api_key  # for File API uploads
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency,
+            thread_name_prefix="gemini",
+        )
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.queue_timeouts = 0
+        self.max_wait = 0.0
+        self._avg_call_seconds = 1.0  # moving average, for Retry-After estimates
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # Created lazily so the semaphore binds to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    @contextmanager
+    def background(self) -> Iterator[None]:
+        """
+        Calls made inside this block queue without limit (for background jobs)
+        """
+        token = _background.set(True)
+        try:
+            yield
+        finally:
+            _background.reset(token)
+
+    @contextmanager
+    def _timed(self, stage: str) -> Iterator[None]:
+        if self.stage_seconds is None:
+            yield
+            return
+        with self.stage_seconds.labels(stage=stage).time():
+            yield
+
+    def _record_usage(self, response: Any, policy: Optional[CallPolicy]) -> None:
+        # usage_metadata is absent on some responses (and on test fakes)
+        usage = getattr(response, "usage_metadata", None)
+        if self.token_counts is None or usage is None:
+            return
+        name = (policy or self.default_policy).name
+        self.token_counts.labels(direction="prompt", policy=name).observe(usage.prompt_token_count or 0)
+        self.token_counts.labels(direction="response", policy=name).observe(usage.candidates_token_count or 0)
+
+    def retry_after(self) -> float:
+        """
+        Rough seconds until a newly queued call would get a slot
+        """
+        return self._avg_call_seconds * (self.waiting + 1) / self.max_concurrency
+
+    def check_capacity(self) -> None:
+        """
+        Raise LLMOverloaded (or CircuitOpen) if a new interactive call would be rejected right now
+        """
+        if self.resilience is not None:
+            self.resilience.breaker.raise_if_open()
+        if self.max_queue is not None and self.waiting >= self.max_queue and self._get_semaphore().locked():
+            raise LLMOverloaded(self.retry_after())
+
+    @asynccontextmanager
+    async def _slot(self) -> AsyncIterator[Callable[[Future], None]]:
+        # Wait (boundedly, unless in background()) for one of the max_concurrency call slots.
+        # Yields a function handing the slot to an executor future, which then holds it until it finishes
+        semaphore = self._get_semaphore()
+        loop = asyncio.get_running_loop()
+        background = _background.get()
+        queued = loop.time()
+        if not semaphore.locked():
+            # A free slot is taken without suspending, so the next caller sees the updated count
+            await semaphore.acquire()
+        else:
+            if not background and self.max_queue is not None and self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise LLMOverloaded(self.retry_after())
+            self.waiting += 1
+            try:
+                if self.queue_timeout is None or background:
+                    await semaphore.acquire()
+                else:
+                    await asyncio.wait_for(semaphore.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                self.queue_timeouts += 1
+                raise LLMOverloaded(self.retry_after())
+            finally:
+                self.waiting -= 1
+        started = loop.time()
+        self.max_wait = max(self.max_wait, started - queued)
+        self.in_flight += 1
+        holders: List[Future] = []
+
+        def release() -> None:
+            self.in_flight -= 1
+            semaphore.release()
+            self._avg_call_seconds = 0.9 * self._avg_call_seconds + 0.1 * (loop.time() - started)
+
+        def release_from_thread(future: Future) -> None:
+            try:
+                loop.call_soon_threadsafe(release)
+            except RuntimeError:
+                pass  # the loop is already closed
+
+        try:
+            yield holders.append
+        finally:
+            if holders and not holders[0].done():
+                # The caller gave up (cancelled, deadline, hedge lost) but the thread can't be
+                # interrupted: it keeps using Gemini, so it keeps the slot until it returns
+                holders[0].add_done_callback(release_from_thread)
+            else:
+                release()
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Run a blocking SDK call on the Gemini thread pool without blocking the event loop
+        """
+        async with self._slot() as hold:
+            future = self._executor.submit(fn, *args, **kwargs)
+            hold(future)
+            return await asyncio.wrap_future(future)
+
+    async def _call(self, policy: Optional[CallPolicy], fn: Callable[..., Any], *args, sdk_timeout: bool = False, **kwargs) -> Any:
+        # Through the resilience policy when configured; sdk_timeout passes each attempt's time left to the SDK
+        if self.resilience is None:
+            return await self.run(fn, *args, **kwargs)
+
+        def attempt(timeout: float) -> Any:
+            return self.run(fn, *args, **(_with_timeout(kwargs, timeout) if sdk_timeout else kwargs))
+
+        return await self.resilience.call(
+            attempt,
+            policy or self.default_policy,
+            can_hedge=lambda: not self._get_semaphore().locked(),
+        )
+
+    async def generate(self, contents: Any, policy: Optional[CallPolicy] = None, **kwargs) -> Any:
+        """
+        Async equivalent of model.generate_content
+        """
+        with self._timed("generate"):
+            response = await self._call(policy, self.model.generate_content, contents, sdk_timeout=True, **kwargs)
+        self._record_usage(response, policy)
+        return response
+
+    async def generate_stream(self, contents: Any, policy: Optional[CallPolicy] = None, **kwargs) -> AsyncIterator[Any]:
+        """
+        Async equivalent of model.generate_content(stream=True), yielding chunks as Gemini produces them
+        """
+        if self.resilience is None:
+            chunks = self._stream(contents, **kwargs)
+        else:
+            chunks = self.resilience.stream(
+                lambda timeout: self._stream(contents, **_with_timeout(kwargs, timeout)),
+                policy or self.default_policy,
+            )
+        chunk = None
+        try:
+            with self._timed("generate_stream"):
+                async for chunk in chunks:
+                    yield chunk
+        finally:
+            await chunks.aclose()
+        # Each chunk carries the usage so far; the last one has the totals
+        self._record_usage(chunk, policy)
+
+    async def _stream(self, contents: Any, **kwargs) -> AsyncIterator[Any]:
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for chunk in self.model.generate_content(contents, stream=True, **kwargs):
+                    if stop.is_set():
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, (chunk, None))
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, (None, e))
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, (_STREAM_END, None))
+
+        async with self._slot() as hold:
+            future = self._executor.submit(produce)
+            hold(future)
+            try:
+                while True:
+                    chunk, error = await queue.get()
+                    if error is not None:
+                        raise error
+                    if chunk is _STREAM_END:
+                        break
+                    yield chunk
+            finally:
+                # Stop the producer early if the consumer went away (e.g. client disconnect)
+                stop.set()
+                if future.done():
+                    future.result()
+
+    async def upload_file(self, path: str, policy: Optional[CallPolicy] = None, **kwargs) -> Any:
+        """
+        Async equivalent of genai.upload_file
+        """
+        if self.api_key is None:
+            raise ValueError("Uploading to the File API requires an API key")
+        with self._timed("gemini_upload"):
+            return await self._call(policy, upload_file, self.api_key, path, sdk_timeout=True, **kwargs)
+
+    async def get_file(self, name: str, policy: Optional[CallPolicy] = None) -> Any:
+        """
+        Async equivalent of genai.get_file
+        """
+        return await self._call(policy, get_file, name, sdk_timeout=True)
+
+    async def wait_for_file(
+        self,
+        file: Any,
+        initial_delay: float = 0.5,
+        max_delay: float = 8.0,
+        timeout: float = 300.0,
+        policy: Optional[CallPolicy] = None,
+    ) -> Any:
+        """
+        Poll an uploaded file until Gemini finishes PROCESSING it, backing off exponentially
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        delay = initial_delay
+        with self._timed("file_processing_wait"):
+            while file.state.name == "PROCESSING":
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise TimeoutError(f"Gemini is still processing {file.name} after {timeout:.0f}s")
+                await asyncio.sleep(min(delay, remaining))
+                delay = min(delay * 2, max_delay)
+                file = await self.get_file(file.name, policy)
+        return file
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "queue_depth": self.waiting,
+            "max_queue": self.max_queue,
+            "rejected": self.rejected,
+            "queue_timeouts": self.queue_timeouts,
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            "avg_call_ms": round(self._avg_call_seconds * 1000, 1),
+        }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
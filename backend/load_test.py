@@ -0,0 +1,1029 @@
+#!/usr/bin/env python3
+"""
+Load tests and benchmarks for the Medical AI Chat Backend.
+
+These run against local fakes, so no Gemini key or network is needed.
+
+Usage:
+    python load_test.py            # run everything
+    python load_test.py llm        # run a single benchmark by name
+"""
+
+import asyncio
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+from google.api_core.exceptions import ServiceUnavailable
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import UploadFile
+
+from compression import brotli
+from document_analysis import ANALYSIS_MODES, analyze_document, extract_key_facts
+from history_repo import HISTORY_SORT, HistoryRepository, encode_page_token
+from llm_client import LLMClient, LLMOverloaded
+from metrics import MetricsRegistry
+from prompt_builder import build_chat_prompt
+from rate_limit import RateLimited, RateLimiter
+from resilience import CallPolicy, CircuitBreaker, CircuitOpen, Resilience
+from serialization import FastJSONResponse, ndjson_chunks, orjson
+from sessions import Session, SQLiteSessionStore
+from singleflight import SingleFlight
+from uploads import ingest_upload
+from video_preprocess import PREPROCESS_MODES, VideoPreprocessor, cv2, np
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeModel:
+    """Stand-in for genai.GenerativeModel with a fixed, blocking latency"""
+
+    def __init__(self, latency=0.5):
+        self.latency = latency
+
+    def generate_content(self, contents, **kwargs):
+        time.sleep(self.latency)
+        return FakeResponse(f"Fake answer to: {str(contents)[:40]}")
+
+
+class FakeDocumentModel(FakeModel):
+    """FakeModel that answers structured (JSON) requests with a summary and key facts"""
+
+    def generate_content(self, contents, **kwargs):
+        time.sleep(self.latency)
+        if "generation_config" in kwargs:
+            return FakeResponse(json.dumps({"summary": "Fake analysis", "key_facts": ["Fact one", "Fact two"]}))
+        return FakeResponse("Fact one\nFact two")
+
+
+class FaultyModel(FakeModel):
+    """FakeModel that fails with a 503, hangs or answers slowly at the given rates"""
+
+    def __init__(self, latency=0.02, error_rate=0.0, hang_rate=0.0, slow_rate=0.0, slow_latency=0.5, hang_latency=2.0):
+        super().__init__(latency)
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.hang_latency = hang_latency
+        self.calls = 0
+
+    def generate_content(self, contents, **kwargs):
+        self.calls += 1
+        roll = random.random()
+        if roll < self.error_rate:
+            time.sleep(self.latency)
+            raise ServiceUnavailable("injected fault")
+        roll -= self.error_rate
+        if roll < self.hang_rate:
+            # Sleeps past the deadline; the SDK timeout in request_options is what would end it
+            time.sleep(min(self.hang_latency, kwargs.get("request_options", {}).get("timeout", self.hang_latency)))
+            raise ServiceUnavailable("injected hang")
+        roll -= self.hang_rate
+        time.sleep(self.slow_latency if roll < self.slow_rate else self.latency)
+        return FakeResponse("Fake answer")
+
+
+def bench_llm_concurrency(n=8, latency=0.5):
+    """N concurrent chats should finish in about the time of one, not N"""
+    print(f"\n⚡ LLM client concurrency ({n} chats, {latency}s fake latency)")
+    fake = FakeModel(latency=latency)
+
+    async def blocking():
+        # What the endpoints used to do: call the sync SDK inside async def
+        async def chat(i):
+            return fake.generate_content(f"question {i}")
+        await asyncio.gather(*(chat(i) for i in range(n)))
+
+    async def non_blocking():
+        llm = LLMClient(fake, max_concurrency=n)
+        try:
+            await asyncio.gather(*(llm.generate(f"question {i}") for i in range(n)))
+        finally:
+            llm.shutdown()
+
+    start = time.perf_counter()
+    asyncio.run(blocking())
+    blocking_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    asyncio.run(non_blocking())
+    client_time = time.perf_counter() - start
+
+    print(f"  direct generate_content: {blocking_time:.2f}s")
+    print(f"  LLMClient.generate:      {client_time:.2f}s")
+    ok = client_time < latency * 2
+    print(f"{'✅' if ok else '❌'} speedup {blocking_time / client_time:.1f}x")
+    return ok
+
+
+def bench_admission(burst=40, concurrency=4, max_queue=8, latency=0.2):
+    """Under a burst, calls beyond the wait queue are turned away at once instead of queuing for seconds"""
+    print(f"\n🚦 Admission control ({burst} simultaneous chats, {concurrency} Gemini slots, {latency}s fake latency)")
+    fake = FakeModel(latency=latency)
+
+    async def chat(llm, i):
+        start = time.perf_counter()
+        try:
+            await llm.generate(f"question {i}")
+            return "served", time.perf_counter() - start
+        except LLMOverloaded:
+            return "rejected", time.perf_counter() - start
+
+    async def run(llm):
+        try:
+            return await asyncio.gather(*(chat(llm, i) for i in range(burst)))
+        finally:
+            llm.shutdown()
+
+    ok = True
+    for name, llm in (
+        ("unbounded queue", LLMClient(fake, max_concurrency=concurrency)),
+        (f"max_queue={max_queue}", LLMClient(fake, max_concurrency=concurrency, max_queue=max_queue)),
+    ):
+        outcomes = asyncio.run(run(llm))
+        served = [elapsed for outcome, elapsed in outcomes if outcome == "served"]
+        rejected = [elapsed for outcome, elapsed in outcomes if outcome == "rejected"]
+        print(f"  {name:16s}: {len(served):2d} served (slowest {max(served):.2f}s), {len(rejected):2d} rejected"
+              + (f" within {max(rejected) * 1000:.1f}ms" if rejected else ""))
+        if rejected:
+            ok = ok and len(served) == concurrency + max_queue and max(rejected) < 0.05
+
+    # A client hammering the API is limited without touching anyone else's budget
+    limiter = RateLimiter(rate=30 / 60, burst=10)
+    noisy = quiet = 0
+    for i in range(100):
+        for key in ("user:noisy",) + (("user:quiet",) if i % 20 == 0 else ()):
+            try:
+                limiter.acquire(key)
+                if key == "user:noisy":
+                    noisy += 1
+                else:
+                    quiet += 1
+            except RateLimited:
+                pass
+    print(f"  rate limiter: noisy client got {noisy}/100 requests through, quiet client {quiet}/5")
+    ok = ok and noisy == 10 and quiet == 5
+    print(f"{'✅' if ok else '❌'} overload answered fast, per-client budgets isolated")
+    return ok
+
+
+def bench_resilience(calls=200, concurrency=8):
+    """Retries, deadlines and hedging against injected faults, and a breaker that fails fast during an outage"""
+    print(f"\n🛡️  Resilience ({calls} calls against a fault-injecting fake)")
+    random.seed(1)
+
+    async def run(fake, policy, resilience=None):
+        # Spare slots, so hedges don't queue behind the calls they duplicate
+        llm = LLMClient(fake, max_concurrency=concurrency * 2, resilience=resilience)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(i):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    await llm.generate(f"question {i}", policy=policy)
+                    return True, time.perf_counter() - start
+                except Exception:
+                    return False, time.perf_counter() - start
+
+        try:
+            return await asyncio.gather(*(one(i) for i in range(calls)))
+        finally:
+            llm.shutdown()
+
+    def summary(outcomes):
+        latencies = sorted(elapsed for _, elapsed in outcomes)
+        success = sum(1 for ok, _ in outcomes if ok) / len(outcomes)
+        return success, latencies[int(0.99 * (len(latencies) - 1))], latencies[-1]
+
+    # No breaker here: these runs measure retries, deadlines and hedging on their own
+    def resilience():
+        return Resilience(CircuitBreaker(failure_threshold=0), base_delay=0.01)
+
+    ok = True
+    print("  (success rate, p99, slowest)")
+    faults = dict(error_rate=0.1, hang_rate=0.02, hang_latency=2.0)
+    plain = summary(asyncio.run(run(FaultyModel(**faults), CallPolicy("chat", deadline=5.0))))
+    guarded = summary(asyncio.run(run(FaultyModel(**faults), CallPolicy("chat", deadline=0.5), resilience())))
+    print(f"  10% errors, 2% hangs, no policy:        {plain[0]:5.1%}  {plain[1]:.2f}s  {plain[2]:.2f}s")
+    print(f"  0.5s deadline, 2 retries:               {guarded[0]:5.1%}  {guarded[1]:.2f}s  {guarded[2]:.2f}s")
+    ok = ok and guarded[0] > plain[0] and guarded[2] < 0.6
+
+    tail = dict(slow_rate=0.03, slow_latency=0.5)
+    unhedged = summary(asyncio.run(run(FaultyModel(**tail), CallPolicy("chat", deadline=5.0), resilience())))
+    hedging = resilience()
+    hedged = summary(asyncio.run(run(FaultyModel(**tail), CallPolicy("chat", deadline=5.0, hedge=True), hedging)))
+    print(f"  3% slow (0.5s), no hedging:             {unhedged[0]:5.1%}  {unhedged[1]:.2f}s  {unhedged[2]:.2f}s")
+    print(f"  3% slow (0.5s), hedged at p95:          {hedged[0]:5.1%}  {hedged[1]:.2f}s  {hedged[2]:.2f}s"
+          f"  ({hedging.hedges} hedges, {hedging.hedges / calls:.0%} extra calls)")
+    ok = ok and hedged[1] < unhedged[1]
+
+    # Outage: once the breaker opens, calls are refused without touching the upstream
+    async def outage():
+        fake = FaultyModel(latency=0.05, error_rate=1.0)
+        breaker = CircuitBreaker(failure_threshold=5, reset_timeout=30)
+        llm = LLMClient(fake, max_concurrency=concurrency, resilience=Resilience(breaker, base_delay=0.01))
+        policy = CallPolicy("chat", deadline=5.0, retries=0)
+        refused = []
+        try:
+            for i in range(50):
+                start = time.perf_counter()
+                try:
+                    await llm.generate(f"question {i}", policy=policy)
+                except CircuitOpen:
+                    refused.append(time.perf_counter() - start)
+                except ServiceUnavailable:
+                    pass
+        finally:
+            llm.shutdown()
+        return fake.calls, refused
+
+    upstream_calls, refused = asyncio.run(outage())
+    print(f"  outage: {upstream_calls} calls reached Gemini, {len(refused)} refused"
+          f" in at most {max(refused) * 1000:.2f}ms each")
+    ok = ok and upstream_calls == 5 and max(refused) < 0.001
+    print(f"{'✅' if ok else '❌'} transient faults retried, hung calls bounded, outages fail fast")
+    return ok
+
+
+def bench_singleflight(duplicates=5, requests=4, latency=0.3):
+    """Double submits and retries of the same work share one Gemini call"""
+    print(f"\n🔁 Single-flight ({requests} distinct requests, each submitted {duplicates}x at once, {latency}s fake latency)")
+
+    class CountingModel(FakeModel):
+        calls = 0
+
+        def generate_content(self, contents, **kwargs):
+            CountingModel.calls += 1
+            return super().generate_content(contents, **kwargs)
+
+    async def run(coalesce):
+        CountingModel.calls = 0
+        llm = LLMClient(CountingModel(latency=latency), max_concurrency=4)
+        inflight = SingleFlight()
+
+        async def submit(i):
+            if coalesce:
+                return await inflight.do("document", i, lambda: llm.generate(f"document {i}"))
+            return await llm.generate(f"document {i}")
+
+        start = time.perf_counter()
+        try:
+            await asyncio.gather(*(submit(i) for i in range(requests) for _ in range(duplicates)))
+        finally:
+            llm.shutdown()
+        return CountingModel.calls, time.perf_counter() - start, inflight.stats()
+
+    direct_calls, direct_time, _ = asyncio.run(run(False))
+    coalesced_calls, coalesced_time, stats = asyncio.run(run(True))
+    print(f"  without coalescing: {direct_calls:2d} Gemini calls, {direct_time:.2f}s")
+    print(f"  single-flight:      {coalesced_calls:2d} Gemini calls, {coalesced_time:.2f}s"
+          f" ({stats['coalesced']['document']} requests coalesced)")
+    ok = coalesced_calls == requests and stats["coalesced"]["document"] == requests * (duplicates - 1)
+    print(f"{'✅' if ok else '❌'} {direct_calls / coalesced_calls:.0f}x fewer upstream calls for duplicate requests")
+    return ok
+
+
+def bench_metrics(observations=200_000, series=50):
+    """Timing every stage must cost microseconds, and a scrape must stay cheap"""
+    print(f"\n📈 Metrics overhead ({observations} observations over {series} series)")
+    registry = MetricsRegistry()
+    histogram = registry.histogram("stage_seconds", "Stage latency", ["stage"])
+    counter = registry.counter("errors_total", "Errors", ["endpoint"])
+
+    start = time.perf_counter()
+    for i in range(observations):
+        histogram.labels(stage=f"stage{i % series}").observe((i % 1000) / 1000)
+    observe_time = (time.perf_counter() - start) / observations
+
+    start = time.perf_counter()
+    for i in range(observations):
+        with histogram.labels(stage="timed").time():
+            pass
+    timer_time = (time.perf_counter() - start) / observations
+    for i in range(series):
+        counter.labels(endpoint=f"/api/endpoint{i}").inc()
+
+    start = time.perf_counter()
+    text = registry.render()
+    render_time = time.perf_counter() - start
+    print(f"  observe:      {observe_time * 1e6:.2f}µs per call")
+    print(f"  time() block: {timer_time * 1e6:.2f}µs per call")
+    print(f"  render:       {render_time * 1000:.2f}ms for {len(text.splitlines())} lines")
+    ok = observe_time < 20e-6 and timer_time < 20e-6 and render_time < 0.05
+    print(f"{'✅' if ok else '❌'} instrumentation overhead negligible next to a Gemini call")
+    return ok
+
+
+def bench_upload_ingestion(sizes_mb=(5, 20, 50)):
+    """Peak memory while ingesting an upload should not grow with the file size"""
+    print("\n📥 Upload ingestion peak memory")
+    peaks = []
+    for size_mb in sizes_mb:
+        upload = UploadFile(io.BytesIO(b"\x1a\x45\xdf\xa3" + os.urandom(size_mb * 1024 * 1024)))
+        tracemalloc.start()
+        start = time.perf_counter()
+        ingested = asyncio.run(ingest_upload(upload, max_bytes=100 * 1024 * 1024))
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        ingested.discard()
+        peaks.append(peak)
+        print(f"  {size_mb:3d}MB upload: peak {peak / 1024 / 1024:.1f}MB, {elapsed * 1000:.0f}ms")
+    ok = max(peaks) < 4 * 1024 * 1024
+    print(f"{'✅' if ok else '❌'} peak memory stays bounded")
+    return ok
+
+
+def _session_worker(args):
+    """One 'uvicorn worker': serve chat requests against the shared SQLite session store"""
+    return asyncio.run(_serve_sessions(*args))
+
+
+async def _serve_sessions(db_path, worker, requests, users):
+    store = SQLiteSessionStore(db_path)
+    await store.add_document("shared-patient", f"Document uploaded through worker {worker}", [])
+    start = time.perf_counter()
+    for i in range(requests):
+        user_id = f"patient-{i % users}"
+        session = await store.get(user_id)
+        prompt = "\n".join(turn.content for turn in session.recent_turns(10))
+        # Stand-in for the per-request CPU work (validation, prompt formatting, serialization)
+        digest = prompt.encode()
+        for _ in range(200):
+            digest = hashlib.sha256(digest).digest()
+        await store.add_exchange(user_id, f"worker {worker} question {i}", "Fake answer " * 40)
+    elapsed = time.perf_counter() - start
+    store.close()
+    return elapsed
+
+
+def bench_session_store_workers(requests=2000, users=50):
+    """Several worker processes share one history and scale with the number of cores"""
+    cores = os.cpu_count() or 1
+    print(f"\n🗄️  Shared SQLite session store ({requests} requests, {cores} cores)")
+    ok = True
+    baseline = None
+    for processes in sorted({1, min(4, cores)}):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, "sessions.db")
+            SQLiteSessionStore(db_path).close()  # create the schema once
+            start = time.perf_counter()
+            with multiprocessing.Pool(processes) as pool:
+                pool.map(_session_worker, [
+                    (db_path, worker, requests // processes, users) for worker in range(processes)
+                ])
+            elapsed = time.perf_counter() - start
+
+            # Every worker's writes must be visible to a fresh process
+            store = SQLiteSessionStore(db_path)
+            documents = asyncio.run(store.get("shared-patient")).documents
+            # Turns pushed out of the ring buffer are deleted, so the table stays bounded
+            most_turns = store._conn.execute(
+                "SELECT MAX(n) FROM (SELECT COUNT(*) AS n FROM session_records"
+                " WHERE kind = 'turn' GROUP BY user_key)"
+            ).fetchone()[0]
+            store.close()
+            visible = len(documents) == processes
+            bounded = most_turns <= store.max_turns + 2 * processes
+            ok = ok and visible and bounded
+
+        throughput = requests / elapsed
+        baseline = baseline or throughput
+        print(f"  {processes} worker(s): {throughput:7.0f} req/s ({throughput / baseline:.1f}x), "
+              f"all workers' writes visible: {visible}, most turn rows per user: {most_turns}")
+    print(f"{'✅' if ok else '❌'} workers share one session history")
+    return ok
+
+
+def bench_document_analysis(latency=0.3):
+    """Single-pass and background key facts vs. the sequential summary + key-facts calls"""
+    print(f"\n📄 Document analysis modes ({latency}s fake latency per Gemini call)")
+
+    async def run(mode):
+        llm = LLMClient(FakeDocumentModel(latency=latency))
+        try:
+            start = time.perf_counter()
+            analysis = await analyze_document(llm, "fake-file-handle", mode)
+            summary_time = time.perf_counter() - start
+            key_facts = analysis.key_facts
+            if key_facts is None:
+                key_facts = await extract_key_facts(llm, analysis.summary)
+            return summary_time, time.perf_counter() - start, key_facts
+        finally:
+            llm.shutdown()
+
+    results = {}
+    for mode in ANALYSIS_MODES:
+        summary_time, total_time, key_facts = asyncio.run(run(mode))
+        results[mode] = summary_time
+        print(f"  {mode:10s}: summary returned after {summary_time:.2f}s, "
+              f"key facts after {total_time:.2f}s ({len(key_facts)} facts)")
+    ok = max(results["single"], results["background"]) < 0.75 * results["sequential"]
+    print(f"{'✅' if ok else '❌'} summary latency {results['sequential'] / results['single']:.1f}x lower than sequential")
+    return ok
+
+
+def _record_webcam_video(path, seconds=10, fps=30, size=(1280, 720)):
+    """Synthetic webcam recording: a still scene with sensor noise and a few seconds of movement"""
+    width, height = size
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"VP80"), fps, size)
+    gradient = np.tile(np.linspace(40, 200, width, dtype=np.uint8), (height, 1))
+    scene = cv2.merge([gradient, gradient // 2 + 60, 255 - gradient])
+    rng = np.random.default_rng(0)
+    for i in range(seconds * fps):
+        frame = scene.copy()
+        if 3 * fps <= i < 6 * fps:
+            # The patient moves their hand across the frame
+            cv2.circle(frame, (width // 4 + (i - 3 * fps) * 8, height // 2), 120, (90, 140, 200), -1)
+        noise = rng.integers(-3, 4, frame.shape, dtype=np.int16)
+        writer.write(np.clip(frame.astype(np.int16) + noise, 0, 255).astype(np.uint8))
+    writer.release()
+
+
+def _record_moving_video(path, seconds, fps=10, size=(1280, 720)):
+    """Synthetic recording where every sampled frame differs from the last (constant motion)"""
+    width, height = size
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"VP80"), fps, size)
+    for i in range(seconds * fps):
+        frame = np.full((height, width, 3), (i * 7) % 200 + 30, dtype=np.uint8)
+        cv2.circle(frame, ((i * 97) % width, (i * 53) % height), 200, (255, 255 - (i * 11) % 255, 0), -1)
+        writer.write(frame)
+    writer.release()
+
+
+def bench_video_preprocessing(uplink_mbps=20.0, motion_seconds=(10, 30)):
+    """Bytes sent to Gemini and time to get them there, with and without pre-processing"""
+    print(f"\n🎬 Video pre-processing (measured pre-processing time; upload time is an estimate at {uplink_mbps:.0f} Mbit/s)")
+    if cv2 is None:
+        print("  opencv-python / numpy not installed, skipping")
+        return True
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "recording.webm")
+        _record_webcam_video(path)
+        original = os.path.getsize(path)
+        for mode in PREPROCESS_MODES:
+            start = time.perf_counter()
+            prepared = asyncio.run(VideoPreprocessor(mode=mode).prepare(path))
+            preprocess_time = time.perf_counter() - start
+            sent = prepared.sent_bytes if prepared is not None else original
+            upload_estimate = sent * 8 / (uplink_mbps * 1_000_000)
+            frames = f"{prepared.frames_kept}/{prepared.frames_read} frames kept" if prepared else "original file"
+            print(f"  {mode:10s}: {sent / 1024:8.1f} KB sent ({frames}), "
+                  f"pre-processing {preprocess_time * 1000:5.0f}ms + est. upload {upload_estimate * 1000:5.0f}ms")
+            if prepared is not None:
+                prepared.discard()
+            elif mode != "off":
+                ok = False
+
+        # Constant motion: every sample is a distinct frame, the worst case for buffering
+        for mode in PREPROCESS_MODES[1:]:
+            peaks = []
+            for seconds in motion_seconds:
+                moving = os.path.join(tmp, f"moving-{seconds}.webm")
+                if not os.path.exists(moving):
+                    _record_moving_video(moving, seconds)
+                tracemalloc.start()
+                prepared = VideoPreprocessor(mode=mode).process(moving)
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                peaks.append(peak)
+                kept = prepared.frames_kept if prepared is not None else 0
+                print(f"  {mode:10s}: {seconds:3d}s of constant motion, {kept:3d} distinct frames, peak memory {peak / 1e6:5.1f}MB")
+                if prepared is not None:
+                    prepared.discard()
+            # Three times the distinct frames may not need more room for frames
+            ok = ok and peaks[-1] <= peaks[0] * 1.25 + 1e6
+    print(f"{'✅' if ok else '❌'} pre-processing reduces upload bytes in bounded memory")
+    return ok
+
+
+def _matches(document, query):
+    """Equality, $in, $lt and $or filters, the subset of Mongo queries the stand-in needs"""
+    for key, value in query.items():
+        if key == "$or":
+            if not any(_matches(document, clause) for clause in value):
+                return False
+        elif isinstance(value, dict) and "$in" in value:
+            if document.get(key) not in value["$in"]:
+                return False
+        elif isinstance(value, dict) and "$lt" in value:
+            # Like Mongo, $lt only compares values of the same type (a missing field never matches)
+            field = document.get(key)
+            if type(field) is not type(value["$lt"]) or not field < value["$lt"]:
+                return False
+        elif document.get(key) != value:
+            # None matches a missing field, as null does in Mongo
+            return False
+    return True
+
+
+def _sort_value(value):
+    # Missing and null fields sort lowest, as in Mongo
+    return (value is not None, value)
+
+
+class FakeHistoryCursor:
+    """Async cursor over FakeHistoryCollection documents, returned one batch per round trip"""
+
+    def __init__(self, collection, query):
+        self.collection = collection
+        self.query = query
+        self._sort = None
+        self._limit = 0
+        self._batch_size = 0
+        self.closed = False
+
+    def sort(self, keys):
+        self._sort = keys
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size):
+        self._batch_size = batch_size
+        return self
+
+    async def close(self):
+        self.closed = True
+
+    async def __aiter__(self):
+        # Matching and sorting happen "server-side" on references; documents are copied out lazily
+        documents = [document for document in self.collection.documents if _matches(document, self.query)]
+        for key, direction in reversed(self._sort or []):
+            documents.sort(key=lambda document: _sort_value(document.get(key)), reverse=direction < 0)
+        if self._limit:
+            documents = documents[:self._limit]
+        batch = self._batch_size or len(documents) or 1
+        for start in range(0, max(len(documents), 1), batch):
+            await asyncio.sleep(self.collection.latency)
+            for document in documents[start:start + batch]:
+                yield dict(document)
+
+
+class FakeHistoryCollection:
+    """In-process stand-in for an async Mongo collection with a fixed per-operation latency"""
+
+    def __init__(self, latency=0.2):
+        self.latency = latency
+        self.documents = []
+
+    async def insert_one(self, document):
+        await asyncio.sleep(self.latency)
+        document = {**document, "_id": ObjectId()}
+        self.documents.append(document)
+        return SimpleNamespace(inserted_id=document["_id"])
+
+    async def delete_one(self, query):
+        await asyncio.sleep(self.latency)
+        before = len(self.documents)
+        self.documents = [document for document in self.documents if document["_id"] != query["_id"]]
+        return SimpleNamespace(deleted_count=before - len(self.documents))
+
+    async def insert_many(self, documents, ordered=True):
+        await asyncio.sleep(self.latency)
+        self.documents.extend(dict(document) for document in documents)
+        return SimpleNamespace(inserted_ids=[document["_id"] for document in documents])
+
+    async def delete_many(self, query):
+        await asyncio.sleep(self.latency)
+        before = len(self.documents)
+        self.documents = [document for document in self.documents if not _matches(document, query)]
+        return SimpleNamespace(deleted_count=before - len(self.documents))
+
+    def find(self, query, projection=None):
+        return FakeHistoryCursor(self, query)
+
+    def find_blocking(self, query, limit):
+        # What the synchronous client did: block a thread for the round trip
+        time.sleep(self.latency)
+        return [document for document in self.documents if document.get("user_id") == query.get("user_id")][:limit]
+
+
+async def _history_burst(read, requests):
+    """Fire concurrent history reads and time a threadpool call (as a chat upload would make) issued meanwhile"""
+    burst = asyncio.gather(*(read(i) for i in range(requests)))
+    await asyncio.sleep(0.01)
+    start = time.perf_counter()
+    await run_in_threadpool(lambda: None)
+    bystander = time.perf_counter() - start
+    await burst
+    return bystander
+
+
+def _plan_stages(plan):
+    """All stage names in an explain() plan tree"""
+    stages = [plan.get("stage")]
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child:
+            stages.extend(_plan_stages(child))
+    return stages
+
+
+def bench_history_store(requests=200, latency=0.2):
+    """A slow Mongo must not exhaust the threadpool the other endpoints depend on"""
+    print(f"\n🍃 History reads ({requests} concurrent, {latency}s Mongo latency, in-process stand-in)")
+    collection = FakeHistoryCollection(latency=latency)
+    collection.documents = [
+        {"_id": ObjectId(), "user_id": f"patient-{i % 10}", "diagnosis": "Fake", "created_at": i} for i in range(200)
+    ]
+    repo = HistoryRepository(collection)
+
+    async def sync_reads():
+        return await _history_burst(
+            lambda i: run_in_threadpool(collection.find_blocking, {"user_id": f"patient-{i % 10}"}, 50), requests
+        )
+
+    async def async_reads():
+        return await _history_burst(lambda i: repo.find_page(f"patient-{i % 10}", 50), requests)
+
+    results = {}
+    for name, run in (("sync client in threadpool", sync_reads), ("HistoryRepository", async_reads)):
+        start = time.perf_counter()
+        bystander = asyncio.run(run())
+        results[name] = bystander
+        print(f"  {name:26s}: burst {time.perf_counter() - start:5.2f}s, "
+              f"unrelated threadpool call waited {bystander * 1000:7.1f}ms")
+    ok = results["HistoryRepository"] < 0.05
+
+    url = os.getenv("LOAD_TEST_MONGODB_URL")
+    if url:
+        # Same burst against a real mongod, to check the pool settings
+        async def real_reads():
+            real = HistoryRepository.from_url(url, "load_test", "history", max_pool_size=20)
+            try:
+                await real.collection.delete_many({})
+                await real.ensure_indexes()
+                for i in range(200):
+                    await real.insert({"user_id": f"patient-{i % 10}", "diagnosis": "Fake"})
+                start = time.perf_counter()
+                await asyncio.gather(*(real.find_page(f"patient-{i % 10}", 50) for i in range(requests)))
+                elapsed = time.perf_counter() - start
+                # Listing must be an index range scan with no in-memory sort
+                explain = await real.collection.find({"user_id": "patient-1"}).sort(HISTORY_SORT).limit(50).explain()
+                stages = _plan_stages(explain["queryPlanner"]["winningPlan"])
+                await real.collection.drop()
+                return elapsed, real.stats(), stages
+            finally:
+                await real.close()
+
+        elapsed, stats, stages = asyncio.run(real_reads())
+        print(f"  mongod at {url}: {requests} reads in {elapsed:.2f}s, pool {stats}")
+        print(f"  history listing plan: {' <- '.join(filter(None, stages))}")
+        ok = ok and "SORT" not in stages
+
+    print(f"{'✅' if ok else '❌'} history reads leave the threadpool free")
+    return ok
+
+
+def bench_history_bulk(entries=200, latency=0.02):
+    """Saving or clearing a whole history takes a round trip per batch, not per entry"""
+    print(f"\n📦 Saving and clearing {entries} history entries ({latency * 1000:.0f}ms Mongo latency, in-process stand-in)")
+    diagnoses = [{"user_id": "patient-1", "diagnosis": f"Fake {i}"} for i in range(entries)]
+
+    async def one_by_one():
+        repo = HistoryRepository(FakeHistoryCollection(latency=latency))
+        ids = [await repo.insert(diagnosis) for diagnosis in diagnoses]
+        deleted = [await repo.delete(ObjectId(document_id)) for document_id in ids]
+        return sum(deleted), len(repo.collection.documents)
+
+    async def bulk():
+        repo = HistoryRepository(FakeHistoryCollection(latency=latency))
+        inserted = await repo.insert_many(diagnoses, batch_size=100)
+        ids = [result["id"] for result in inserted] + ["not-an-id", str(ObjectId())]
+        deleted = await repo.delete_many(ids, batch_size=100)
+        # The two bogus ids are reported per item, not as a failed request
+        ok = [result["success"] for result in deleted] == [True] * entries + [False, False]
+        return sum(result["success"] for result in deleted) if ok else -1, len(repo.collection.documents)
+
+    results = {}
+    ok = True
+    for name, run in (("one request per entry", one_by_one), ("bulk endpoints", bulk)):
+        start = time.perf_counter()
+        deleted, remaining = asyncio.run(run())
+        results[name] = time.perf_counter() - start
+        ok = ok and deleted == entries and remaining == 0
+        print(f"  {name:22s}: {results[name]:6.2f}s, deleted {deleted}, {remaining} left")
+    ok = ok and results["bulk endpoints"] * 10 < results["one request per entry"]
+    print(f"{'✅' if ok else '❌'} bulk save and clear at least 10x faster")
+    return ok
+
+
+async def _page_through(repo, user_id, limit):
+    """Every entry of user_id, following next_before from page to page"""
+    seen, pages, before = [], 0, None
+    while True:
+        history, before = await repo.find_page(user_id, limit, before)
+        seen.extend(document["_id"] for document in history)
+        pages += 1
+        if before is None or pages > 1000:
+            return seen, pages
+
+
+def bench_history_paging(limit=25):
+    """Keyset pages cover a history exactly once, through tied timestamps and entries without one"""
+    print(f"\n📄 Paging a history {limit} entries at a time")
+    now = datetime.now().replace(microsecond=0)
+    documents = (
+        # More entries than fit on a page, all created in the same second
+        [{"user_id": "patient-0", "diagnosis": f"Tied {i}", "created_at": now} for i in range(2 * limit + 10)]
+        + [{"user_id": "patient-0", "diagnosis": f"Older {i}", "created_at": now - timedelta(days=i + 1)} for i in range(limit)]
+        # Saved before created_at was recorded
+        + [{"user_id": "patient-0", "diagnosis": f"Legacy {i}"} for i in range(limit + 5)]
+        + [{"user_id": "patient-1", "diagnosis": f"Other {i}", "created_at": now} for i in range(limit)]
+    )
+    for document in documents:
+        document["_id"] = ObjectId()
+    expected = sorted(
+        (document for document in documents if document["user_id"] == "patient-0"),
+        key=lambda document: (_sort_value(document.get("created_at")), document["_id"]),
+        reverse=True,
+    )
+    expected_ids = [document["_id"] for document in expected]
+
+    def check(name, seen, pages):
+        duplicates = len(seen) - len(set(seen))
+        missing = len(set(expected_ids) - set(seen))
+        exact = seen == expected_ids
+        print(f"  {name:14s}: {len(seen)} of {len(expected_ids)} entries in {pages} pages, "
+              f"{duplicates} duplicates, {missing} missing, order {'ok' if exact else 'wrong'}")
+        return exact
+
+    collection = FakeHistoryCollection(latency=0)
+    collection.documents = [dict(document) for document in documents]
+    ok = check("stand-in", *asyncio.run(_page_through(HistoryRepository(collection), "patient-0", limit)))
+
+    url = os.getenv("LOAD_TEST_MONGODB_URL")
+    if url:
+        async def real_pages():
+            real = HistoryRepository.from_url(url, "load_test", "history_paging")
+            try:
+                await real.collection.drop()
+                await real.ensure_indexes()
+                await real.collection.insert_many([dict(document) for document in documents])
+                return await _page_through(real, "patient-0", limit)
+            finally:
+                await real.collection.drop()
+                await real.close()
+
+        ok = check("mongod", *asyncio.run(real_pages())) and ok
+
+    # A malformed before token is the client's mistake: 400, not a 500
+    os.environ.setdefault("GEMINI_API_KEY", "load-test")
+    import main
+
+    async def status_for(before):
+        main.history_repo = HistoryRepository(collection)
+        try:
+            await main.get_medical_history(user_id="patient-0", limit=limit, before=before, view="full")
+            return 200
+        except main.HTTPException as e:
+            return e.status_code
+
+    bad_tokens = ["not-a-token", "!!!", encode_page_token({"created_at": now, "_id": "not-an-object-id"})]
+    statuses = [asyncio.run(status_for(token)) for token in bad_tokens]
+    print(f"  malformed before tokens answered with {statuses}")
+    ok = ok and statuses == [400] * len(bad_tokens)
+    print(f"{'✅' if ok else '❌'} history pages have no duplicates or gaps")
+    return ok
+
+
+def _history_document(i, now):
+    return {
+        "_id": ObjectId(),
+        "user_id": f"patient-{i % 10}",
+        "diagnosis": "Tension-type headache",
+        "date": "2025-06-21",
+        "duration": "3 days",
+        "symptoms": ["headache", "neck stiffness", "fatigue"],
+        "confidence": 0.72,
+        "followUpNeeded": i % 3 == 0,
+        "aiRecommendations": [
+            "Stay hydrated and keep regular meal times.",
+            "Take short breaks from screens every hour.",
+            "See a doctor if the headache becomes severe or is accompanied by fever.",
+        ],
+        "visionData": {"posture": "forward head", "eye_strain": True, "frames_analyzed": 48},
+        "voiceAnalysis": {"stress_level": "moderate", "speech_rate_wpm": 142},
+        "created_at": now - timedelta(minutes=i),
+        "updated_at": now - timedelta(minutes=i),
+    }
+
+
+def bench_serialization(entries=500, runs=20):
+    """Encode time for a full history page, and bytes on the wire with each encoding"""
+    print(f"\n🗜️  Serializing and compressing a {entries}-entry history page")
+    now = datetime.now()
+    documents = [_history_document(i, now) for i in range(entries)]
+
+    def before():
+        # The old path: stringify each _id, then jsonable_encoder + json.dumps in JSONResponse
+        history = [{**document, "_id": str(document["_id"])} for document in documents]
+        content = jsonable_encoder({"success": True, "history": history, "count": len(history), "next_before": None})
+        return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def after():
+        return FastJSONResponse({"success": True, "history": documents, "count": len(documents), "next_before": None}).body
+
+    timings = {}
+    for name, encode in (("jsonable_encoder + json", before), ("FastJSONResponse", after)):
+        start = time.perf_counter()
+        for _ in range(runs):
+            body = encode()
+        timings[name] = (time.perf_counter() - start) / runs
+        print(f"  {name:24s}: {timings[name] * 1000:7.2f} ms/page, {len(body):7d} bytes")
+    # Same document, so the two bodies must decode to the same JSON
+    same = json.loads(before()) == json.loads(after())
+    print(f"  orjson installed: {orjson is not None}, identical output: {same}")
+
+    body = after()
+    analysis = "\n\n".join(_document_analysis(i) for i in range(len(REPORT_TOPICS))).encode()
+    for label, payload in (("history page", body), ("document analysis", analysis)):
+        encodings = [("identity", lambda data: data), ("gzip", lambda data: zlib.compress(data, 6, wbits=16 + zlib.MAX_WBITS))]
+        if brotli is not None:
+            encodings.append(("br", lambda data: brotli.compress(data, quality=4)))
+        for name, compress in encodings:
+            start = time.perf_counter()
+            wire = compress(payload)
+            elapsed = (time.perf_counter() - start) * 1000
+            print(f"  {label:17s} {name:8s}: {len(wire):7d} bytes on the wire ({elapsed:6.2f} ms)")
+
+    ok = same and timings["FastJSONResponse"] < timings["jsonable_encoder + json"]
+    print(f"{'✅' if ok else '❌'} history pages encode faster, with identical JSON")
+    return ok
+
+
+class GeneratedHistoryCursor(FakeHistoryCursor):
+    """Cursor making one patient's documents, newest first, as each batch is fetched"""
+
+    async def __aiter__(self):
+        count = min(self._limit or self.collection.count, self.collection.count)
+        batch = self._batch_size or count or 1
+        for start in range(0, count, batch):
+            await asyncio.sleep(self.collection.latency)
+            for i in range(start, min(start + batch, count)):
+                yield {**_history_document(i, self.collection.now), "user_id": self.collection.user_id}
+
+
+class GeneratedHistoryCollection:
+    """
+    A history of count entries that exists only as it is read, so a memory measurement
+    sees the consumer's allocations and none of the stand-in's own per-entry state
+    """
+
+    def __init__(self, count, user_id, now, latency=0.005):
+        self.count = count
+        self.user_id = user_id
+        self.now = now
+        self.latency = latency
+
+    def find(self, query, projection=None):
+        return GeneratedHistoryCursor(self, query)
+
+
+def bench_history_export(sizes=(2_000, 20_000), batch_size=500, latency=0.005):
+    """Exporting a whole history streams in constant memory, and the first bytes leave before the query ends"""
+    print(f"\n📤 Full history export ({batch_size} documents per cursor batch, {latency * 1000:.0f}ms per round trip)")
+    now = datetime.now()
+    ok = True
+    peaks = []
+    for count in sizes:
+        # One patient with a long history
+        repo = HistoryRepository(GeneratedHistoryCollection(count, "patient-0", now, latency=latency))
+
+        async def streamed():
+            start = time.perf_counter()
+            first_chunk = None
+            lines = 0
+            async for chunk in ndjson_chunks(repo.iter_entries("patient-0", batch_size=batch_size)):
+                first_chunk = first_chunk or time.perf_counter() - start
+                lines += chunk.count(b"\n")
+            return first_chunk, time.perf_counter() - start, lines
+
+        async def materialized():
+            # The alternative: one page as large as the whole history
+            history, _ = await repo.find_page(user_id="patient-0", limit=count)
+            return len(FastJSONResponse({"history": history}).body)
+
+        results = {}
+        for name, run in (("streamed NDJSON", streamed), ("one JSON document", materialized)):
+            tracemalloc.start()
+            result = asyncio.run(run())
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[name] = (result, peak)
+        (first_chunk, total, lines), stream_peak = results["streamed NDJSON"]
+        _, document_peak = results["one JSON document"]
+        peaks.append(stream_peak)
+        ok = ok and lines == count and first_chunk < total / 4
+        print(f"  {count:6d} entries: first bytes after {first_chunk * 1000:6.1f}ms of {total * 1000:7.1f}ms, "
+              f"peak memory streamed {stream_peak / 1e6:5.1f}MB vs one document {document_peak / 1e6:6.1f}MB")
+    print(f"  peak growth: {(peaks[-1] - peaks[0]) / 1024:.1f}KB")
+    # Nothing is kept per entry on either side, so ten times the entries may only add allocator noise
+    flat = peaks[-1] - peaks[0] <= 64 * 1024
+    ok = ok and flat
+    print(f"{'✅' if ok else '❌'} export memory independent of history size")
+    return ok
+
+
+REPORT_TOPICS = [
+    ("blood panel", "hemoglobin", "Hemoglobin 11.2 g/dL, slightly below range; ferritin low, suggesting iron deficiency."),
+    ("lipid panel", "cholesterol", "LDL cholesterol 162 mg/dL, above target; HDL 41 mg/dL; triglycerides 190 mg/dL."),
+    ("thyroid panel", "thyroid", "TSH 6.8 mIU/L, elevated; free T4 at the low end of normal, consistent with subclinical hypothyroidism."),
+    ("chest x-ray", "opacity", "Small opacity in the right lower lobe; no effusion; heart size normal."),
+    ("glucose test", "hba1c", "Fasting glucose 118 mg/dL and HbA1c 6.1%, in the prediabetes range."),
+]
+
+
+def _document_analysis(i):
+    title, _, finding = REPORT_TOPICS[i % len(REPORT_TOPICS)]
+    return (
+        f"Report {i}: {title}.\n\n{finding}\n\n"
+        + "The remaining values were within their reference ranges and no urgent action was flagged. " * 8
+        + f"\n\nRecommendation: discuss the {title} with the treating physician at the next visit."
+    )
+
+
+def bench_retrieval(doc_counts=(1, 10, 50, 200), budget=100_000):
+    """Prompt size and retrieval time stay flat as a patient uploads more reports"""
+    print("\n🔎 Document retrieval vs. number of stored analyses")
+    question = "Is my thyroid TSH result something to worry about?"
+    ok = True
+    sizes = []
+    for count in doc_counts:
+        session = Session()
+        for i in range(count):
+            session.add_document(_document_analysis(i))
+        all_documents = sum(doc.tokens for doc in session.documents)
+
+        runs = 200
+        start = time.perf_counter()
+        for _ in range(runs):
+            prompt = build_chat_prompt(session, question, budget=budget)
+        per_prompt_ms = (time.perf_counter() - start) / runs * 1000
+
+        tokens = prompt.usage["total"]
+        sizes.append(tokens)
+        relevant = "TSH 6.8" in prompt.text if count > 2 else True
+        ok = ok and relevant
+        print(f"  {count:4d} docs: {per_prompt_ms:6.2f} ms/prompt, prompt {tokens:5d} tokens "
+              f"(all analyses would add {all_documents:6d}), relevant excerpt included: {relevant}")
+    flat = sizes[-1] <= 1.25 * sizes[0]
+    ok = ok and flat
+    print(f"{'✅' if ok else '❌'} prompt size independent of document count")
+    return ok
+
+
+BENCHMARKS = {
+    "llm": bench_llm_concurrency,
+    "admission": bench_admission,
+    "resilience": bench_resilience,
+    "singleflight": bench_singleflight,
+    "metrics": bench_metrics,
+    "ingest": bench_upload_ingestion,
+    "sessions": bench_session_store_workers,
+    "retrieval": bench_retrieval,
+    "documents": bench_document_analysis,
+    "video": bench_video_preprocessing,
+    "history": bench_history_store,
+    "history-bulk": bench_history_bulk,
+    "paging": bench_history_paging,
+    "serialization": bench_serialization,
+    "export": bench_history_export,
+}
+
+
+def main():
+    """Run all (or the selected) benchmarks"""
+    print("🧪 Medical AI Backend Load Tests")
+    print("=" * 40)
+
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    results = {name: BENCHMARKS[name]() for name in selected}
+
+    print(f"\n📊 Passed: {sum(1 for ok in results.values() if ok)}/{len(results)}")
+    if not all(results.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,41 @@
-from fastapi import FastAPI, HTTPException, File, UploadFile, Form
+from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, TypeAdapter, ValidationError
 import google.generativeai as genai
 import os
 from dotenv import load_dotenv
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, AsyncIterator
 import logging
-import tempfile
+import time
 import json
-from collections import defaultdict
-from datetime import datetime
-from pymongo import MongoClient
+from datetime import datetime, timezone
+from pymongo.errors import ConnectionFailure
 from bson import ObjectId
 from bson.errors import InvalidId
 import certifi
+import hashlib
+from contextlib import asynccontextmanager
+
+from cache import LRUCache
+from compression import CompressionMiddleware, CompressionStats
+from document_analysis import ANALYSIS_MODES, DOCUMENT_ANALYSIS_PROMPT, DocumentAnalysis, analyze_document as analyze_document_file, extract_key_facts
+from history_analysis import HistoryAnalysisTracker, conversation_key, merge_diagnoses, summarize_diagnoses, transcript_digest
+from history_repo import CommandTimer, HistoryRepository, InvalidPageToken
+from jobs import Job, JobManager, JobQueueFull, SQLiteJobStore
+from json_stream import JSONArrayStream
+from llm_client import LLMClient, LLMOverloaded
+from metrics import CONTENT_TYPE, TOKEN_BUCKETS, MetricsMiddleware, MetricsRegistry
+from prompt_builder import BuiltPrompt, build_chat_prompt as assemble_chat_prompt
+from rate_limit import RateLimited, RateLimiter
+from resilience import CallPolicy, CircuitBreaker, CircuitOpen, Resilience
+from response_cache import ResponseCache
+from serialization import FastJSONResponse, ndjson_chunks
+from sessions import InMemorySessionStore, Session, SessionStore, SQLiteSessionStore
+from singleflight import SingleFlight
+from text_extraction import DocumentTextExtractor
+from uploads import BodyLimitMiddleware, IngestedUpload, UploadTooLarge, ingest_upload
+from video_preprocess import VideoPreprocessor
 
 # Load environment variables
 load_dotenv()
@@ -22,8 +44,54 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Start background workers for video/document analysis jobs
+    await job_manager.start()
+    if history_repo is not None and await history_repo.ping():
+        await history_repo.ensure_indexes()
+    yield
+    await job_manager.stop()
+    if history_repo is not None:
+        await history_repo.close()
+    llm.shutdown()
+    text_extractor.shutdown()
+    session_store.close()
+
 # Initialize FastAPI app
-app = FastAPI(title="Medical AI Chat Backend", version="1.0.0")
+app = FastAPI(
+    title="Medical AI Chat Backend",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse,
+)
+
+# In-process metrics, served at /metrics in the Prometheus text format
+metrics = MetricsRegistry()
+stage_seconds = metrics.histogram(
+    "medical_ai_stage_seconds",
+    "Time spent in each stage of handling a request (prompt build, upload, generate, ...)",
+    ["stage"],
+)
+mongo_command_seconds = metrics.histogram("medical_ai_mongo_command_seconds", "MongoDB command round trips", ["command"])
+gemini_tokens = metrics.histogram(
+    "medical_ai_gemini_tokens",
+    "Prompt and response tokens per Gemini call, as reported by Gemini",
+    ["direction", "policy"],
+    buckets=TOKEN_BUCKETS,
+)
+request_seconds = metrics.histogram("medical_ai_http_request_seconds", "HTTP request latency by route", ["endpoint", "method"])
+endpoint_errors = metrics.counter(
+    "medical_ai_errors_total",
+    "Requests (and the analysis jobs they queued) that failed, by endpoint",
+    ["endpoint"],
+)
+
+def record_error(endpoint: str) -> None:
+    """
+    Count a failure that is reported in the response body (or a job result) rather than a 5xx
+    """
+    endpoint_errors.labels(endpoint=endpoint).inc()
 
 #connect to mongoDB
 
@@ -42,6 +110,33 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress responses (brotli or gzip, per Accept-Encoding) above a size threshold
+compression_stats = CompressionStats()
+app.add_middleware(
+    CompressionMiddleware,
+    min_size=int(os.getenv("COMPRESSION_MIN_SIZE", "1024")),
+    gzip_level=int(os.getenv("COMPRESSION_GZIP_LEVEL", "6")),
+    brotli_quality=int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4")),
+    stats=compression_stats,
+)
+
+# Largest accepted uploads. The whole request body may exceed the file by the
+# multipart framing and form fields; anything larger is cut off with a 413
+# while it is still being received
+VIDEO_MAX_SIZE = 50 * 1024 * 1024  # 50MB
+DOCUMENT_MAX_SIZE = 10 * 1024 * 1024  # 10MB
+MULTIPART_OVERHEAD = 64 * 1024
+app.add_middleware(
+    BodyLimitMiddleware,
+    limits={
+        "/api/video/analyze": VIDEO_MAX_SIZE + MULTIPART_OVERHEAD,
+        "/api/document/analyze": DOCUMENT_MAX_SIZE + MULTIPART_OVERHEAD,
+    },
+)
+
+# Added last, so it is the outermost middleware and its timings include compression
+app.add_middleware(MetricsMiddleware, duration=request_seconds, errors=endpoint_errors)
+
 # Configure Gemini API
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not GEMINI_API_KEY:
@@ -70,31 +165,241 @@ except Exception as e:
     logger.error(f"Failed to initialize Gemini model: {e}")
     raise
 
+# Deadlines (seconds, retries included) and retries for each kind of Gemini call;
+# chat calls still running at their p95 latency get a hedged duplicate
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "2"))
+CHAT_POLICY = CallPolicy(
+    "chat",
+    deadline=float(os.getenv("CHAT_DEADLINE", "30")),
+    retries=GEMINI_MAX_RETRIES,
+    hedge=os.getenv("CHAT_HEDGING", "true").lower() == "true",
+)
+CHAT_STREAM_POLICY = CallPolicy("chat_stream", deadline=float(os.getenv("CHAT_STREAM_DEADLINE", "60")), retries=GEMINI_MAX_RETRIES)
+HISTORY_ANALYSIS_POLICY = CallPolicy("history_analysis", deadline=float(os.getenv("HISTORY_ANALYSIS_DEADLINE", "60")), retries=GEMINI_MAX_RETRIES)
+# Video/document analysis jobs: uploads and generate calls
+ANALYSIS_POLICY = CallPolicy("analysis", deadline=float(os.getenv("ANALYSIS_DEADLINE", "120")), retries=GEMINI_MAX_RETRIES)
+FILE_STATUS_POLICY = CallPolicy("file_status", deadline=15.0, retries=GEMINI_MAX_RETRIES)
+TEST_POLICY = CallPolicy("test", deadline=10.0, retries=0)
+
+# Shared by every Gemini call: after GEMINI_BREAKER_THRESHOLD consecutive transient
+# failures, calls fail fast for GEMINI_BREAKER_RESET seconds instead of waiting on an outage
+resilience = Resilience(
+    CircuitBreaker(
+        failure_threshold=int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5")),
+        reset_timeout=float(os.getenv("GEMINI_BREAKER_RESET", "30")),
+    ),
+    base_delay=float(os.getenv("GEMINI_RETRY_BASE_DELAY", "0.5")),
+)
+
+# All Gemini calls go through this client so they never block the event loop.
+# Calls beyond the concurrency cap wait in a bounded queue; when it is full, or
+# a call has waited GEMINI_QUEUE_TIMEOUT seconds, the request gets a 429
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+llm = LLMClient(
+    model,
+    max_concurrency=GEMINI_MAX_CONCURRENCY,
+    max_queue=int(os.getenv("GEMINI_MAX_QUEUE", "32")),
+    queue_timeout=float(os.getenv("GEMINI_QUEUE_TIMEOUT", "10")) or None,
+    resilience=resilience,
+    default_policy=ANALYSIS_POLICY,
+    stage_seconds=stage_seconds,
+    token_counts=gemini_tokens,
+    api_key=GEMINI_API_KEY,
+)
+
+# Per-client token buckets for the endpoints that call Gemini (0 requests per minute disables)
+rate_limiter = RateLimiter(
+    rate=float(os.getenv("RATE_LIMIT_PER_MINUTE", "30")) / 60,
+    burst=int(os.getenv("RATE_LIMIT_BURST", "10")),
+)
+# Behind a reverse proxy every request comes from the proxy's address; trust X-Forwarded-For instead
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "false").lower() == "true"
+
+# Identical requests arriving while the first is still running (double submits,
+# frontend retries) wait for its Gemini call instead of making their own
+inflight = SingleFlight()
+
+# Content-addressed caches for uploads: remote Gemini file handles keyed by the
+# SHA-256 of the uploaded bytes, and finished analyses keyed by bytes + prompt.
+# Gemini deletes uploaded files after 48 hours.
+GEMINI_FILE_TTL = 47 * 3600
+GEMINI_FILE_EXPIRY_MARGIN = 3600
+file_cache = LRUCache(maxsize=int(os.getenv("FILE_CACHE_SIZE", "256")), ttl=GEMINI_FILE_TTL)
+analysis_cache = LRUCache(
+    maxsize=int(os.getenv("ANALYSIS_CACHE_SIZE", "512")),
+    ttl=float(os.getenv("ANALYSIS_CACHE_TTL", str(24 * 3600))),
+)
+
+# single: one structured call returns summary and key facts; background: the
+# summary is returned first and key facts follow in a separate job;
+# sequential: summary call then key-facts call
+DOCUMENT_ANALYSIS_MODE = os.getenv("DOCUMENT_ANALYSIS_MODE", "single")
+if DOCUMENT_ANALYSIS_MODE not in ANALYSIS_MODES:
+    raise ValueError(f"Unknown DOCUMENT_ANALYSIS_MODE: {DOCUMENT_ANALYSIS_MODE}")
+
+# Text-based PDFs and DOCX files are read locally and sent inline; scanned
+# documents still go through the Gemini file upload
+text_extractor = DocumentTextExtractor(
+    workers=int(os.getenv("TEXT_EXTRACTION_WORKERS", "0")) or None,
+    min_chars_per_page=int(os.getenv("TEXT_EXTRACTION_MIN_CHARS_PER_PAGE", "100")),
+    max_chars=int(os.getenv("TEXT_EXTRACTION_MAX_CHARS", "500000")),
+)
+# off: upload recordings as they are; downsample: upload a low-resolution,
+# low-frame-rate copy without near-duplicate frames; keyframes: send a few
+# distinct frames inline as images (both processing modes drop the audio)
+video_preprocessor = VideoPreprocessor(
+    mode=os.getenv("VIDEO_PREPROCESS_MODE", "off"),
+    max_height=int(os.getenv("VIDEO_MAX_HEIGHT", "360")),
+    target_fps=float(os.getenv("VIDEO_TARGET_FPS", "2")),
+    duplicate_threshold=float(os.getenv("VIDEO_DUPLICATE_THRESHOLD", "0.01")),
+    max_keyframes=int(os.getenv("VIDEO_MAX_KEYFRAMES", "16")),
+)
+
+DOCUMENT_SUFFIXES = {
+    'application/pdf': '.pdf',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': '.docx',
+}
+
+# Per-user conversation state (documents, key facts, recent turns). Use the
+# sqlite backend when running more than one uvicorn worker so every worker
+# sees the same history.
+CHAT_CONTEXT_TURNS = 10  # most recent turns considered for each chat prompt
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "6000"))
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "4"))  # document chunks retrieved per chat prompt
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+
+def create_session_store() -> SessionStore:
+    max_turns = int(os.getenv("SESSION_MAX_TURNS", "20"))
+    max_bytes_per_user = int(os.getenv("SESSION_MAX_BYTES_PER_USER", str(256 * 1024)))
+    idle_ttl = float(os.getenv("SESSION_IDLE_TTL", str(2 * 3600)))
+    if SESSION_BACKEND == "sqlite":
+        return SQLiteSessionStore(
+            os.getenv("SESSION_DB_PATH", "sessions.db"),
+            max_turns=max_turns,
+            max_bytes_per_user=max_bytes_per_user,
+            idle_ttl=idle_ttl,
+        )
+    if SESSION_BACKEND == "memory":
+        return InMemorySessionStore(
+            max_turns=max_turns,
+            max_bytes_per_user=max_bytes_per_user,
+            max_total_bytes=int(os.getenv("SESSION_MAX_TOTAL_BYTES", str(64 * 1024 * 1024))),
+            idle_ttl=idle_ttl,
+            spill_dir=os.getenv("SESSION_SPILL_DIR") or None,
+        )
+    raise ValueError(f"Unknown SESSION_BACKEND: {SESSION_BACKEND}")
+
+session_store = create_session_store()
+logger.info(f"Using {SESSION_BACKEND} session store")
+
+# Video and document analysis run as background jobs. With the shared SQLite
+# session store, job states go into the same database, so any worker process
+# can answer a status poll
+job_manager = JobManager(
+    workers=int(os.getenv("JOB_WORKERS", "4")),
+    max_queue=int(os.getenv("JOB_QUEUE_SIZE", "100")),
+    store=SQLiteJobStore(os.getenv("SESSION_DB_PATH", "sessions.db")) if SESSION_BACKEND == "sqlite" else None,
+)
+
+# Read from the store (and the Gemini client) at scrape time
+metrics.gauge("medical_ai_sessions", "Live chat sessions").set_function(lambda: session_store.stats()["live_sessions"])
+metrics.gauge("medical_ai_session_store_bytes", "Bytes retained by the session store").set_function(
+    lambda: session_store.stats()["retained_bytes"]
+)
+metrics.gauge("medical_ai_gemini_in_flight", "Gemini calls in flight").set_function(lambda: llm.in_flight)
+metrics.gauge("medical_ai_gemini_queue_depth", "Gemini calls waiting for a slot").set_function(lambda: llm.waiting)
+metrics.gauge("medical_ai_job_queue_depth", "Analysis jobs waiting for a worker").set_function(lambda: job_manager.queue_depth)
+
+# Answers to generic questions from users without document context.
+# RESPONSE_CACHE_SIMILARITY=0 restricts hits to exact (normalized) matches.
+response_cache = ResponseCache(
+    maxsize=int(os.getenv("RESPONSE_CACHE_SIZE", "512")),
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL", str(6 * 3600))),
+    similarity_threshold=float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.9")),
+)
+
+# Which messages of each conversation analyze-history has already sent to Gemini
+history_tracker = HistoryAnalysisTracker(
+    maxsize=int(os.getenv("HISTORY_ANALYSIS_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("HISTORY_ANALYSIS_TTL", str(2 * 3600))),
+)
+
 # MongoDB Configuration
 MONGODB_URL = os.getenv("MONGODB_URL")
 DATABASE_NAME = os.getenv("DATABASE_NAME")
 COLLECTION_NAME = os.getenv("COLLECTION_NAME")
 
-# Initialize MongoDB client
-try:
-    client = MongoClient(MONGODB_URL,tlsCAFile=certifi.where())
-    print("mongsadfafodb", client.admin.command('ping'))
-    database = client[DATABASE_NAME]
-    history_collection = database[COLLECTION_NAME]
-    database = client.get_database("sample_mflix")
-    movies = database.get_collection("movies")
-    # Query for a movie that has the title 'Back to the Future'
-    query = { "runtime": 14 }
-    movie = movies.find_one(query)
-    print(movie)
-    # client.close()
-    logger.info("MongoDB connection initialized successfully")
-except Exception as e:
-    logger.error(f"Failed to initialize MongoDB: {e}")
-    # Don't raise here, allow app to start without MongoDB for now
-    mongodb_client = None
-    database = None
-    history_collection = None
+# Async access to the history collection with a bounded pool and explicit
+# timeouts, so a slow Mongo node fails requests quickly instead of piling them up
+history_repo: Optional[HistoryRepository] = None
+if MONGODB_URL:
+    try:
+        history_repo = HistoryRepository.from_url(
+            MONGODB_URL,
+            DATABASE_NAME,
+            COLLECTION_NAME,
+            max_pool_size=int(os.getenv("MONGODB_MAX_POOL_SIZE", "50")),
+            min_pool_size=int(os.getenv("MONGODB_MIN_POOL_SIZE", "0")),
+            server_selection_timeout_ms=int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "3000")),
+            connect_timeout_ms=int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS", "5000")),
+            socket_timeout_ms=int(os.getenv("MONGODB_SOCKET_TIMEOUT_MS", "10000")),
+            wait_queue_timeout_ms=int(os.getenv("MONGODB_WAIT_QUEUE_TIMEOUT_MS", "2000")),
+            event_listeners=[CommandTimer(lambda command, seconds: mongo_command_seconds.labels(command=command).observe(seconds))],
+            tlsCAFile=certifi.where(),
+        )
+    except Exception as e:
+        logger.error(f"Failed to initialize MongoDB: {e}")
+        # Don't raise here, allow app to start without MongoDB for now
+        history_repo = None
+
+# Bulk history writes: documents per insert_many/delete_many call, and items per request
+HISTORY_BULK_BATCH_SIZE = int(os.getenv("HISTORY_BULK_BATCH_SIZE", "500"))
+HISTORY_BULK_MAX_ITEMS = int(os.getenv("HISTORY_BULK_MAX_ITEMS", "5000"))
+# Documents fetched per cursor round trip by the NDJSON history export
+HISTORY_EXPORT_BATCH_SIZE = int(os.getenv("HISTORY_EXPORT_BATCH_SIZE", "500"))
+
+def client_keys(http_request: Request, user_id: Optional[str] = None) -> List[str]:
+    """
+    Rate limit keys for a request: always the client IP, plus the user id when given
+
+    user_id comes from the client, so it only ever adds a budget on top of the IP's
+    """
+    forwarded = http_request.headers.get("x-forwarded-for") if RATE_LIMIT_TRUST_PROXY else None
+    if forwarded:
+        keys = [f"ip:{forwarded.split(',')[0].strip()}"]
+    else:
+        keys = [f"ip:{http_request.client.host if http_request.client else 'unknown'}"]
+    if user_id and user_id != "default":
+        keys.append(f"user:{user_id}")
+    return keys
+
+def admit(http_request: Request, user_id: Optional[str] = None) -> None:
+    """
+    Take a token from each of the client's buckets; raises RateLimited (answered with 429) when one is empty
+    """
+    keys = client_keys(http_request, user_id)
+    try:
+        rate_limiter.acquire(*keys)
+    except RateLimited:
+        logger.warning(f"Rate limited {', '.join(keys)}")
+        raise
+
+@app.exception_handler(RateLimited)
+@app.exception_handler(LLMOverloaded)
+async def too_many_requests(http_request: Request, exc: Exception) -> JSONResponse:
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": exc.retry_after_header},
+    )
+
+@app.exception_handler(CircuitOpen)
+async def gemini_unavailable(http_request: Request, exc: CircuitOpen) -> JSONResponse:
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": exc.retry_after_header},
+    )
 
 # Pydantic models for request/response
 class ChatRequest(BaseModel):
@@ -105,6 +410,8 @@ class ChatResponse(BaseModel):
     response: str
     success: bool
     error: Optional[str] = None
+    prompt_tokens: Optional[Dict[str, int]] = None  # estimated prompt tokens per section
+    cached: bool = False  # answered from the response cache
 
 class VideoAnalysisResponse(BaseModel):
     analysis: str
@@ -113,6 +420,11 @@ class VideoAnalysisResponse(BaseModel):
     video_duration: Optional[float] = None
     file_size: Optional[int] = None
 
+class JobSubmittedResponse(BaseModel):
+    job_id: str
+    status: str
+    status_url: str
+
 class ChatMessage(BaseModel):
     type: str  # "user" or "ai"
     content: str
@@ -137,6 +449,14 @@ class DiagnosisData(BaseModel):
 
 class AddHistoryRequest(BaseModel):
     diagnosis: DiagnosisData
+    user_id: Optional[str] = None
+
+class BulkAddHistoryRequest(BaseModel):
+    diagnoses: List[DiagnosisData]
+    user_id: Optional[str] = None
+
+class BulkDeleteHistoryRequest(BaseModel):
+    document_ids: List[str]
 
 class ChatHistoryResponse(BaseModel):
     diagnoses: List[DiagnosisData]
@@ -148,75 +468,53 @@ class ChatHistoryResponse(BaseModel):
 async def health_check():
     return {"status": "healthy", "message": "Medical AI Chat Backend is running"}
 
+def build_chat_prompt(session: Session, message: str) -> BuiltPrompt:
+    """
+    Build the Gemini prompt for a chat message from the user's stored context, within the token budget
+    """
+    with stage_seconds.labels(stage="prompt_build").time():
+        prompt = assemble_chat_prompt(
+            session,
+            message,
+            budget=PROMPT_TOKEN_BUDGET,
+            max_turns=CHAT_CONTEXT_TURNS,
+            top_k_chunks=RETRIEVAL_TOP_K,
+        )
+    logger.info(f"Prompt tokens by section: {prompt.usage} (budget {prompt.budget}, {prompt.dropped} items left out)")
+    return prompt
+
 # Chat endpoint
 @app.post("/api/chat", response_model=ChatResponse)
-async def chat_with_ai(request: ChatRequest):
-    try:
-        logger.info(f"Received chat request: {request.message[:50]}...")
-        
-        if not request.message.strip():
-            raise HTTPException(status_code=400, detail="Message cannot be empty")
-        
-        # Extract all document analyses
-        document_analyses = [
-            msg.content for msg in chat_histories[request.user_id]
-            if msg.content.startswith("[Document Analysis]")
-        ]
-
-        document_context = ""
-        if document_analyses:
-            document_context = (
-                "==== Document Analyses ====\n"
-                + "\n".join(document_analyses)
-                + "\n==== End of Document Analyses ====\n\n"
-            )
-
-        # Build conversation history
-        history_context = ""
-        for msg in chat_histories[request.user_id][-10:]:
-            role = "Patient" if msg.type == "user" else "AI Doctor"
-            history_context += f"{role}: {msg.content}\n"
-
-        # Extract key facts from chat history
-        key_facts = [
-            msg.content for msg in chat_histories[request.user_id]
-            if msg.content.startswith("[Key Fact]")
-        ]
-
-        key_facts_context = ""
-        if key_facts:
-            key_facts_context = (
-                "Important facts from previous documents:\n"
-                + "\n".join(key_facts)
-                + "\n\n"
-            )
-
-        medical_prompt = f"""
-        {document_context}
-        {key_facts_context}
-        Conversation so far:
-        {history_context}
+async def chat_with_ai(request: ChatRequest, http_request: Request):
+    logger.info(f"Received chat request: {request.message[:50]}...")
 
-        Patient Question: {request.message}
-
-        Instructions:
-        - Use any document analyses above to inform your answer.
-        - Also use the conversation so far.
-        - Be clear if you are referencing information from a document.
-        - If you need more information, ask the user for clarification.
-
-        Please provide a helpful medical response following these guidelines:
-        1. Be informative but emphasize the importance of professional medical consultation
-        2. If the question involves serious symptoms, recommend seeking immediate medical attention
-        3. Provide general health information when appropriate
-        4. Be empathetic and supportive
+    # Validated before admission, as in the streaming endpoint, so invalid requests don't use up tokens
+    if not request.message.strip():
+        raise HTTPException(status_code=400, detail="Message cannot be empty")
+    admit(http_request, request.user_id)
+    try:
+        session = await session_store.get(request.user_id)
         
-        Respond in a caring, professional manner as a medical AI assistant.
-        """
+        # Only questions asked with no context (no earlier turns, no documents) get the same
+        # answer for everyone; an answer written from one user's conversation must not reach another
+        use_response_cache = not session.has_context
+        if use_response_cache:
+            cached_answer = response_cache.get(request.message)
+            if cached_answer is not None:
+                logger.info("Chat response served from cache")
+                await session_store.add_exchange(request.user_id, request.message, cached_answer)
+                return ChatResponse(
+                    response=cached_answer,
+                    success=True,
+                    cached=True
+                )
+        
+        prompt = build_chat_prompt(session, request.message)
         
         # Generate response using Gemini
         logger.info("Sending request to Gemini API...")
-        response = model.generate_content(medical_prompt)
+        start = time.perf_counter()
+        response = await llm.generate(prompt.text, policy=CHAT_POLICY)
         
         if not response.text:
             logger.error("Empty response from Gemini API")
@@ -224,95 +522,223 @@ async def chat_with_ai(request: ChatRequest):
         
         logger.info("Successfully generated response from Gemini")
         
-        # When user sends a message:
-        now = datetime.utcnow().isoformat()
-        chat_histories[request.user_id].append(ChatMessage(
-            type="user",
-            content=request.message,
-            timestamp=now,
-        ))
-        # When Gemini responds:
-        chat_histories[request.user_id].append(ChatMessage(
-            type="ai",
-            content=response.text,
-            timestamp=now,
-        ))
+        await session_store.add_exchange(request.user_id, request.message, response.text)
+        if use_response_cache:
+            response_cache.set(request.message, response.text, time.perf_counter() - start)
         
         return ChatResponse(
             response=response.text,
-            success=True
+            success=True,
+            prompt_tokens=prompt.usage
         )
         
-    except HTTPException:
+    except (HTTPException, LLMOverloaded, CircuitOpen):
         raise
     except Exception as e:
         logger.error(f"Error in chat endpoint: {str(e)}")
+        record_error("/api/chat")
         return ChatResponse(
             response="I'm sorry, I'm experiencing technical difficulties. Please try again later.",
             success=False,
             error=str(e)
         )
 
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    """
+    Format a single Server-Sent Events message
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def chunk_text(chunk: Any) -> str:
+    """
+    Text of a streamed Gemini chunk, or "" for chunks without text parts (e.g. safety metadata)
+    """
+    try:
+        return chunk.text or ""
+    except ValueError:
+        return ""
+
+# Streaming chat endpoint (Server-Sent Events)
+@app.post("/api/chat/stream")
+async def chat_with_ai_stream(request: ChatRequest, http_request: Request):
+    """
+    Stream the AI response as Server-Sent Events while Gemini generates it.
+
+    Emits "chunk" events with partial text, then a single "done" event with
+    time-to-first-token and total latency, or an "error" event on failure.
+    """
+    logger.info(f"Received streaming chat request: {request.message[:50]}...")
+
+    if not request.message.strip():
+        raise HTTPException(status_code=400, detail="Message cannot be empty")
+    admit(http_request, request.user_id)
+
+    session = await session_store.get(request.user_id)
+
+    # Only questions asked with no context (no earlier turns, no documents) get the same
+    # answer for everyone; an answer written from one user's conversation must not reach another
+    use_response_cache = not session.has_context
+    cached_answer = response_cache.get(request.message) if use_response_cache else None
+    prompt = build_chat_prompt(session, request.message) if cached_answer is None else None
+    if cached_answer is None:
+        # Answer 429 now rather than as an error event once the stream has started
+        llm.check_capacity()
+
+    async def event_stream():
+        start = time.perf_counter()
+        ttft = None
+        parts = []
+        try:
+            if cached_answer is not None:
+                logger.info("Chat response served from cache")
+                await session_store.add_exchange(request.user_id, request.message, cached_answer)
+                yield sse_event("chunk", {"text": cached_answer})
+                elapsed = round((time.perf_counter() - start) * 1000, 1)
+                yield sse_event("done", {
+                    "response": cached_answer,
+                    "success": True,
+                    "cached": True,
+                    "ttft_ms": elapsed,
+                    "total_ms": elapsed,
+                })
+                return
+
+            logger.info("Streaming request to Gemini API...")
+            async for chunk in llm.generate_stream(prompt.text, policy=CHAT_STREAM_POLICY):
+                text = chunk_text(chunk)
+                if not text:
+                    continue
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                    stage_seconds.labels(stage="first_token").observe(ttft)
+                parts.append(text)
+                yield sse_event("chunk", {"text": text})
+
+            answer = "".join(parts)
+            if not answer:
+                raise ValueError("Empty response from Gemini API")
+
+            # Only store the exchange once the full answer is known
+            await session_store.add_exchange(request.user_id, request.message, answer)
+
+            total = time.perf_counter() - start
+            if use_response_cache:
+                response_cache.set(request.message, answer, total)
+            logger.info(f"Streamed chat response: ttft={ttft * 1000:.0f}ms total={total * 1000:.0f}ms")
+            yield sse_event("done", {
+                "response": answer,
+                "success": True,
+                "ttft_ms": round(ttft * 1000, 1),
+                "total_ms": round(total * 1000, 1),
+                "prompt_tokens": prompt.usage,
+            })
+        except (LLMOverloaded, CircuitOpen) as e:
+            logger.warning(f"Streaming chat rejected: {e}")
+            yield sse_event("error", {
+                "response": "The assistant is busy right now. Please try again in a moment.",
+                "success": False,
+                "error": str(e),
+                "retry_after": e.retry_after_header,
+            })
+        except Exception as e:
+            logger.error(f"Error in streaming chat endpoint: {str(e)}")
+            record_error("/api/chat/stream")
+            yield sse_event("error", {
+                "response": "I'm sorry, I'm experiencing technical difficulties. Please try again later.",
+                "success": False,
+                "error": str(e),
+            })
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # Test endpoint for Gemini connection
 @app.get("/api/test-gemini")
-async def test_gemini():
+async def test_gemini(http_request: Request):
+    # Makes a real Gemini call, so it is charged to the client IP like the chat endpoints
+    admit(http_request)
     try:
-        response = model.generate_content("Say 'Hello, I am your medical AI assistant!'")
+        response = await inflight.do(
+            "test_gemini",
+            "hello",
+            lambda: llm.generate("Say 'Hello, I am your medical AI assistant!'", policy=TEST_POLICY),
+        )
         return {
             "success": True,
             "response": response.text,
             "message": "Gemini API connection successful"
         }
+    except (LLMOverloaded, CircuitOpen):
+        raise
     except Exception as e:
         logger.error(f"Gemini API test failed: {e}")
+        record_error("/api/test-gemini")
         return {
             "success": False,
             "error": str(e),
             "message": "Gemini API connection failed"
         }
 
-# Video analysis endpoint
-@app.post("/api/video/analyze", response_model=VideoAnalysisResponse)
-async def analyze_video(
-    video: UploadFile = File(..., description="Video file to analyze"),
-    prompt: str = Form(default="Analyze this video for health-related information, symptoms, or medical concerns. Provide a detailed analysis.")
-):
+def file_cache_ttl(remote_file: Any) -> float:
     """
-    Analyze uploaded video using Gemini API for health-related insights
+    Seconds a remote Gemini file handle can be reused, leaving a safety margin before it expires
+    """
+    expiration_time = getattr(remote_file, "expiration_time", None)
+    if expiration_time is None:
+        return GEMINI_FILE_TTL
+    remaining = (expiration_time - datetime.now(timezone.utc)).total_seconds()
+    return max(remaining - GEMINI_FILE_EXPIRY_MARGIN, 0)
+
+async def get_gemini_file(temp_file_path: str, content_hash: str, kind: str) -> Any:
+    """
+    Upload a file to Gemini and wait until it is processed, reusing the remote handle for identical bytes
+    """
+    cached_file = file_cache.get(content_hash)
+    if cached_file is not None:
+        logger.info(f"Reusing uploaded {kind} {cached_file.name} (content cache hit)")
+        return cached_file
+
+    # Upload file to Gemini
+    logger.info(f"Uploading {kind} to Gemini API...")
+    remote_file = await llm.upload_file(temp_file_path)
+    
+    # Wait for processing to complete
+    logger.info(f"Waiting for {kind} processing...")
+    remote_file = await llm.wait_for_file(remote_file, policy=FILE_STATUS_POLICY)
+    
+    if remote_file.state.name == "FAILED":
+        raise ValueError(f"{kind.capitalize()} processing failed")
+
+    file_cache.set(content_hash, remote_file, ttl=file_cache_ttl(remote_file))
+    return remote_file
+
+def analysis_cache_key(content_hash: str, prompt: str) -> str:
+    """
+    Cache key for an analysis: the uploaded bytes plus the exact prompt used
+    """
+    return f"{content_hash}:{hashlib.sha256(prompt.encode()).hexdigest()}"
+
+async def run_video_analysis(temp_file_path: str, prompt: str, file_size: int, content_hash: str) -> Dict[str, Any]:
     """
+    Background job: upload a saved video to Gemini and analyze it for health-related insights
+    """
+    prepared = None
     try:
-        logger.info(f"Received video analysis request. File: {video.filename}, Size: {video.size}")
-        
-        # Validate file type
-        if not video.content_type.startswith('video/'):
-            raise HTTPException(status_code=400, detail="File must be a video")
-        
-        # Check file size (limit to 50MB)
-        max_size = 50 * 1024 * 1024  # 50MB in bytes
-        if video.size and video.size > max_size:
-            raise HTTPException(status_code=400, detail="Video file too large (max 50MB)")
-        
-        # Create temporary file to store the video
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.webm') as temp_file:
-            # Read video content and write to temp file
-            video_content = await video.read()
-            temp_file.write(video_content)
-            temp_file_path = temp_file.name
-        
         try:
-            # Upload video file to Gemini
-            logger.info("Uploading video to Gemini API...")
-            video_file = genai.upload_file(temp_file_path)
-            
-            # Wait for processing to complete
-            logger.info("Waiting for video processing...")
-            import time
-            while video_file.state.name == "PROCESSING":
-                time.sleep(2)
-                video_file = genai.get_file(video_file.name)
-            
-            if video_file.state.name == "FAILED":
-                raise HTTPException(status_code=500, detail="Video processing failed")
+            prepared = await video_preprocessor.prepare(temp_file_path)
+            # The remote file depends on the pre-processing, not just the recorded bytes
+            file_key = content_hash if prepared is None else f"{content_hash}:{video_preprocessor.mode}"
+            if prepared is not None and prepared.keyframes:
+                video_contents = [
+                    f"The following are {len(prepared.keyframes)} keyframes from the patient's video, in order:",
+                    *prepared.contents(),
+                ]
+            else:
+                video_path = temp_file_path if prepared is None else prepared.path
+                video_contents = [await get_gemini_file(video_path, file_key, "video")]
             
             # Create the medical analysis prompt
             medical_prompt = f"""
@@ -337,51 +763,189 @@ async def analyze_video(
             
             # Generate analysis using Gemini
             logger.info("Generating analysis with Gemini...")
-            response = model.generate_content([
-                video_file,
-                medical_prompt
-            ])
+            try:
+                response = await llm.generate([
+                    *video_contents,
+                    medical_prompt
+                ])
+            except Exception:
+                # The remote handle may have expired or been deleted; don't hand it out again
+                file_cache.pop(file_key)
+                raise
             
             if not response.text:
-                raise HTTPException(status_code=500, detail="Failed to generate video analysis")
+                raise ValueError("Failed to generate video analysis")
 
             logger.info("Video analysis completed successfully")
+            analysis_cache.set(analysis_cache_key(content_hash, prompt), response.text)
             
             return VideoAnalysisResponse(
                 analysis=response.text,
                 success=True,
-                file_size=len(video_content)
-            )
+                file_size=file_size
+            ).model_dump()
             
         finally:
-            # Clean up temporary file
+            # Clean up temporary files
+            if prepared is not None:
+                prepared.discard()
             try:
                 os.unlink(temp_file_path)
                 logger.info("Temporary file cleaned up")
             except Exception as cleanup_error:
                 logger.warning(f"Failed to clean up temp file: {cleanup_error}")
         
-    except HTTPException:
-        raise
     except Exception as e:
         logger.error(f"Error in video analysis: {str(e)}")
+        record_error("/api/video/analyze")
         return VideoAnalysisResponse(
             analysis=f"I'm sorry, I encountered an error while analyzing your video: {str(e)}",
             success=False,
             error=str(e)
-        )
+        ).model_dump()
+
+def job_accepted(job: Job) -> JSONResponse:
+    """
+    202 Accepted response telling the client where to poll for a job's result
+    """
+    status_url = f"/api/jobs/{job.id}"
+    return JSONResponse(
+        status_code=202,
+        content=JobSubmittedResponse(job_id=job.id, status=job.status, status_url=status_url).model_dump(),
+        headers={"Location": status_url},
+    )
+
+def in_background(fn):
+    """
+    Job function whose Gemini calls wait for a slot instead of being rejected (the job queue bounds them)
+    """
+    async def run():
+        with llm.background():
+            return await fn()
+    return run
+
+def submit_job(kind: str, fn, upload: IngestedUpload) -> JSONResponse:
+    """
+    Queue a background job working on upload and answer 202 Accepted
+
+    The job removes the upload's temp file when it finishes; if it never
+    runs (queue full, shutdown) the file is discarded instead.
+    """
+    try:
+        job = job_manager.submit(kind, in_background(fn), on_drop=upload.discard)
+    except JobQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return job_accepted(job)
+
+# Video analysis endpoint
+@app.post("/api/video/analyze", status_code=202, response_model=JobSubmittedResponse)
+async def analyze_video(
+    http_request: Request,
+    video: UploadFile = File(..., description="Video file to analyze"),
+    prompt: str = Form(default="Analyze this video for health-related information, symptoms, or medical concerns. Provide a detailed analysis.")
+):
+    """
+    Submit an uploaded video for health-related analysis.
+
+    Returns 202 with a job id right away; the VideoAnalysisResponse is
+    available from GET /api/jobs/{job_id} once the job completes.
+    """
+    logger.info(f"Received video analysis request. File: {video.filename}, Size: {video.size}")
+    admit(http_request)
+    
+    # Validate file type
+    if not video.content_type.startswith('video/'):
+        raise HTTPException(status_code=400, detail="File must be a video")
+    
+    # Check file size (limit to 50MB); the declared size is only a fast path,
+    # the limit is enforced on the bytes actually received
+    max_size = VIDEO_MAX_SIZE
+    if video.size and video.size > max_size:
+        raise HTTPException(status_code=413, detail="Video file too large (max 50MB)")
+    
+    # Stream the video to a temporary file; the job removes it when done
+    try:
+        with stage_seconds.labels(stage="temp_file_write").time():
+            upload = await ingest_upload(video, max_size, suffix='.webm')
+    except UploadTooLarge:
+        raise HTTPException(status_code=413, detail="Video file too large (max 50MB)")
+    
+    if upload.mime_type and not upload.mime_type.startswith('video/'):
+        upload.discard()
+        raise HTTPException(status_code=400, detail="File must be a video")
+    
+    # Same clip with the same prompt: answer from the cache without touching Gemini
+    cached_analysis = analysis_cache.get(analysis_cache_key(upload.sha256, prompt))
+    if cached_analysis is not None:
+        logger.info("Video analysis served from cache")
+        upload.discard()
+        return job_accepted(job_manager.record("video", VideoAnalysisResponse(
+            analysis=cached_analysis,
+            success=True,
+            file_size=upload.size
+        ).model_dump()))
+    
+    return submit_job("video", lambda: run_video_analysis(upload.path, prompt, upload.size, upload.sha256), upload)
+
+# Job status endpoint
+@app.get("/api/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    """
+    Status of a background analysis job, with its result once completed
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+# Cache and job statistics endpoint
+@app.get("/api/stats")
+async def get_stats():
+    """
+    Counters for the in-process caches, session store and background job queue
+    """
+    return {
+        "sessions": session_store.stats(),
+        "response_cache": response_cache.stats(),
+        "history_analysis": history_tracker.stats(),
+        "file_cache": file_cache.stats(),
+        "analysis_cache": analysis_cache.stats(),
+        "text_extraction": text_extractor.stats(),
+        "video_preprocessing": video_preprocessor.stats(),
+        "mongodb_pool": history_repo.stats() if history_repo is not None else None,
+        "compression": compression_stats.stats(),
+        "gemini": llm.stats(),
+        "gemini_resilience": resilience.stats(),
+        "rate_limit": rate_limiter.stats(),
+        "singleflight": inflight.stats(),
+        "jobs": {
+            "queue_depth": job_manager.queue_depth,
+            "tracked": len(job_manager.jobs),
+        },
+    }
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Stage latencies, token counts, session store size and errors, in the Prometheus text format
+    """
+    return Response(content=metrics.render(), media_type=CONTENT_TYPE)
 
 class DeleteDocumentRequest(BaseModel):
     document_id: str
 
+def get_history_repo() -> HistoryRepository:
+    if history_repo is None:
+        raise HTTPException(status_code=503, detail="Database connection not available")
+    return history_repo
+
 @app.delete("/api/history/{document_id}")
-def delete_history_entry(document_id: str):
+async def delete_history_entry(document_id: str):
     """
     Delete a medical history entry from MongoDB
     """
     try:
-        if history_collection is None:
-            raise HTTPException(status_code=503, detail="Database connection not available")
+        repo = get_history_repo()
         
         # Validate ObjectId format
         try:
@@ -390,9 +954,7 @@ def delete_history_entry(document_id: str):
             raise HTTPException(status_code=400, detail="Invalid document ID format")
         
         # Delete the document
-        result = history_collection.delete_one({"_id": object_id})
-        
-        if result.deleted_count == 1:
+        if await repo.delete(object_id):
             logger.info(f"Successfully deleted document: {document_id}")
             return {
                 "success": True,
@@ -404,113 +966,205 @@ def delete_history_entry(document_id: str):
             
     except HTTPException:
         raise
+    except ConnectionFailure as e:
+        logger.error(f"MongoDB unavailable while deleting document: {str(e)}")
+        raise HTTPException(status_code=503, detail="Database connection not available")
     except Exception as e:
         logger.error(f"Error deleting document: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
 # Add diagnosis to history endpoint
 @app.post("/api/history/add")
-def add_to_history(request: AddHistoryRequest):
+async def add_to_history(request: AddHistoryRequest):
     """
     Add a diagnosis to the medical history in MongoDB
     """
-    diagnosis = request.diagnosis
-    print("flippodpapsiidai", diagnosis)
-
     try:
-        if history_collection is None:
-            raise HTTPException(status_code=503, detail="Database connection not available")
+        repo = get_history_repo()
         
-        # Convert diagnosis to dict and add metadata
-        diagnosis_dict = diagnosis.model_dump()
-        diagnosis_dict["created_at"] = datetime.now()
-        diagnosis_dict["updated_at"] = datetime.now()
-        print("diagnosis_dict", diagnosis_dict)
+        # Insert into MongoDB (created_at/updated_at are added by the repository)
+        diagnosis_dict = request.diagnosis.model_dump()
+        if request.user_id:
+            diagnosis_dict["user_id"] = request.user_id
+        inserted_id = await repo.insert(diagnosis_dict)
         
-        # Insert into MongoDB
-        result = history_collection.insert_one(diagnosis_dict)
-        
-        if result.inserted_id:
-            logger.info(f"Successfully added diagnosis to history: {result.inserted_id}")
-            return {
-                "success": True,
-                "message": "Diagnosis added to medical history successfully",
-                "id": str(result.inserted_id)
-            }
-        else:
-            raise HTTPException(status_code=500, detail="Failed to save diagnosis to database")
+        logger.info(f"Successfully added diagnosis to history: {inserted_id}")
+        return {
+            "success": True,
+            "message": "Diagnosis added to medical history successfully",
+            "id": inserted_id
+        }
             
     except HTTPException:
         raise
+    except ConnectionFailure as e:
+        logger.error(f"MongoDB unavailable while adding diagnosis: {str(e)}")
+        raise HTTPException(status_code=503, detail="Database connection not available")
     except Exception as e:
         logger.error(f"Error adding diagnosis to history: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
-# Get medical history endpoint
-@app.get("/api/history")
-def get_medical_history(user_id: Optional[str] = None, limit: int = 50):
+# Bulk add diagnoses to history endpoint
+@app.post("/api/history/bulk-add")
+async def bulk_add_to_history(request: BulkAddHistoryRequest):
     """
-    Get medical history from MongoDB
+    Add several diagnoses to the medical history in one request, with a result per diagnosis
     """
+    if len(request.diagnoses) > HISTORY_BULK_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {HISTORY_BULK_MAX_ITEMS} diagnoses per request")
     try:
-        if history_collection is None:
-            raise HTTPException(status_code=503, detail="Database connection not available")
+        repo = get_history_repo()
         
-        # Build query
-        query = {}
-        if user_id:
-            query["user_id"] = user_id
+        documents = []
+        for diagnosis in request.diagnoses:
+            diagnosis_dict = diagnosis.model_dump()
+            if request.user_id:
+                diagnosis_dict["user_id"] = request.user_id
+            documents.append(diagnosis_dict)
         
-        # Get documents sorted by creation date (newest first)
-        cursor = history_collection.find(query).sort("created_at", -1).limit(limit)
+        results = await repo.insert_many(documents, HISTORY_BULK_BATCH_SIZE)
+        inserted = sum(1 for result in results if result["success"])
+        logger.info(f"Bulk added {inserted} of {len(results)} diagnoses to history")
+        return {
+            "success": inserted == len(results),
+            "inserted": inserted,
+            "results": results
+        }
         
-        # Convert to list
-        history_list = []
-        for document in cursor:
-            # Convert ObjectId to string
-            document["_id"] = str(document["_id"])
-            history_list.append(document)
+    except HTTPException:
+        raise
+    except ConnectionFailure as e:
+        logger.error(f"MongoDB unavailable while bulk adding diagnoses: {str(e)}")
+        raise HTTPException(status_code=503, detail="Database connection not available")
+    except Exception as e:
+        logger.error(f"Error bulk adding diagnoses to history: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+# Bulk delete history entries endpoint
+@app.post("/api/history/bulk-delete")
+async def bulk_delete_history_entries(request: BulkDeleteHistoryRequest):
+    """
+    Delete several medical history entries in one request, with a result per id
+    """
+    if len(request.document_ids) > HISTORY_BULK_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {HISTORY_BULK_MAX_ITEMS} ids per request")
+    try:
+        repo = get_history_repo()
         
+        results = await repo.delete_many(request.document_ids, HISTORY_BULK_BATCH_SIZE)
+        deleted = sum(1 for result in results if result["success"])
+        logger.info(f"Bulk deleted {deleted} of {len(results)} history entries")
         return {
+            "success": deleted == len(results),
+            "deleted": deleted,
+            "results": results
+        }
+        
+    except HTTPException:
+        raise
+    except ConnectionFailure as e:
+        logger.error(f"MongoDB unavailable while bulk deleting history: {str(e)}")
+        raise HTTPException(status_code=503, detail="Database connection not available")
+    except Exception as e:
+        logger.error(f"Error bulk deleting history entries: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+# Get medical history endpoint
+@app.get("/api/history")
+async def get_medical_history(
+    user_id: Optional[str] = None,
+    limit: int = Query(default=50, ge=1, le=500),
+    before: Optional[str] = None,
+    view: str = Query(default="full", pattern="^(full|summary)$"),
+):
+    """
+    Get medical history from MongoDB, newest first.
+
+    Pass the returned next_before as before to get the next page; view=summary
+    leaves out the recommendation and vision/voice analysis fields.
+    """
+    try:
+        repo = get_history_repo()
+        
+        # Documents sorted by creation date (newest first)
+        history_list, next_before = await repo.find_page(user_id, limit, before, summary=view == "summary")
+        
+        # Raw Mongo documents: returned as a response so they skip jsonable_encoder
+        return FastJSONResponse({
             "success": True,
             "history": history_list,
-            "count": len(history_list)
-        }
+            "count": len(history_list),
+            "next_before": next_before
+        })
         
     except HTTPException:
         raise
+    except InvalidPageToken as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ConnectionFailure as e:
+        logger.error(f"MongoDB unavailable while retrieving history: {str(e)}")
+        raise HTTPException(status_code=503, detail="Database connection not available")
     except Exception as e:
         logger.error(f"Error retrieving medical history: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
-# Chat history analysis endpoint
-@app.post("/api/chat/analyze-history", response_model=ChatHistoryResponse)
-async def analyze_chat_history(request: ChatHistoryRequest):
+# Export medical history endpoint
+@app.get("/api/history/export")
+async def export_medical_history(
+    user_id: str = Query(..., min_length=1),
+    view: str = Query(default="full", pattern="^(full|summary)$"),
+):
     """
-    Analyze chat history to extract medical diagnoses and create structured medical records
+    Stream every medical history entry of one user as newline-delimited JSON, newest first.
+
+    Entries are read from a server-side cursor and written as they arrive, so
+    memory use doesn't grow with the size of the history.
     """
     try:
-        print("asdsadasdads", request.messages)
-        logger.info(f"Received chat history analysis request with {len(request.messages)} messages")
+        repo = get_history_repo()
         
-        if len(request.messages) < 2:
-            raise HTTPException(status_code=400, detail="Not enough chat history to analyze")
-        
-        # Format chat history for analysis
-        chat_text = ""
-        for msg in request.messages:
-            role = "Patient" if msg.type == "user" else "AI Doctor"
-            if msg.isVideo:
-                chat_text += f"{role}: [Video message] {msg.content}\n"
-            elif msg.isVideoAnalysis:
-                chat_text += f"{role}: [Video Analysis] {msg.content}\n"
-            else:
-                chat_text += f"{role}: {msg.content}\n"
+        entries = repo.iter_entries(user_id, HISTORY_EXPORT_BATCH_SIZE, summary=view == "summary")
+        # Fetch the first batch before answering, so an unreachable database is still a 503
+        first = await anext(entries, None)
         
-        # Create analysis prompt
-        analysis_prompt = f"""
+    except HTTPException:
+        raise
+    except ConnectionFailure as e:
+        logger.error(f"MongoDB unavailable while exporting history: {str(e)}")
+        raise HTTPException(status_code=503, detail="Database connection not available")
+    except Exception as e:
+        logger.error(f"Error exporting medical history: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+    async def export_entries():
+        if first is None:
+            return
+        exported = 1
+        try:
+            yield first
+            async for document in entries:
+                exported += 1
+                yield document
+        except Exception as e:
+            # Headers are already sent; aborting the stream tells the client the export is incomplete
+            logger.error(f"History export failed after {exported} entries: {str(e)}")
+            raise
+        finally:
+            await entries.aclose()
+        logger.info(f"Exported {exported} history entries")
+
+    return StreamingResponse(
+        ndjson_chunks(export_entries()),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="medical-history.ndjson"'},
+    )
+
+# Chat history analysis endpoint
+# Prompt for extracting diagnoses from a chat transcript
+HISTORY_ANALYSIS_PROMPT = """
         Analyze the following medical chat conversation and extract structured diagnosis information. 
         
+        {prior_context}
         Chat History:
         {chat_text}
         
@@ -545,176 +1199,260 @@ async def analyze_chat_history(request: ChatHistoryRequest):
         - For visionData and voiceAnalysis, use realistic medical values or "Normal" if not specifically discussed
         - Estimate documents and tasksGenerated based on conversation complexity
         - If no clear diagnoses, return empty array []
-        
-        Return ONLY the JSON array, no other text or formatting.
         """
-        print("asdsadasdads", analysis_prompt)
-        
-        # Generate analysis using Gemini
-        logger.info("Sending chat history to Gemini for analysis...")
-        response = model.generate_content(analysis_prompt)
+
+# Added to the prompt when earlier messages of the conversation were already analyzed
+HISTORY_ANALYSIS_DELTA_CONTEXT = """
+        Diagnoses already identified earlier in this conversation:
+        {summary}
+
+        Earlier messages (already analyzed, for context only):
+        {context}
+
+        The chat history below contains only the NEW messages since the last analysis. Return objects
+        only for diagnoses that are new or whose details changed in these messages, using the same
+        diagnosis name to update an earlier diagnosis.
+"""
+
+def format_chat_transcript(messages: List[ChatMessage]) -> str:
+    chat_text = ""
+    for msg in messages:
+        role = "Patient" if msg.type == "user" else "AI Doctor"
+        if msg.isVideo:
+            chat_text += f"{role}: [Video message] {msg.content}\n"
+        elif msg.isVideoAnalysis:
+            chat_text += f"{role}: [Video Analysis] {msg.content}\n"
+        else:
+            chat_text += f"{role}: {msg.content}\n"
+    return chat_text
+
+def _text_schema(*names: str) -> Dict[str, Any]:
+    return {"type": "object", "properties": {name: {"type": "string"} for name in names}}
+
+# Response schema Gemini's JSON output is constrained to (a list of DiagnosisData)
+DIAGNOSIS_LIST_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "diagnosis": {"type": "string"},
+            "date": {"type": "string"},
+            "duration": {"type": "string"},
+            "symptoms": {"type": "array", "items": {"type": "string"}},
+            "confidence": {"type": "number"},
+            "followUpNeeded": {"type": "boolean"},
+            "aiRecommendations": {"type": "array", "items": {"type": "string"}},
+            "visionData": {
+                "type": "object",
+                "properties": {
+                    "blinkRate": {"type": "number"},
+                    "eyeMovement": {"type": "string"},
+                    "facialExpression": {"type": "string"},
+                },
+            },
+            "voiceAnalysis": _text_schema("tone", "pace", "clarity"),
+        },
+        "required": list(DiagnosisData.model_fields),
+    },
+}
+DIAGNOSIS_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": DIAGNOSIS_LIST_SCHEMA,
+}
+# Built once; validates each streamed diagnosis straight from its JSON text
+diagnosis_validator = TypeAdapter(DiagnosisData)
+
+class IncompleteDiagnosisList(Exception):
+    """
+    The streamed diagnosis array was truncated; the diagnoses before the cut were still returned
+    """
+
+async def stream_diagnoses(prompt: str) -> AsyncIterator[DiagnosisData]:
+    """
+    Yield each diagnosis from Gemini's JSON array as soon as its object is complete.
+
+    Invalid diagnoses are skipped. Raises ValueError if the reply never
+    contains a JSON array, and IncompleteDiagnosisList (after yielding
+    everything valid) if the array was cut off.
+    """
+    parser = JSONArrayStream()
+    # Parsing is interleaved with the stream, so its time is summed and observed once
+    parse_seconds = 0.0
+    async for chunk in llm.generate_stream(prompt, policy=HISTORY_ANALYSIS_POLICY, generation_config=DIAGNOSIS_GENERATION_CONFIG):
+        parse_start = time.perf_counter()
+        elements = parser.feed(chunk_text(chunk))
+        diagnoses = []
+        for element in elements:
+            try:
+                diagnoses.append(diagnosis_validator.validate_json(element))
+            except ValidationError as validation_error:
+                logger.warning(f"Failed to validate diagnosis data: {validation_error}")
+        parse_seconds += time.perf_counter() - parse_start
+        for diagnosis in diagnoses:
+            yield diagnosis
+    stage_seconds.labels(stage="json_parse").observe(parse_seconds)
+    if not parser.started:
+        raise ValueError("Gemini response did not contain a JSON array")
+    if not parser.finished:
+        raise IncompleteDiagnosisList("Gemini response ended before the diagnosis list was complete")
+
+async def run_history_analysis(request: ChatHistoryRequest) -> ChatHistoryResponse:
+    """
+    Extract diagnoses from the messages not analyzed yet and merge them with the earlier ones
+    """
+    key = conversation_key(request.user_id, request.messages)
+    prior, start = history_tracker.plan(key, request.messages)
+    if prior is not None and start == len(request.messages):
+        logger.info("No new messages since the last analysis, returning stored diagnoses")
+        return ChatHistoryResponse(diagnoses=prior.diagnoses, success=True)
+    
+    prior_context = ""
+    if prior is not None:
+        logger.info(f"Analyzing {len(request.messages) - start} new messages ({start} already analyzed)")
+        prior_context = HISTORY_ANALYSIS_DELTA_CONTEXT.format(
+            summary=summarize_diagnoses(prior.diagnoses),
+            context=format_chat_transcript(request.messages[max(0, start - 2):start]),
+        )
+    analysis_prompt = HISTORY_ANALYSIS_PROMPT.format(
+        prior_context=prior_context,
+        chat_text=format_chat_transcript(request.messages[start:]),
+    )
+    
+    # Generate analysis using Gemini; diagnoses are validated as they stream in
+    logger.info("Sending chat history to Gemini for analysis...")
+    new_diagnoses: List[DiagnosisData] = []
+    complete = True
+    try:
+        async for diagnosis in stream_diagnoses(analysis_prompt):
+            new_diagnoses.append(diagnosis)
+    except IncompleteDiagnosisList as truncated:
+        logger.warning(f"{truncated}; keeping {len(new_diagnoses)} diagnoses parsed so far")
+        complete = False
+    except ValueError as parse_error:
+        logger.error(f"Failed to parse diagnosis data: {parse_error}")
+        record_error("/api/chat/analyze-history")
+        return ChatHistoryResponse(
+            diagnoses=[],
+            success=False,
+            error=f"Failed to parse diagnosis data: {str(parse_error)}"
+        )
+    
+    diagnoses = merge_diagnoses(
+        prior.diagnoses if prior is not None else [],
+        [diagnosis.model_dump() for diagnosis in new_diagnoses],
+    )
+    if complete:
+        # A truncated reply may have missed diagnoses, so analyze these messages again next time
+        history_tracker.save(key, request.messages, diagnoses)
+    logger.info(f"Extracted {len(new_diagnoses)} diagnoses ({len(diagnoses)} for the conversation so far)")
+    
+    return ChatHistoryResponse(
+        diagnoses=diagnoses,
+        success=True
+    )
+
+@app.post("/api/chat/analyze-history", response_model=ChatHistoryResponse)
+async def analyze_chat_history(request: ChatHistoryRequest, http_request: Request):
+    """
+    Analyze chat history to extract medical diagnoses and create structured medical records.
+
+    Messages analyzed by an earlier call for the same conversation are not
+    sent again: Gemini gets the new messages and a summary of the earlier
+    diagnoses, and the results are merged.
+    """
+    admit(http_request, request.user_id)
+    try:
+        logger.info(f"Received chat history analysis request with {len(request.messages)} messages")
         
-        if not response.text:
-            print("Empty response from Gemini API")
-            logger.error("Empty response from Gemini API")
-            raise HTTPException(status_code=500, detail="Failed to generate analysis")
+        if len(request.messages) < 2:
+            raise HTTPException(status_code=400, detail="Not enough chat history to analyze")
         
-        # Parse JSON response
-        try:
-            print("asdsadasdads", response.text)
-            # Clean the response text (remove any markdown formatting)
-            json_text = response.text.strip()
-            if json_text.startswith("```json"):
-                json_text = json_text[7:]
-            if json_text.endswith("```"):
-                json_text = json_text[:-3]
-            json_text = json_text.strip()
-            
-            # Parse JSON
-            diagnoses_data = json.loads(json_text)
-            
-            # Validate and convert to DiagnosisData objects
-            diagnoses = []
-            for diag_dict in diagnoses_data:
-                try:
-                    diagnosis = DiagnosisData(**diag_dict)
-                    diagnoses.append(diagnosis)
-                except Exception as validation_error:
-                    logger.warning(f"Failed to validate diagnosis data: {validation_error}")
-                    continue
-            
-            logger.info(f"Successfully extracted {len(diagnoses)} diagnoses from chat history")
-            
-            return ChatHistoryResponse(
-                diagnoses=diagnoses,
-                success=True
-            )
-            
-        except json.JSONDecodeError as json_error:
-            logger.error(f"Failed to parse JSON response: {json_error}")
-            logger.error(f"Raw response: {response.text}")
-            return ChatHistoryResponse(
-                diagnoses=[],
-                success=False,
-                error=f"Failed to parse diagnosis data: {str(json_error)}"
-            )
+        # The same transcript posted again while it is being analyzed shares that analysis
+        fingerprint = f"{request.user_id or ''}:{transcript_digest(request.messages)}"
+        return await inflight.do("analyze_history", fingerprint, lambda: run_history_analysis(request))
         
-    except HTTPException:
+    except (HTTPException, LLMOverloaded, CircuitOpen):
         raise
     except Exception as e:
         logger.error(f"Error in chat history analysis: {str(e)}")
+        record_error("/api/chat/analyze-history")
         return ChatHistoryResponse(
             diagnoses=[],
             success=False,
             error=str(e)
         )
 
-# Document analysis endpoint
-@app.post("/api/document/analyze", response_model=ChatResponse)
-async def analyze_document(document: UploadFile = File(...), user_id: str = Form(default="default")):
+async def extract_document_key_facts(user_id: str, summary: str, content_hash: str) -> Dict[str, Any]:
     """
-    Analyze uploaded document (e.g., PDF, DOCX) using Gemini API for health-related insights
+    Background job (DOCUMENT_ANALYSIS_MODE=background): add the key facts of an already delivered summary to the session
+    """
+    key_facts = await inflight.do("key_facts", content_hash, lambda: extract_key_facts(llm, summary))
+    await session_store.add_key_facts(user_id, key_facts)
+    analysis_cache.set(
+        analysis_cache_key(content_hash, DOCUMENT_ANALYSIS_PROMPT),
+        {"summary": summary, "key_facts": key_facts},
+    )
+    logger.info(f"Stored {len(key_facts)} key facts for a document analysis")
+    return {"key_facts": key_facts}
+
+async def analyze_document_content(temp_file_path: str, mime_type: str, content_hash: str) -> DocumentAnalysis:
+    """
+    Extract or upload a saved document and analyze it with Gemini
+    """
+    text = await text_extractor.extract(temp_file_path, mime_type)
+    if text is not None:
+        logger.info(f"Extracted {len(text)} characters locally, sending the text inline")
+        document = f"Document text:\n\n{text}"
+    else:
+        document = await get_gemini_file(temp_file_path, content_hash, "document")
+    
+    # Generate analysis using Gemini
+    logger.info(f"Generating analysis with Gemini ({DOCUMENT_ANALYSIS_MODE} mode)...")
+    try:
+        return await analyze_document_file(llm, document, DOCUMENT_ANALYSIS_MODE)
+    except Exception:
+        # The remote handle may have expired or been deleted; don't hand it out again
+        if text is None:
+            file_cache.pop(content_hash)
+        raise
+
+async def run_document_analysis(temp_file_path: str, mime_type: str, user_id: str, content_hash: str) -> Dict[str, Any]:
+    """
+    Background job: analyze a saved document with Gemini and store the summary and key facts in the user's history
     """
     try:
-        logger.info(f"Received document analysis request. File: {document.filename}, Size: {document.size}")
-        
-        # Validate file type
-        if not document.content_type in ['application/pdf', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document']:
-            raise HTTPException(status_code=400, detail="File must be a PDF or DOCX document")
-        
-        # Check file size (limit to 10MB)
-        max_size = 10 * 1024 * 1024  # 10MB in bytes
-        if document.size and document.size > max_size:
-            raise HTTPException(status_code=400, detail="Document file too large (max 10MB)")
-        
-        # Create temporary file to store the document
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
-            # Read document content and write to temp file
-            document_content = await document.read()
-            temp_file.write(document_content)
-            temp_file_path = temp_file.name
-        
         try:
-            # Upload document file to Gemini
-            logger.info("Uploading document to Gemini API...")
-            document_file = genai.upload_file(temp_file_path)
-            
-            # Wait for processing to complete
-            logger.info("Waiting for document processing...")
-            import time
-            while document_file.state.name == "PROCESSING":
-                time.sleep(2)
-                document_file = genai.get_file(document_file.name)
-            
-            if document_file.state.name == "FAILED":
-                raise HTTPException(status_code=500, detail="Document processing failed")
-            
-            # Create the medical analysis prompt
-            medical_prompt = f"""
-            Please analyze this document from a medical/health perspective. Look for:
-            
-            1. **Medical History**: Any relevant past medical history, surgeries, or treatments
-            2. **Current Medications**: List of current medications and dosages
-            3. **Allergies**: Any known allergies or adverse reactions
-            4. **Symptoms**: Description of any current symptoms or health concerns
-            5. **Lifestyle Factors**: Information on diet, exercise, alcohol, tobacco use, etc.
-            
-            User's specific request: Extract health insights from this document.
-            
-            Important Guidelines:
-            - Provide observations but emphasize that this is NOT a medical diagnosis
-            - Recommend consulting healthcare professionals for any concerns
-            - Be thorough but avoid causing unnecessary alarm
-            - Focus on objective observations rather than definitive conclusions
-            - If you see concerning symptoms, advise seeking medical attention
-            
-            Please provide a structured analysis with your observations and recommendations.
-            """
-            
-            # Generate analysis using Gemini
-            logger.info("Generating analysis with Gemini...")
-            response = model.generate_content([
-                document_file,
-                medical_prompt
-            ])
-            
-            if not response.text:
-                raise HTTPException(status_code=500, detail="Failed to generate document analysis")
+            # Jobs for the same bytes running at once share one analysis. The job that started it
+            # waits for it too, so its temp file is only removed once the call is done
+            analysis = await inflight.do(
+                "document",
+                analysis_cache_key(content_hash, DOCUMENT_ANALYSIS_PROMPT),
+                lambda: analyze_document_content(temp_file_path, mime_type, content_hash),
+            )
 
             logger.info("Document analysis completed successfully")
             
-            # After generating the summary in /api/document/analyze:
-            now = datetime.utcnow().isoformat()
-            chat_histories[user_id].append(ChatMessage(
-                type="ai",
-                content=f"[Document Analysis] {response.text}",
-                timestamp=now,
-            ))
-            
-            # After getting response.text (the summary)
-            key_facts_prompt = f"""
-            Extract the 3-5 most important facts, findings, or recommendations from the following medical document summary. 
-            Format each as a single, clear sentence.
-
-            Summary:
-            {response.text}
-            """
-
-            key_facts_response = model.generate_content(key_facts_prompt)
-            key_facts = [fact.strip() for fact in key_facts_response.text.split('\n') if fact.strip()]
-            
-            now = datetime.utcnow().isoformat()
-            for fact in key_facts:
-                chat_histories[user_id].append(ChatMessage(
-                    type="ai",
-                    content=f"[Key Fact] {fact}",
-                    timestamp=now,
-                ))
+            if analysis.key_facts is None:
+                # Deliver the summary now; the key facts follow in their own job
+                await session_store.add_document(user_id, analysis.summary, [])
+                try:
+                    job_manager.submit(
+                        "key_facts",
+                        in_background(lambda: extract_document_key_facts(user_id, analysis.summary, content_hash)),
+                    )
+                except JobQueueFull as e:
+                    logger.warning(f"Skipping key fact extraction: {e}")
+            else:
+                await session_store.add_document(user_id, analysis.summary, analysis.key_facts)
+                analysis_cache.set(
+                    analysis_cache_key(content_hash, DOCUMENT_ANALYSIS_PROMPT),
+                    {"summary": analysis.summary, "key_facts": analysis.key_facts},
+                )
             
             return ChatResponse(
-                response=response.text,
+                response=analysis.summary,
                 success=True
-            )
+            ).model_dump()
             
         finally:
             # Clean up temporary file
@@ -724,18 +1462,61 @@ async def analyze_document(document: UploadFile = File(...), user_id: str = Form
             except Exception as cleanup_error:
                 logger.warning(f"Failed to clean up temp file: {cleanup_error}")
         
-    except HTTPException:
-        raise
     except Exception as e:
         logger.error(f"Error in document analysis: {str(e)}")
+        record_error("/api/document/analyze")
         return ChatResponse(
             response=f"Error: {str(e)}",
             success=False,
             error=str(e)
-        )
+        ).model_dump()
+
+# Document analysis endpoint
+@app.post("/api/document/analyze", status_code=202, response_model=JobSubmittedResponse)
+async def analyze_document(http_request: Request, document: UploadFile = File(...), user_id: str = Form(default="default")):
+    """
+    Submit an uploaded document (e.g., PDF, DOCX) for health-related analysis.
 
-# In-memory storage for chat histories
-chat_histories = defaultdict(list)  # user_id -> List[ChatMessage]
+    Returns 202 with a job id right away; the ChatResponse with the summary is
+    available from GET /api/jobs/{job_id} once the job completes.
+    """
+    logger.info(f"Received document analysis request. File: {document.filename}, Size: {document.size}")
+    admit(http_request, user_id)
+    
+    # Validate file type
+    if not document.content_type in DOCUMENT_SUFFIXES:
+        raise HTTPException(status_code=400, detail="File must be a PDF or DOCX document")
+    
+    # Check file size (limit to 10MB); the declared size is only a fast path,
+    # the limit is enforced on the bytes actually received
+    max_size = DOCUMENT_MAX_SIZE
+    if document.size and document.size > max_size:
+        raise HTTPException(status_code=413, detail="Document file too large (max 10MB)")
+    
+    # Stream the document to a temporary file; the job removes it when done
+    try:
+        with stage_seconds.labels(stage="temp_file_write").time():
+            upload = await ingest_upload(document, max_size, suffix=DOCUMENT_SUFFIXES[document.content_type])
+    except UploadTooLarge:
+        raise HTTPException(status_code=413, detail="Document file too large (max 10MB)")
+    
+    # Check the content really is a PDF or DOCX (zip container), not just the declared type
+    if upload.mime_type not in ('application/pdf', 'application/zip'):
+        upload.discard()
+        raise HTTPException(status_code=400, detail="File must be a PDF or DOCX document")
+    
+    # Same document analyzed before: reuse the summary and key facts without touching Gemini
+    cached_analysis = analysis_cache.get(analysis_cache_key(upload.sha256, DOCUMENT_ANALYSIS_PROMPT))
+    if cached_analysis is not None:
+        logger.info("Document analysis served from cache")
+        upload.discard()
+        await session_store.add_document(user_id, cached_analysis["summary"], cached_analysis["key_facts"])
+        return job_accepted(job_manager.record("document", ChatResponse(
+            response=cached_analysis["summary"],
+            success=True
+        ).model_dump()))
+    
+    return submit_job("document", lambda: run_document_analysis(upload.path, upload.mime_type, user_id, upload.sha256), upload)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,197 @@
+"""
+Token-budgeted assembly of chat prompts.
+
+The chat prompt used to include every document analysis, every key fact and
+the last 10 turns with no size limit, so it kept growing as patients
+uploaded reports. build_chat_prompt fills a token budget by priority
+instead: the patient's question, then recent turns, then the key facts most
+relevant to the question, then the document-analysis chunks the session's
+retrieval index ranks highest for the question. It reports how many tokens
+each section used.
+
+Token counts are estimated locally (about four characters per token), so
+they cost no Gemini round trip. Session records compute theirs once, when
+they are stored, and their relevance terms on first use.
+"""
+
+import math
+import re
+from typing import TYPE_CHECKING, Dict, List, Sequence, Set, Union
+
+if TYPE_CHECKING:
+    from retrieval import Chunk
+    from sessions import Session, SessionRecord
+
+CHARS_PER_TOKEN = 4
+# Label and newline added around each stored item ("Patient: ", "[Key Fact] ", ...)
+ITEM_OVERHEAD_TOKENS = 4
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from have how i if in is it "
+    "me my of on or should so that the their this to was what when which who "
+    "why will with you your".split()
+)
+
+CHAT_PROMPT_TEMPLATE = """
+        {document_context}
+        {key_facts_context}
+        Conversation so far:
+        {history_context}
+
+        Patient Question: {message}
+
+        Instructions:
+        - Use any document analyses above to inform your answer.
+        - Also use the conversation so far.
+        - Be clear if you are referencing information from a document.
+        - If you need more information, ask the user for clarification.
+
+        Please provide a helpful medical response following these guidelines:
+        1. Be informative but emphasize the importance of professional medical consultation
+        2. If the question involves serious symptoms, recommend seeking immediate medical attention
+        3. Provide general health information when appropriate
+        4. Be empathetic and supportive
+
+        Respond in a caring, professional manner as a medical AI assistant.
+        """
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap local estimate of the Gemini token count of text
+    """
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+_TEMPLATE_TOKENS = estimate_tokens(CHAT_PROMPT_TEMPLATE.format(
+    document_context="", key_facts_context="", history_context="", message=""
+))
+
+
+def content_words(text: str) -> List[str]:
+    """
+    Lower-cased words of text in order, without stopwords
+    """
+    return [word for word in _WORD_RE.findall(text.lower()) if word not in _STOPWORDS]
+
+
+def terms(text: str) -> Set[str]:
+    """
+    Lower-cased content words of text, for relevance scoring
+    """
+    return set(content_words(text))
+
+
+class BuiltPrompt:
+    """
+    A finished prompt and the number of tokens each section used
+    """
+
+    def __init__(self, text: str, usage: Dict[str, int], budget: int, dropped: int):
+        self.text = text
+        self.usage = usage
+        self.budget = budget
+        self.dropped = dropped  # stored items left out to stay within budget
+
+
+def _take(records: Sequence[Union["SessionRecord", "Chunk"]], remaining: int, contiguous: bool = False) -> List:
+    # Greedily keep records (in the given priority order) that still fit; contiguous stops at the
+    # first one that doesn't, for turns, where skipping one would leave a gap in the conversation
+    chosen = []
+    for record in records:
+        cost = record.tokens + ITEM_OVERHEAD_TOKENS
+        if cost <= remaining:
+            chosen.append(record)
+            remaining -= cost
+        elif contiguous:
+            break
+    return chosen
+
+
+def _cost(records: Sequence[Union["SessionRecord", "Chunk"]]) -> int:
+    return sum(record.tokens + ITEM_OVERHEAD_TOKENS for record in records)
+
+
+def rank_by_relevance(records: Sequence["SessionRecord"], question: str) -> List["SessionRecord"]:
+    """
+    Records ordered by word overlap with the question, newest first on ties
+    """
+    question_terms = terms(question)
+    scored = [
+        (len(question_terms & record.terms), index, record)
+        for index, record in enumerate(records)
+    ]
+    scored.sort(key=lambda item: (item[0], item[1]), reverse=True)
+    return [record for _, _, record in scored]
+
+
+def retrieve_document_chunks(session: "Session", message: str, k: int) -> List["Chunk"]:
+    """
+    The k document chunks most relevant to the message, topped up with the latest document's
+    opening chunks when the question shares few words with the analyses ("what did my report say?")
+    """
+    chunks = session.document_index.search(message, k)
+    if len(chunks) < k:
+        chosen = set(chunks)
+        chunks += [chunk for chunk in session.document_index.latest_chunks(k) if chunk not in chosen][:k - len(chunks)]
+    return chunks
+
+
+def build_chat_prompt(
+    session: "Session", message: str, budget: int, max_turns: int = 10, top_k_chunks: int = 4
+) -> BuiltPrompt:
+    """
+    Fill the token budget by priority: question, recent turns, relevant key facts, relevant document chunks
+    """
+    question_tokens = estimate_tokens(message)
+    remaining = budget - _TEMPLATE_TOKENS - question_tokens
+
+    # Newest turns first, then restore chronological order for the prompt
+    turns = _take(session.recent_turns(max_turns)[::-1], remaining, contiguous=True)[::-1]
+    remaining -= _cost(turns)
+
+    key_facts = _take(rank_by_relevance(session.key_facts, message), remaining)
+    remaining -= _cost(key_facts)
+
+    documents = _take(retrieve_document_chunks(session, message, top_k_chunks), remaining)
+    remaining -= _cost(documents)
+
+    document_context = ""
+    if documents:
+        document_context = (
+            "==== Document Analyses (most relevant excerpts) ====\n"
+            + "\n".join(f"[Document Analysis] {chunk.content}" for chunk in documents)
+            + "\n==== End of Document Analyses ====\n\n"
+        )
+
+    key_facts_context = ""
+    if key_facts:
+        key_facts_context = (
+            "Important facts from previous documents:\n"
+            + "\n".join(f"[Key Fact] {fact.content}" for fact in key_facts)
+            + "\n\n"
+        )
+
+    history_context = ""
+    for msg in turns:
+        role = "Patient" if msg.type == "user" else "AI Doctor"
+        history_context += f"{role}: {msg.content}\n"
+
+    text = CHAT_PROMPT_TEMPLATE.format(
+        document_context=document_context,
+        key_facts_context=key_facts_context,
+        history_context=history_context,
+        message=message,
+    )
+    usage = {
+        "instructions": _TEMPLATE_TOKENS,
+        "question": question_tokens,
+        "turns": _cost(turns),
+        "key_facts": _cost(key_facts),
+        "documents": _cost(documents),
+    }
+    usage["total"] = sum(usage.values())
+    available = min(len(session.turns), max_turns) + len(session.key_facts) + len(session.document_index)
+    dropped = available - len(turns) - len(key_facts) - len(documents)
+    return BuiltPrompt(text, usage, budget, dropped)
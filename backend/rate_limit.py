@@ -0,0 +1,104 @@
+"""
+Per-client admission control for the endpoints that call Gemini.
+
+One client firing dozens of chat or analysis requests at once used to eat
+the whole Gemini quota and fail everyone else's requests. RateLimiter keeps
+a token bucket per key: each request takes a token, tokens refill at a
+steady rate up to a burst size, and a request finding the bucket empty is
+rejected straight away with the time until the next token, for a 429
+Retry-After.
+
+Every request is charged to its client IP, and also to its user id when it
+names one. The user id is supplied by the client, so it can only narrow a
+budget: a caller inventing a fresh id per request still drains its IP's
+bucket.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List
+
+
+class RateLimited(Exception):
+    """
+    The client has used up its request budget; retry_after is in seconds
+    """
+
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(f"Rate limit exceeded, retry in {self.retry_after_header}s")
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class RateLimiter:
+    """
+    Token buckets keyed by client; rate is tokens per second, burst the bucket size
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.rejected = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def acquire(self, *keys: str, cost: float = 1.0) -> None:
+        """
+        Take cost tokens from every key's bucket, or raise RateLimited without taking any
+        """
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        with self._lock:
+            buckets: List[TokenBucket] = [self._bucket(key, now) for key in keys]
+            shortfall = max(cost - bucket.tokens for bucket in buckets)
+            if shortfall > 0:
+                self.rejected += 1
+                raise RateLimited(shortfall / self.rate)
+            for bucket in buckets:
+                bucket.tokens -= cost
+            self.allowed += 1
+
+    def _bucket(self, key: str, now: float) -> TokenBucket:
+        # key's bucket, refilled up to now; the caller holds the lock
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.burst, now)
+            self._buckets[key] = bucket
+            # Forgetting the least recently seen client only ever refills its bucket early
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+        return bucket
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "requests_per_minute": round(self.rate * 60, 2),
+            "burst": self.burst,
+            "tracked_clients": len(self._buckets),
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,112 @@
+"""
+Cache of AI answers to generic, context-free health questions.
+
+Much of the /api/chat traffic is the same handful of general questions
+("What are the symptoms of the flu?"). When the user has no document or
+key-fact context, the answer doesn't depend on who is asking, so it can be
+reused. Lookups first try the normalized question exactly. If that misses,
+an optional near-duplicate matcher compares the question's content words
+with every cached question (cosine similarity over word sets).
+"""
+
+import math
+import re
+from typing import Any, Dict, FrozenSet, Optional
+
+from cache import LRUCache
+from prompt_builder import terms
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s]")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_question(question: str) -> str:
+    """
+    Lower-case the question and drop punctuation and repeated whitespace
+    """
+    question = _PUNCTUATION_RE.sub(" ", question.lower())
+    return _WHITESPACE_RE.sub(" ", question).strip()
+
+
+def question_terms(question: str) -> FrozenSet[str]:
+    """
+    Content words of a question with a trailing plural "s" removed
+    """
+    return frozenset(word[:-1] if len(word) > 3 and word.endswith("s") else word for word in terms(question))
+
+
+def similarity(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / math.sqrt(len(a) * len(b))
+
+
+class ResponseCache:
+    """
+    LRU/TTL cache of answers keyed by normalized question, with near-duplicate lookup
+    """
+
+    def __init__(self, maxsize: int = 512, ttl: float = 6 * 3600, similarity_threshold: float = 0.9):
+        self.similarity_threshold = similarity_threshold  # 0 disables near-duplicate matching
+        self._answers = LRUCache(maxsize=maxsize, ttl=ttl, on_remove=self._forget)
+        self._terms: Dict[str, FrozenSet[str]] = {}
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.latency_saved = 0.0
+        self._avg_latency: Optional[float] = None
+
+    def get(self, question: str) -> Optional[str]:
+        """
+        Cached answer for the question (or a near-duplicate of it), or None
+        """
+        key = normalize_question(question)
+        answer = self._answers.get(key)
+        if answer is None and self.similarity_threshold > 0:
+            answer = self._near_duplicate(question)
+            if answer is not None:
+                self.near_hits += 1
+        if answer is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.latency_saved += self._avg_latency or 0.0
+        return answer
+
+    def set(self, question: str, answer: str, latency: float) -> None:
+        """
+        Cache the answer; latency is how long Gemini took, used to estimate time saved by hits
+        """
+        key = normalize_question(question)
+        self._answers.set(key, answer)
+        self._terms[key] = question_terms(question)
+        # Exponential moving average of the upstream latency a hit avoids
+        if self._avg_latency is None:
+            self._avg_latency = latency
+        else:
+            self._avg_latency = 0.9 * self._avg_latency + 0.1 * latency
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._answers),
+            "hits": self.hits,
+            "near_duplicate_hits": self.near_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "latency_saved_seconds": round(self.latency_saved, 3),
+        }
+
+    def _near_duplicate(self, question: str) -> Optional[str]:
+        wanted = question_terms(question)
+        best_key, best_score = None, self.similarity_threshold
+        for key, cached_terms in self._terms.items():
+            score = similarity(wanted, cached_terms)
+            if score >= best_score:
+                best_key, best_score = key, score
+        if best_key is None:
+            return None
+        return self._answers.get(best_key)
+
+    def _forget(self, key: str) -> None:
+        self._terms.pop(key, None)
@@ -0,0 +1,135 @@
+"""
+Per-user local retrieval over stored document analyses.
+
+Document analyses are split into chunks when they are stored and indexed
+in an in-memory BM25 inverted index. Chat prompts then include only the
+top-k chunks for the question instead of every analysis the patient has
+ever uploaded, so prompt size stays flat as the number of documents grows.
+"""
+
+import math
+import re
+from collections import Counter
+from typing import Dict, Hashable, List
+
+from prompt_builder import content_words, estimate_tokens
+
+CHUNK_CHARS = 800
+
+_PARAGRAPH_RE = re.compile(r"\n\s*\n")
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+def split_chunks(text: str, max_chars: int = CHUNK_CHARS) -> List[str]:
+    """
+    Split text into chunks of at most about max_chars, preferring paragraph then sentence boundaries
+    """
+    pieces: List[str] = []
+    for paragraph in _PARAGRAPH_RE.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= max_chars:
+            pieces.append(paragraph)
+        else:
+            pieces.extend(sentence for sentence in _SENTENCE_RE.split(paragraph) if sentence)
+
+    chunks: List[str] = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + len(piece) + 1 > max_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{piece}" if current else piece
+        # A single oversized sentence is hard-wrapped
+        while len(current) > max_chars:
+            chunks.append(current[:max_chars])
+            current = current[max_chars:]
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class Chunk:
+    """
+    One indexed piece of a document analysis
+    """
+
+    __slots__ = ("doc_key", "position", "content", "tokens", "length", "term_counts")
+
+    def __init__(self, doc_key: Hashable, position: int, content: str):
+        self.doc_key = doc_key
+        self.position = position  # order within its document
+        self.content = content
+        self.tokens = estimate_tokens(content)
+        words = content_words(content)
+        self.length = len(words)
+        self.term_counts = Counter(words)
+
+
+class DocumentIndex:
+    """
+    In-memory BM25 inverted index over document chunks
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._chunks: Dict[Hashable, List[Chunk]] = {}  # doc key -> chunks, in insertion order
+        self._postings: Dict[str, Dict[Chunk, int]] = {}  # term -> chunk -> term frequency
+        self._total_length = 0
+        self._chunk_count = 0
+
+    def add(self, doc_key: Hashable, text: str) -> List[Chunk]:
+        chunks = [Chunk(doc_key, position, content) for position, content in enumerate(split_chunks(text))]
+        self._chunks[doc_key] = chunks
+        for chunk in chunks:
+            for term, count in chunk.term_counts.items():
+                self._postings.setdefault(term, {})[chunk] = count
+            self._total_length += chunk.length
+            self._chunk_count += 1
+        return chunks
+
+    def remove(self, doc_key: Hashable) -> None:
+        for chunk in self._chunks.pop(doc_key, []):
+            for term in chunk.term_counts:
+                postings = self._postings[term]
+                del postings[chunk]
+                if not postings:
+                    del self._postings[term]
+            self._total_length -= chunk.length
+            self._chunk_count -= 1
+
+    def __len__(self) -> int:
+        return self._chunk_count
+
+    def search(self, query: str, k: int) -> List[Chunk]:
+        """
+        The k chunks that best match the query by BM25 score, best first
+        """
+        if not self._chunk_count:
+            return []
+        avg_length = self._total_length / self._chunk_count or 1.0
+        scores: Dict[Chunk, float] = {}
+        for term in set(content_words(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (self._chunk_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk, frequency in postings.items():
+                norm = frequency + self.k1 * (1 - self.b + self.b * chunk.length / avg_length)
+                scores[chunk] = scores.get(chunk, 0.0) + idf * frequency * (self.k1 + 1) / norm
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        return ranked[:k]
+
+    def latest_chunks(self, k: int) -> List[Chunk]:
+        """
+        The first k chunks of the most recently added documents, newest document first
+        """
+        chunks: List[Chunk] = []
+        for doc_chunks in reversed(list(self._chunks.values())):
+            for chunk in doc_chunks:
+                if len(chunks) == k:
+                    return chunks
+                chunks.append(chunk)
+        return chunks
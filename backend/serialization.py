@@ -0,0 +1,83 @@
+"""
+Fast JSON encoding for API responses, including raw Mongo documents.
+
+FastAPI's default path runs every returned value through jsonable_encoder
+and then json.dumps, which walks each history entry twice in Python, and
+it can't encode ObjectId at all. The history code therefore rewrote every
+_id to a string by hand. FastJSONResponse encodes with orjson when it is
+installed. orjson serializes dicts, lists and datetimes natively and calls
+bson_default only for the BSON types it doesn't know (ObjectId, Decimal128,
+Binary), so documents can be returned exactly as the driver yields them.
+Without orjson the standard library encoder is used with the same hook.
+
+Endpoints that return raw Mongo documents must return a FastJSONResponse
+instance themselves: returning a plain dict still goes through
+jsonable_encoder. ndjson_chunks() encodes a stream of documents as
+newline-delimited JSON for StreamingResponse.
+"""
+
+import base64
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, AsyncIterator, Dict
+
+from bson import Binary, Decimal128, ObjectId
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # optional: without it responses use the standard library encoder
+    orjson = None
+
+
+def bson_default(value: Any) -> Any:
+    """
+    JSON form of the BSON and standard types the encoders don't handle themselves
+    """
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal128):
+        return float(value.to_decimal())
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (Binary, bytes)):
+        return base64.b64encode(value).decode()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    """
+    Compact UTF-8 JSON for content, which may contain raw Mongo documents
+    """
+    if orjson is not None:
+        # OPT_NON_STR_KEYS matches json.dumps for int keys, e.g. in /api/stats
+        return orjson.dumps(content, default=bson_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=bson_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSONResponse rendered with orjson (when available) and BSON-aware encoding
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+async def ndjson_chunks(documents: AsyncIterator[Dict[str, Any]], chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+    """
+    Newline-delimited JSON for documents, in chunks of about chunk_size bytes
+    """
+    # One chunk per document would mean one write (and compressor flush) per line
+    buffer = bytearray()
+    async for document in documents:
+        buffer += dumps(document)
+        buffer += b"\n"
+        if len(buffer) >= chunk_size:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
@@ -0,0 +1,645 @@
+"""
+Per-user conversation state used to build chat prompts.
+
+Each session keeps document analyses, key facts and conversational turns in
+separate indexes. Recent turns live in a fixed-size ring buffer, so building
+a prompt only touches the context it needs instead of rescanning everything
+the user has ever sent. Document analyses are also chunked into a BM25
+retrieval index as they are added, so prompts can include only the passages
+relevant to the question.
+
+Two SessionStore backends are available:
+
+- InMemorySessionStore keeps sessions in this process, bounded by per-user
+  and global byte budgets and an idle TTL. Sessions pushed out of memory can
+  optionally be spilled to disk (zlib-compressed) and are restored
+  transparently on the user's next request.
+- SQLiteSessionStore persists records in a local SQLite database in WAL mode
+  so every uvicorn worker process sees the same history.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from typing import Any, Deque, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from prompt_builder import estimate_tokens, terms
+from retrieval import DocumentIndex
+
+logger = logging.getLogger(__name__)
+
+# Rough per-record overhead (object header, slots, timestamp string) on top of the text itself
+RECORD_OVERHEAD_BYTES = 120
+
+
+class SessionRecord:
+    """
+    One stored message: a conversational turn, a document analysis or a key fact
+    """
+
+    __slots__ = ("type", "content", "timestamp", "nbytes", "tokens", "id", "_terms")
+
+    def __init__(self, type: str, content: str, timestamp: Optional[str] = None):
+        self.type = type  # "user" or "ai"
+        self.content = content
+        self.timestamp = timestamp or datetime.utcnow().isoformat()
+        self.nbytes = len(content.encode("utf-8")) + RECORD_OVERHEAD_BYTES
+        self.tokens = estimate_tokens(content)  # computed once, reused by every prompt
+        self.id: Optional[int] = None  # row id when backed by a database
+        self._terms: Optional[FrozenSet[str]] = None
+
+    @property
+    def terms(self) -> FrozenSet[str]:
+        """
+        Content words, for relevance scoring; computed on first use and reused by every prompt
+        """
+        if self._terms is None:
+            self._terms = frozenset(terms(self.content))
+        return self._terms
+
+    def to_list(self) -> List[str]:
+        return [self.type, self.content, self.timestamp]
+
+    def __repr__(self) -> str:
+        return f"SessionRecord(type={self.type!r}, content={self.content[:30]!r})"
+
+
+class Session:
+    """
+    Typed context for one user: document analyses, key facts and recent turns
+    """
+
+    __slots__ = ("documents", "document_index", "key_facts", "turns", "nbytes", "last_access")
+
+    def __init__(self, max_turns: int = 20):
+        self.documents: List[SessionRecord] = []
+        self.document_index = DocumentIndex()  # chunks of self.documents, keyed by record
+        self.key_facts: List[SessionRecord] = []
+        self.turns: Deque[SessionRecord] = deque(maxlen=max_turns)
+        self.nbytes = 0
+        self.last_access = time.monotonic()
+
+    def add_turn(self, type: str, content: str, timestamp: Optional[str] = None) -> SessionRecord:
+        record = SessionRecord(type, content, timestamp)
+        if len(self.turns) == self.turns.maxlen:
+            # The ring buffer is about to drop its oldest turn
+            self.nbytes -= self.turns[0].nbytes
+        self.turns.append(record)
+        self.nbytes += record.nbytes
+        return record
+
+    def add_document(self, content: str, timestamp: Optional[str] = None) -> SessionRecord:
+        record = SessionRecord("ai", content, timestamp)
+        self.documents.append(record)
+        self.document_index.add(record, content)
+        self.nbytes += record.nbytes
+        return record
+
+    def add_key_fact(self, content: str, timestamp: Optional[str] = None) -> SessionRecord:
+        record = SessionRecord("ai", content, timestamp)
+        self.key_facts.append(record)
+        self.nbytes += record.nbytes
+        return record
+
+    def recent_turns(self, n: int) -> List[SessionRecord]:
+        """
+        The last n conversational turns, oldest first
+        """
+        if n >= len(self.turns):
+            return list(self.turns)
+        return [self.turns[i] for i in range(len(self.turns) - n, len(self.turns))]
+
+    @property
+    def has_document_context(self) -> bool:
+        return bool(self.documents or self.key_facts)
+
+    @property
+    def has_context(self) -> bool:
+        """
+        Whether a prompt built from this session would include anything besides the new message
+        """
+        return bool(self.turns) or self.has_document_context
+
+    def trim(self, max_bytes: int) -> int:
+        """
+        Drop the oldest records until the session fits in max_bytes; returns the bytes freed.
+
+        Old turns go first (the latest exchange is kept), then old document
+        analyses (their key facts are the compact form), then old key facts.
+        """
+        freed = 0
+        while self.nbytes > max_bytes:
+            if len(self.turns) > 2:
+                record = self.turns.popleft()
+            elif self.documents:
+                record = self.documents.pop(0)
+                self.document_index.remove(record)
+            elif self.key_facts:
+                record = self.key_facts.pop(0)
+            elif self.turns:
+                record = self.turns.popleft()
+            else:
+                break
+            self.nbytes -= record.nbytes
+            freed += record.nbytes
+        return freed
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "max_turns": self.turns.maxlen,
+            "documents": [record.to_list() for record in self.documents],
+            "key_facts": [record.to_list() for record in self.key_facts],
+            "turns": [record.to_list() for record in self.turns],
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Session":
+        session = cls(data["max_turns"])
+        for type, content, timestamp in data["documents"]:
+            session.add_document(content, timestamp)
+        for type, content, timestamp in data["key_facts"]:
+            session.add_key_fact(content, timestamp)
+        for type, content, timestamp in data["turns"]:
+            session.add_turn(type, content, timestamp)
+        return session
+
+
+class SessionStore(ABC):
+    """
+    Where per-user sessions live. get() returns the user's current Session for
+    building prompts; all writes go through the store so shared backends see them.
+    The methods are coroutines so backends doing I/O can keep it off the event loop.
+    """
+
+    @abstractmethod
+    async def get(self, user_id: Optional[str]) -> Session:
+        """
+        The user's session, created empty if the user has no history
+        """
+
+    @abstractmethod
+    async def add_exchange(self, user_id: Optional[str], message: str, answer: str) -> None:
+        """
+        Record a completed patient question and AI answer
+        """
+
+    @abstractmethod
+    async def add_document(self, user_id: Optional[str], summary: str, key_facts: Iterable[str]) -> None:
+        """
+        Record a document analysis and the key facts extracted from it
+        """
+
+    @abstractmethod
+    async def add_key_facts(self, user_id: Optional[str], key_facts: Iterable[str]) -> None:
+        """
+        Record key facts extracted after their document analysis was stored
+        """
+
+    @abstractmethod
+    def stats(self) -> Dict[str, Any]:
+        """
+        Gauges and counters describing the store
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class InMemorySessionStore(SessionStore):
+    """
+    In-process map of user id -> Session with per-user and global byte budgets,
+    idle expiry, LRU eviction and optional compressed spill-to-disk
+    """
+
+    def __init__(
+        self,
+        max_turns: int = 20,
+        max_bytes_per_user: int = 256 * 1024,
+        max_total_bytes: int = 64 * 1024 * 1024,
+        idle_ttl: float = 2 * 3600,
+        spill_dir: Optional[str] = None,
+        spill_ttl: float = 7 * 24 * 3600,
+        sweep_interval: float = 60,
+        stats_interval: float = 5,
+    ):
+        self.max_turns = max_turns
+        self.max_bytes_per_user = max_bytes_per_user
+        self.max_total_bytes = max_total_bytes
+        self.idle_ttl = idle_ttl
+        self.spill_dir = spill_dir
+        self.spill_ttl = spill_ttl
+        self.sweep_interval = sweep_interval
+        self.total_bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.spills = 0
+        self.restores = 0
+        self._sessions: "OrderedDict[Optional[str], Session]" = OrderedDict()
+        self._last_sweep = time.monotonic()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    async def get(self, user_id: Optional[str]) -> Session:
+        """
+        The user's session, restored from disk or created empty if not in memory
+        """
+        return self._get(user_id)
+
+    def _get(self, user_id: Optional[str]) -> Session:
+        self._maybe_sweep()
+        session = self._sessions.get(user_id)
+        if session is None:
+            session = self._restore(user_id) or Session(self.max_turns)
+            self._sessions[user_id] = session
+            self.total_bytes += session.nbytes
+            self._enforce_total_budget(user_id)
+        else:
+            self._sessions.move_to_end(user_id)
+        session.last_access = time.monotonic()
+        return session
+
+    async def add_exchange(self, user_id: Optional[str], message: str, answer: str) -> None:
+        """
+        Record a completed patient question and AI answer
+        """
+        now = datetime.utcnow().isoformat()
+        session = self._get(user_id)
+        before = session.nbytes
+        session.add_turn("user", message, now)
+        session.add_turn("ai", answer, now)
+        self._account(user_id, session, before)
+
+    async def add_document(self, user_id: Optional[str], summary: str, key_facts: Iterable[str]) -> None:
+        """
+        Record a document analysis and the key facts extracted from it
+        """
+        now = datetime.utcnow().isoformat()
+        session = self._get(user_id)
+        before = session.nbytes
+        session.add_document(summary, now)
+        for fact in key_facts:
+            session.add_key_fact(fact, now)
+        self._account(user_id, session, before)
+
+    async def add_key_facts(self, user_id: Optional[str], key_facts: Iterable[str]) -> None:
+        now = datetime.utcnow().isoformat()
+        session = self._get(user_id)
+        before = session.nbytes
+        for fact in key_facts:
+            session.add_key_fact(fact, now)
+        self._account(user_id, session, before)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "live_sessions": len(self._sessions),
+            "retained_bytes": self.total_bytes,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "spills": self.spills,
+            "restores": self.restores,
+        }
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _account(self, user_id: Optional[str], session: Session, before: int) -> None:
+        # Enforce the per-user budget, then the global one
+        if session.nbytes > self.max_bytes_per_user:
+            session.trim(self.max_bytes_per_user)
+        self.total_bytes += session.nbytes - before
+        self._enforce_total_budget(user_id)
+
+    def _enforce_total_budget(self, keep_user_id: Optional[str]) -> None:
+        # Evict least recently used sessions, never the one currently in use
+        while self.total_bytes > self.max_total_bytes and len(self._sessions) > 1:
+            oldest_id = next(iter(self._sessions))
+            if oldest_id == keep_user_id:
+                break
+            self._evict(oldest_id)
+            self.evictions += 1
+
+    def _maybe_sweep(self) -> None:
+        now = time.monotonic()
+        if now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+        # Sessions are kept in access order, so idle ones are at the front
+        cutoff = now - self.idle_ttl
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if session.last_access > cutoff:
+                break
+            self._evict(user_id)
+            self.expirations += 1
+        if self.spill_dir:
+            self._sweep_spilled()
+
+    def _sweep_spilled(self) -> None:
+        # Spilled sessions of users who never came back are deleted after spill_ttl
+        cutoff = time.time() - self.spill_ttl
+        try:
+            with os.scandir(self.spill_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".json.z") and entry.stat().st_mtime < cutoff:
+                        os.unlink(entry.path)
+        except OSError as e:
+            logger.warning(f"Failed to clean up spilled sessions: {e}")
+
+    def _evict(self, user_id: Optional[str]) -> None:
+        session = self._sessions.pop(user_id)
+        self.total_bytes -= session.nbytes
+        if self.spill_dir:
+            self._spill(user_id, session)
+
+    def _spill_path(self, user_id: Optional[str]) -> str:
+        key = hashlib.sha256(repr(user_id).encode("utf-8")).hexdigest()
+        return os.path.join(self.spill_dir, f"{key}.json.z")
+
+    def _spill(self, user_id: Optional[str], session: Session) -> None:
+        try:
+            data = zlib.compress(json.dumps(session.to_dict()).encode("utf-8"))
+            with open(self._spill_path(user_id), "wb") as f:
+                f.write(data)
+            self.spills += 1
+        except OSError as e:
+            logger.warning(f"Failed to spill session to disk: {e}")
+
+    def _restore(self, user_id: Optional[str]) -> Optional[Session]:
+        if not self.spill_dir:
+            return None
+        path = self._spill_path(user_id)
+        try:
+            with open(path, "rb") as f:
+                data = json.loads(zlib.decompress(f.read()))
+            os.unlink(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, zlib.error) as e:
+            logger.warning(f"Failed to restore spilled session: {e}")
+            return None
+        self.restores += 1
+        return Session.from_dict(data)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Sessions persisted in a local SQLite database shared by every worker process.
+
+    Records are appended to a single table. Each process keeps an LRU of
+    materialized sessions and, on every get(), reads only the rows newer than
+    the last one it has seen, so another worker's writes show up without
+    reloading the whole history. Per-user retention follows the same budget
+    rules as the in-memory store; trimmed rows (turns included) are deleted
+    from the database.
+
+    Queries can wait up to the busy timeout for another process's write, so
+    they run on a dedicated thread; the sessions themselves are only built
+    and changed on the event loop. stats() reports figures refreshed on that
+    thread at most every stats_interval seconds rather than scanning the
+    table on every scrape.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_turns: int = 20,
+        max_bytes_per_user: int = 256 * 1024,
+        idle_ttl: float = 2 * 3600,
+        max_cached_sessions: int = 1024,
+        sweep_interval: float = 60,
+        stats_interval: float = 5,
+    ):
+        self.path = path
+        self.max_turns = max_turns
+        self.max_bytes_per_user = max_bytes_per_user
+        self.idle_ttl = idle_ttl
+        self.max_cached_sessions = max_cached_sessions
+        self.sweep_interval = sweep_interval
+        self.stats_interval = stats_interval
+        self.expirations = 0
+        self._cache: "OrderedDict[str, Session]" = OrderedDict()
+        self._last_row: Dict[str, int] = {}
+        self._last_sweep = time.monotonic()
+        # One thread: the connection is used by one query at a time, in order
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-sessions")
+
+        self._conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS session_records (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_key TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                type TEXT NOT NULL,
+                content TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                created REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_session_records_user ON session_records (user_key, kind, id)"
+        )
+        self._table_stats = self._count_records()
+        self._stats_at = float("-inf")
+
+    @staticmethod
+    def _user_key(user_id: Optional[str]) -> str:
+        return "" if user_id is None else user_id
+
+    async def _run(self, fn, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, partial(fn, *args))
+
+    async def get(self, user_id: Optional[str]) -> Session:
+        await self._maybe_sweep()
+        key = self._user_key(user_id)
+        session = self._cache.get(key)
+        if session is None or time.monotonic() - session.last_access > self.idle_ttl:
+            if session is not None:
+                del self._cache[key]
+            session = await self._load(key)
+        else:
+            self._cache.move_to_end(key)
+            rows = await self._run(self._select_newer, key, self._last_row[key])
+            self._apply(key, session, rows)
+        session.trim(self.max_bytes_per_user)
+        session.last_access = time.monotonic()
+        return session
+
+    async def add_exchange(self, user_id: Optional[str], message: str, answer: str) -> None:
+        now = datetime.utcnow().isoformat()
+        key = self._user_key(user_id)
+        await self._run(self._insert, key, [("turn", "user", message, now), ("turn", "ai", answer, now)])
+        await self._collect_trimmed(key, await self.get(user_id))
+
+    async def add_document(self, user_id: Optional[str], summary: str, key_facts: Iterable[str]) -> None:
+        now = datetime.utcnow().isoformat()
+        key = self._user_key(user_id)
+        rows = [("document", "ai", summary, now)]
+        rows.extend(("key_fact", "ai", fact, now) for fact in key_facts)
+        await self._run(self._insert, key, rows)
+        await self._collect_trimmed(key, await self.get(user_id))
+
+    async def add_key_facts(self, user_id: Optional[str], key_facts: Iterable[str]) -> None:
+        now = datetime.utcnow().isoformat()
+        key = self._user_key(user_id)
+        rows = [("key_fact", "ai", fact, now) for fact in key_facts]
+        if rows:
+            await self._run(self._insert, key, rows)
+            await self._collect_trimmed(key, await self.get(user_id))
+
+    def stats(self) -> Dict[str, Any]:
+        live_sessions, records, content_bytes = self._table_stats
+        return {
+            "live_sessions": live_sessions,
+            "retained_bytes": content_bytes + records * RECORD_OVERHEAD_BYTES,
+            "cached_sessions": len(self._cache),
+            "expirations": self.expirations,
+        }
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        self._conn.close()
+
+    # Blocking queries, run on the store's thread
+
+    def _count_records(self) -> tuple:
+        return self._conn.execute(
+            "SELECT COUNT(DISTINCT user_key), COUNT(*), COALESCE(SUM(LENGTH(CAST(content AS BLOB))), 0)"
+            " FROM session_records"
+        ).fetchone()
+
+    def _insert(self, key: str, rows: List[tuple]) -> None:
+        created = time.time()
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.executemany(
+                "INSERT INTO session_records (user_key, kind, type, content, timestamp, created)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [(key, kind, type, content, timestamp, created) for kind, type, content, timestamp in rows],
+            )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def _select_newer(self, key: str, last_row: int) -> List[tuple]:
+        return self._conn.execute(
+            "SELECT id, kind, type, content, timestamp FROM session_records"
+            " WHERE user_key = ? AND id > ? ORDER BY id",
+            (key, last_row),
+        ).fetchall()
+
+    def _select_session(self, key: str) -> Tuple[int, List[tuple]]:
+        # One read transaction so the rows and the high-water mark are consistent
+        self._conn.execute("BEGIN")
+        try:
+            last_row = self._conn.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM session_records WHERE user_key = ?", (key,)
+            ).fetchone()[0]
+            context_rows = self._conn.execute(
+                "SELECT id, kind, type, content, timestamp FROM session_records"
+                " WHERE user_key = ? AND kind != 'turn' AND id <= ? ORDER BY id",
+                (key, last_row),
+            ).fetchall()
+            turn_rows = self._conn.execute(
+                "SELECT id, kind, type, content, timestamp FROM session_records"
+                " WHERE user_key = ? AND kind = 'turn' AND id <= ? ORDER BY id DESC LIMIT ?",
+                (key, last_row, self.max_turns),
+            ).fetchall()
+        finally:
+            self._conn.execute("COMMIT")
+        return last_row, context_rows + turn_rows[::-1]
+
+    def _delete_before(self, key: str, oldest_kept: List[Tuple[str, int]], count: bool) -> Optional[tuple]:
+        self._conn.executemany(
+            "DELETE FROM session_records WHERE user_key = ? AND kind = ? AND id < ?",
+            [(key, kind, row_id) for kind, row_id in oldest_kept],
+        )
+        return self._count_records() if count else None
+
+    def _delete_idle(self, idle_before: float) -> Tuple[List[str], tuple]:
+        idle_keys = [
+            row[0] for row in self._conn.execute(
+                "SELECT user_key FROM session_records GROUP BY user_key HAVING MAX(created) < ?",
+                (idle_before,),
+            )
+        ]
+        self._conn.executemany(
+            "DELETE FROM session_records WHERE user_key = ?", [(key,) for key in idle_keys]
+        )
+        return idle_keys, self._count_records()
+
+    # Session state, on the event loop
+
+    async def _load(self, key: str) -> Session:
+        last_row, rows = await self._run(self._select_session, key)
+        session = self._cache.get(key)
+        if session is not None:
+            # A concurrent get() loaded it while this one waited on the query
+            return session
+        session = Session(self.max_turns)
+        self._last_row[key] = 0
+        self._apply(key, session, rows)
+        self._last_row[key] = last_row
+        self._cache[key] = session
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_cached_sessions:
+            evicted_key, _ = self._cache.popitem(last=False)
+            del self._last_row[evicted_key]
+        return session
+
+    def _apply(self, key: str, session: Session, rows: List[tuple]) -> None:
+        applied = self._last_row.get(key, 0)
+        for row_id, kind, type, content, timestamp in rows:
+            if row_id <= applied:
+                # Already applied by a concurrent get() that read the same rows
+                continue
+            if kind == "turn":
+                record = session.add_turn(type, content, timestamp)
+            elif kind == "document":
+                record = session.add_document(content, timestamp)
+            else:
+                record = session.add_key_fact(content, timestamp)
+            record.id = row_id
+            self._last_row[key] = max(self._last_row[key], row_id)
+
+    async def _collect_trimmed(self, key: str, session: Session) -> None:
+        # Delete rows the ring buffer or the per-user budget has pushed out of the session
+        next_row = self._last_row.get(key, 0) + 1
+        oldest_kept = [
+            (kind, records[0].id if records else next_row)
+            for kind, records in (("turn", session.turns), ("document", session.documents), ("key_fact", session.key_facts))
+        ]
+        now = time.monotonic()
+        count = now - self._stats_at >= self.stats_interval
+        if count:
+            self._stats_at = now
+        table_stats = await self._run(self._delete_before, key, oldest_kept, count)
+        if table_stats is not None:
+            self._table_stats = table_stats
+
+    async def _maybe_sweep(self) -> None:
+        now = time.monotonic()
+        if now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+        # Forget users whose newest record is older than the idle TTL
+        idle_keys, self._table_stats = await self._run(self._delete_idle, time.time() - self.idle_ttl)
+        self._stats_at = now
+        for key in idle_keys:
+            self._cache.pop(key, None)
+            self._last_row.pop(key, None)
+        self.expirations += len(idle_keys)
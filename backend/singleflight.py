@@ -0,0 +1,58 @@
+"""
+Coalescing of identical in-flight work.
+
+A double-submitted form or a frontend retry used to run the same work twice
+at the same time: the same document uploaded and analyzed twice, the same
+transcript sent to Gemini twice, parallel /api/test-gemini probes each
+making their own call. SingleFlight runs one call per key at a time. A
+caller arriving while a call with its key is in flight waits for that call
+and gets the same result (or exception) instead of starting another.
+
+Keys are fingerprints of the work (content hashes, transcript digests), so
+only requests that would make the same upstream call share one. Nothing is
+kept once the call finishes; caching results is left to the caches.
+"""
+
+import asyncio
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class SingleFlight:
+    """
+    Shares one in-flight call among concurrent callers with the same kind and key
+    """
+
+    def __init__(self):
+        self._calls: Dict[Tuple[str, Hashable], asyncio.Future] = {}
+        self.calls: Counter = Counter()
+        self.coalesced: Counter = Counter()
+
+    async def do(self, kind: str, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Await fn(), or the call already running for (kind, key)
+        """
+        flight_key = (kind, key)
+        task = self._calls.get(flight_key)
+        if task is None:
+            self.calls[kind] += 1
+            # A task of its own, so a caller that gives up (e.g. a client disconnect) doesn't cancel it for the others
+            task = asyncio.ensure_future(fn())
+            self._calls[flight_key] = task
+            task.add_done_callback(lambda done: self._finished(flight_key, done))
+        else:
+            self.coalesced[kind] += 1
+        return await asyncio.shield(task)
+
+    def _finished(self, flight_key: Tuple[str, Hashable], task: asyncio.Future) -> None:
+        self._calls.pop(flight_key, None)
+        if not task.cancelled():
+            # Marks the exception retrieved even if every caller gave up waiting
+            task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._calls),
+            "calls": dict(self.calls),
+            "coalesced": dict(self.coalesced),
+        }
@@ -0,0 +1,168 @@
+"""
+Local text extraction for uploaded PDF and DOCX documents.
+
+Most uploads are text-based PDFs or DOCX files whose text can be read
+locally in well under a second. Sending that text inline skips the Gemini
+file upload and its PROCESSING poll entirely. Extraction runs in a process
+pool, with a PDF's pages split into batches that are read in parallel.
+extract() returns None for PDFs with any page that yields too little text
+(scanned or image-only pages, which would be silently left out of an inline
+prompt) and for documents that can't be read locally. Those still go
+through the Gemini file upload.
+
+The pool's workers are started with forkserver (spawn where that isn't
+available) rather than forked from the server process, which by then runs
+the event loop and the Gemini and Mongo client threads.
+
+A DOCX is a zip archive, so a small upload can inflate to gigabytes of XML.
+Its document.xml is only read when its uncompressed size is within
+max_xml_bytes, and reading stops once the text passes max_chars.
+
+PDF support needs the optional pypdf package; without it every PDF takes
+the upload path. DOCX is read with the standard library.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
+from xml.etree import ElementTree
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # optional: without it every PDF is uploaded to Gemini
+    PdfReader = None
+
+logger = logging.getLogger(__name__)
+
+_WORD_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+def _pdf_page_count(path: str) -> int:
+    return len(PdfReader(path).pages)
+
+
+def _pdf_pages_text(path: str, start: int, stop: int) -> List[str]:
+    # Runs in a worker process; each batch opens its own reader
+    reader = PdfReader(path)
+    return [reader.pages[number].extract_text() or "" for number in range(start, stop)]
+
+
+def _docx_text(path: str, max_chars: int, max_xml_bytes: int) -> Optional[str]:
+    """
+    Paragraph text of a DOCX file, or None if the zip isn't a Word document or its XML is too large
+
+    Stops once the text passes max_chars, returning what it has read so far.
+    """
+    try:
+        with zipfile.ZipFile(path) as archive:
+            # The declared size also bounds what ZipExtFile will decompress
+            if archive.getinfo("word/document.xml").file_size > max_xml_bytes:
+                logger.info(f"DOCX document.xml is over {max_xml_bytes} bytes uncompressed")
+                return None
+            with archive.open("word/document.xml") as document_xml:
+                paragraphs = []
+                current: List[str] = []
+                length = 0
+                for _, element in ElementTree.iterparse(document_xml):
+                    if element.tag == f"{_WORD_NS}t":
+                        current.append(element.text or "")
+                    elif element.tag == f"{_WORD_NS}tab":
+                        current.append("\t")
+                    elif element.tag in (f"{_WORD_NS}br", f"{_WORD_NS}cr"):
+                        current.append("\n")
+                    elif element.tag == f"{_WORD_NS}p":
+                        paragraphs.append("".join(current))
+                        length += len(paragraphs[-1]) + 1
+                        current = []
+                        element.clear()
+                        if length > max_chars:
+                            break
+    except (KeyError, zipfile.BadZipFile, ElementTree.ParseError):
+        return None
+    return "\n".join(paragraphs)
+
+
+class DocumentTextExtractor:
+    """
+    Reads document text in a process pool so parsing doesn't block the event loop
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        pages_per_task: int = 8,
+        min_chars_per_page: int = 100,
+        max_chars: int = 500_000,
+        max_xml_bytes: int = 32 * 1024 * 1024,
+    ):
+        self.workers = workers or os.cpu_count() or 1
+        self.pages_per_task = pages_per_task
+        self.min_chars_per_page = min_chars_per_page  # a PDF with any page below this is treated as scanned
+        self.max_chars = max_chars  # longer documents go through the file upload instead
+        self.max_xml_bytes = max_xml_bytes  # uncompressed size limit for a DOCX's document.xml
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.extracted = 0
+        self.fallbacks = 0
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        # Created on first use so importing the app doesn't start worker processes
+        if self._pool is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(method))
+        return self._pool
+
+    async def extract(self, path: str, mime_type: str) -> Optional[str]:
+        """
+        The document's text, or None if it should be sent to Gemini as a file
+        """
+        try:
+            if mime_type == "application/pdf":
+                text = await self._extract_pdf(path)
+            elif mime_type == "application/zip":
+                text = await self._run(_docx_text, path, self.max_chars, self.max_xml_bytes)
+            else:
+                text = None
+        except Exception as e:
+            logger.warning(f"Local text extraction failed, falling back to file upload: {e}")
+            text = None
+        if text is not None and len(text) > self.max_chars:
+            logger.info(f"Extracted text too long for an inline prompt ({len(text)} chars)")
+            text = None
+        if text is None:
+            self.fallbacks += 1
+        else:
+            self.extracted += 1
+        return text
+
+    async def _extract_pdf(self, path: str) -> Optional[str]:
+        if PdfReader is None:
+            return None
+        page_count = await self._run(_pdf_page_count, path)
+        if page_count == 0:
+            return None
+        batches = await asyncio.gather(*(
+            self._run(_pdf_pages_text, path, start, min(start + self.pages_per_task, page_count))
+            for start in range(0, page_count, self.pages_per_task)
+        ))
+        pages = [page for batch in batches for page in batch]
+        # Averaging would let a few text pages carry scanned ones (e.g. a typed cover letter on scanned results)
+        short_pages = sum(1 for page in pages if len(page.strip()) < self.min_chars_per_page)
+        if short_pages:
+            logger.info(f"PDF has {short_pages} of {page_count} pages with too little text for local extraction, likely scanned")
+            return None
+        return "\n\n".join(f"--- Page {number} ---\n{page}" for number, page in enumerate(pages, start=1))
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._get_pool(), fn, *args)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"extracted": self.extracted, "uploaded": self.fallbacks}
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
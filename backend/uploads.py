@@ -0,0 +1,153 @@
+"""
+Bounded-memory ingestion of multipart uploads.
+
+Uploads are copied to a temporary file in fixed-size blocks rather than read
+into memory in one piece. The byte limit is enforced on the bytes actually
+received rather than the client-supplied size, and the SHA-256 content hash
+and sniffed MIME type are computed in the same pass, so peak memory per
+upload stays at one block however large the file is.
+
+By the time an endpoint runs, Starlette has already parsed the multipart
+body into its own spooled temporary file, so ingest_upload's limit only
+bounds what is kept. BodyLimitMiddleware enforces the limit while the
+request is still being received: a Content-Length over the limit is refused
+before any of the body is read, and a body that turns out larger than the
+limit is cut off with a 413 as soon as it crosses it. Accepted uploads are
+still copied once more, from Starlette's spooled file to ingest_upload's.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+from typing import Dict, Optional
+
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024  # 1MB
+SNIFF_BYTES = 64
+
+
+class UploadTooLarge(Exception):
+    """Raised as soon as an upload exceeds its byte limit"""
+
+
+class IngestedUpload:
+    """
+    An upload saved to disk, with its size, content hash and sniffed MIME type
+    """
+
+    def __init__(self, path: str, size: int, sha256: str, mime_type: Optional[str]):
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.mime_type = mime_type
+
+    def discard(self) -> None:
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            logger.warning(f"Failed to clean up temp file: {e}")
+
+
+def sniff_mime_type(head: bytes) -> Optional[str]:
+    """
+    Guess a MIME type from the first bytes of a file, or None if unrecognized
+    """
+    if head.startswith(b"%PDF-"):
+        return "application/pdf"
+    if head.startswith(b"PK\x03\x04"):
+        # DOCX (and other OOXML formats) are zip containers
+        return "application/zip"
+    if head.startswith(b"\x1a\x45\xdf\xa3"):
+        # EBML header, used by WebM/Matroska (MediaRecorder output)
+        return "video/webm"
+    if head[4:8] == b"ftyp":
+        return "video/quicktime" if head[8:10] == b"qt" else "video/mp4"
+    if head.startswith(b"RIFF") and head[8:12] == b"AVI ":
+        return "video/x-msvideo"
+    if head.startswith(b"OggS"):
+        return "video/ogg"
+    if head.startswith(b"\x00\x00\x01\xba") or head.startswith(b"\x00\x00\x01\xb3"):
+        return "video/mpeg"
+    return None
+
+
+async def ingest_upload(
+    upload: UploadFile,
+    max_bytes: int,
+    suffix: str = "",
+    chunk_size: int = CHUNK_SIZE,
+) -> IngestedUpload:
+    """
+    Stream an UploadFile to a temporary file, hashing and sniffing it on the way.
+
+    Raises UploadTooLarge as soon as more than max_bytes have been received;
+    the partial temp file is removed. The caller owns the returned file.
+    """
+    digest = hashlib.sha256()
+    head = b""
+    size = 0
+    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
+    try:
+        with temp_file:
+            while True:
+                chunk = await upload.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f"Upload exceeds {max_bytes} bytes")
+                if len(head) < SNIFF_BYTES:
+                    head += chunk[:SNIFF_BYTES - len(head)]
+                digest.update(chunk)
+                await run_in_threadpool(temp_file.write, chunk)
+    except BaseException:
+        try:
+            os.unlink(temp_file.name)
+        except OSError:
+            pass
+        raise
+
+    return IngestedUpload(temp_file.name, size, digest.hexdigest(), sniff_mime_type(head))
+
+
+class BodyLimitMiddleware:
+    """
+    ASGI middleware answering 413 once a request body to one of the limited paths exceeds its byte limit
+    """
+
+    def __init__(self, app: ASGIApp, limits: Dict[str, int]):
+        self.app = app
+        self.limits = limits  # path -> maximum body bytes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        limit = self.limits.get(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+        detail = f"Request body too large (max {limit} bytes)"
+        content_length = Headers(scope=scope).get("content-length", "")
+        if content_length.isdigit() and int(content_length) > limit:
+            await JSONResponse({"detail": detail}, status_code=413)(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # Raised inside the body parser; FastAPI passes HTTPExceptions through as the response
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
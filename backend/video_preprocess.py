@@ -0,0 +1,285 @@
+"""
+Local pre-processing of recorded videos before they are sent to Gemini.
+
+Browser recordings are uploaded as full-resolution, full-frame-rate .webm
+files (up to 50MB), and Gemini then processes them server-side before the
+analysis can start. Most of those frames are near-identical: the patient is
+sitting in front of a webcam. VideoPreprocessor samples the video at a low
+frame rate and resolution, then drops frames that barely differ from the
+last kept one: frames are compared as small grayscale thumbnails, and a
+frame is a near-duplicate when only a tiny fraction of its pixels changed
+by more than sensor noise.
+What it sends depends on the mode (VIDEO_PREPROCESS_MODE):
+
+- off: the original recording is uploaded unchanged.
+- downsample: the sampled frames are re-encoded into a small .mp4 that is
+  uploaded instead; near-duplicates repeat the previous distinct frame,
+  which costs almost nothing to encode and keeps the timing intact.
+- keyframes: up to max_keyframes of the most distinct frames are sent
+  inline as JPEG images, so no file upload or processing wait is needed.
+
+Both processing modes drop the audio track, so speech cannot be analyzed.
+They need the optional opencv-python and numpy packages. Without them, or
+for videos OpenCV can't decode, the original file is uploaded.
+"""
+
+import heapq
+import logging
+import os
+import tempfile
+from typing import Any, Dict, List, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:  # optional: without them videos are uploaded as recorded
+    cv2 = None
+    np = None
+
+logger = logging.getLogger(__name__)
+
+PREPROCESS_MODES = ("off", "downsample", "keyframes")
+
+THUMBNAIL_SIZE = (64, 36)  # frames are compared at this size
+PIXEL_CHANGE_LEVEL = 24  # grayscale difference (0-255) that counts as a changed pixel rather than noise
+
+
+class Keyframe:
+    """
+    A JPEG-encoded frame and its position in the video
+    """
+
+    __slots__ = ("timestamp", "jpeg", "score")
+
+    def __init__(self, timestamp: float, jpeg: bytes, score: float):
+        self.timestamp = timestamp  # seconds from the start
+        self.jpeg = jpeg
+        self.score = score  # fraction of pixels changed since the previous kept frame
+
+
+class PreprocessedVideo:
+    """
+    What to send instead of the original recording: a smaller file or keyframes
+    """
+
+    def __init__(self, original_bytes: int, frames_read: int, frames_kept: int):
+        self.original_bytes = original_bytes
+        self.frames_read = frames_read
+        self.frames_kept = frames_kept
+        self.path: Optional[str] = None  # re-encoded video (downsample mode)
+        self.keyframes: List[Keyframe] = []  # inline images (keyframes mode)
+
+    @property
+    def sent_bytes(self) -> int:
+        if self.path is not None:
+            return os.path.getsize(self.path)
+        return sum(len(frame.jpeg) for frame in self.keyframes)
+
+    def contents(self) -> List[Any]:
+        """
+        Gemini content parts for the keyframes, each preceded by its timestamp
+        """
+        parts: List[Any] = []
+        for frame in self.keyframes:
+            parts.append(f"Frame at {frame.timestamp:.1f}s:")
+            parts.append({"mime_type": "image/jpeg", "data": frame.jpeg})
+        return parts
+
+    def discard(self) -> None:
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+
+class VideoPreprocessor:
+    """
+    Downsamples videos and drops near-duplicate frames before they go to Gemini
+    """
+
+    def __init__(
+        self,
+        mode: str = "off",
+        max_height: int = 360,
+        target_fps: float = 2.0,
+        duplicate_threshold: float = 0.01,
+        max_keyframes: int = 16,
+        jpeg_quality: int = 80,
+    ):
+        if mode not in PREPROCESS_MODES:
+            raise ValueError(f"Unknown video preprocess mode: {mode}")
+        self.mode = mode
+        self.max_height = max_height
+        self.target_fps = target_fps
+        self.duplicate_threshold = duplicate_threshold  # fraction of changed pixels below which a frame is a duplicate
+        self.max_keyframes = max_keyframes
+        self.jpeg_quality = jpeg_quality
+        self.processed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off" and cv2 is not None
+
+    async def prepare(self, path: str) -> Optional[PreprocessedVideo]:
+        """
+        The reduced video for path, or None if the original should be uploaded
+        """
+        if not self.enabled:
+            return None
+        try:
+            prepared = await run_in_threadpool(self.process, path)
+        except Exception as e:
+            logger.warning(f"Video pre-processing failed, uploading the original: {e}")
+            return None
+        if prepared is None:
+            return None
+        if prepared.sent_bytes >= prepared.original_bytes:
+            # Nothing gained (already tiny or heavily compressed)
+            prepared.discard()
+            return None
+        self.processed += 1
+        self.bytes_in += prepared.original_bytes
+        self.bytes_out += prepared.sent_bytes
+        return prepared
+
+    def process(self, path: str) -> Optional[PreprocessedVideo]:
+        """
+        Blocking: decode, sample, deduplicate and re-encode the video at path
+
+        Frames aren't buffered: downsample mode writes each sample to the
+        encoder as it is read, and keyframes mode keeps only the first frame
+        and a heap of the max_keyframes - 1 most distinct others.
+        """
+        capture = cv2.VideoCapture(path)
+        if not capture.isOpened():
+            return None
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        # Browser .webm files often report no (or a bogus) frame rate
+        fps = fps if 0 < fps <= 240 else 30.0
+        interval = 1.0 / self.target_fps
+
+        output: Optional[str] = None  # downsample mode: the .mp4 being written
+        writer = None
+        first = None  # keyframes mode: (timestamp, frame, score) of the first frame
+        candidates: List[tuple] = []  # keyframes mode: min-heap of (score, -order, timestamp, frame)
+        last_frame = None
+        frames_read = 0
+        frames_kept = 0
+        next_sample = 0.0
+        last_thumbnail = None
+        try:
+            # grab() advances without converting frames that aren't sampled
+            while capture.grab():
+                position = capture.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+                timestamp = position if position > 0 else frames_read / fps
+                frames_read += 1
+                if timestamp + 1e-6 < next_sample:
+                    continue
+                ok, frame = capture.retrieve()
+                if not ok:
+                    break
+                next_sample = timestamp + interval
+
+                frame = self._resize(frame)
+                thumbnail = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), THUMBNAIL_SIZE)
+                if last_thumbnail is None:
+                    score = 1.0
+                else:
+                    score = float(np.count_nonzero(cv2.absdiff(thumbnail, last_thumbnail) > PIXEL_CHANGE_LEVEL)) / thumbnail.size
+                    if score < self.duplicate_threshold:
+                        if writer is not None:
+                            # Duplicates repeat the previous distinct frame (nearly free to encode) so timing is preserved
+                            writer.write(last_frame)
+                        continue
+                last_thumbnail = thumbnail
+                last_frame = frame
+                frames_kept += 1
+                if self.mode == "keyframes":
+                    if first is None:
+                        first = (timestamp, frame, score)
+                    elif self.max_keyframes > 1:
+                        # Among equal scores the earlier frame wins; -order also keeps frames out of comparisons
+                        item = (score, -frames_kept, timestamp, frame)
+                        if len(candidates) < self.max_keyframes - 1:
+                            heapq.heappush(candidates, item)
+                        else:
+                            heapq.heappushpop(candidates, item)
+                    continue
+                if writer is None:
+                    output = self._temp_output()
+                    writer = self._open_writer(output, frame)
+                    if writer is None:
+                        os.unlink(output)
+                        return None
+                writer.write(frame)
+        except BaseException:
+            if output is not None:
+                os.unlink(output)
+            raise
+        finally:
+            capture.release()
+            if writer is not None:
+                writer.release()
+        if not frames_kept:
+            return None
+
+        prepared = PreprocessedVideo(os.path.getsize(path), frames_read, frames_kept)
+        if self.mode == "keyframes":
+            prepared.keyframes = self._keyframes(first, candidates)
+        else:
+            prepared.path = output
+        logger.info(
+            f"Pre-processed video: kept {frames_kept} of {frames_read} frames, "
+            f"{prepared.original_bytes} -> {prepared.sent_bytes} bytes"
+        )
+        return prepared
+
+    def _resize(self, frame: Any) -> Any:
+        height, width = frame.shape[:2]
+        if height <= self.max_height:
+            return frame
+        scale = self.max_height / height
+        # Even dimensions keep video encoders happy
+        size = (int(width * scale) // 2 * 2, self.max_height // 2 * 2)
+        return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+    def _keyframes(self, first: tuple, candidates: List[tuple]) -> List[Keyframe]:
+        # The first frame plus the most distinct others, in time order
+        chosen = [first] + [(timestamp, frame, score) for score, _, timestamp, frame in candidates]
+        chosen.sort(key=lambda item: item[0])
+        keyframes = []
+        for timestamp, frame, score in chosen:
+            ok, jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+            if ok:
+                keyframes.append(Keyframe(timestamp, jpeg.tobytes(), score))
+        return keyframes
+
+    def _temp_output(self) -> str:
+        handle, path = tempfile.mkstemp(suffix=".mp4")
+        os.close(handle)
+        return path
+
+    def _open_writer(self, path: str, frame: Any) -> Any:
+        # An mp4v writer sized for frame, or None when this OpenCV build can't open one
+        height, width = frame.shape[:2]
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), self.target_fps, (width, height))
+        if not writer.isOpened():
+            # No mp4v encoder in this OpenCV build: write() would silently do nothing
+            logger.warning("Could not open an mp4v video writer, uploading the original")
+            writer.release()
+            return None
+        return writer
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode if self.enabled else "off",
+            "processed": self.processed,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
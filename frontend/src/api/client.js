@@ -23,7 +23,11 @@ class APIClient {
       const response = await fetch(url, config);
 
       if (!response.ok) {
-        throw new Error(`HTTP error! status: ${response.status}`);
+        const error = new Error(`HTTP error! status: ${response.status}`);
+        error.status = response.status;
+        // Seconds to wait before retrying, on 429 responses
+        error.retryAfter = Number(response.headers.get("Retry-After")) || null;
+        throw error;
       }
 
       return await response.json();
@@ -44,6 +48,73 @@ class APIClient {
     });
   }
 
+  // Chat with AI, streaming the response as it is generated.
+  // onChunk receives the accumulated text after every chunk; resolves with
+  // the same shape as sendChatMessage plus ttft_ms / total_ms.
+  async streamChatMessage(message, userId = null, onChunk = () => {}) {
+    const url = `${this.baseURL}/api/chat/stream`;
+
+    try {
+      const response = await fetch(url, {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+        },
+        body: JSON.stringify({
+          message: message,
+          user_id: userId,
+        }),
+      });
+
+      if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+      }
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      let text = "";
+      let result = null;
+
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // SSE messages are separated by a blank line
+        let boundary;
+        while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+          const raw = buffer.slice(0, boundary);
+          buffer = buffer.slice(boundary + 2);
+
+          let event = "message";
+          let data = "";
+          for (const line of raw.split("\n")) {
+            if (line.startsWith("event: ")) event = line.slice(7);
+            else if (line.startsWith("data: ")) data += line.slice(6);
+          }
+          if (!data) continue;
+
+          const payload = JSON.parse(data);
+          if (event === "chunk") {
+            text += payload.text;
+            onChunk(text);
+          } else if (event === "done" || event === "error") {
+            result = payload;
+          }
+        }
+      }
+
+      if (!result) {
+        throw new Error("Stream ended without a result");
+      }
+      return result;
+    } catch (error) {
+      console.error("Streaming chat failed:", error);
+      throw error;
+    }
+  }
+
   // Test Gemini connection
   async testGeminiConnection() {
     return this.request("/api/test-gemini", {
@@ -58,6 +129,26 @@ class APIClient {
     });
   }
 
+  // Poll a background analysis job until it finishes and return its result.
+  // The delay between polls backs off from 500ms up to 5s.
+  async waitForJob(statusUrl, timeoutMs = 5 * 60 * 1000) {
+    const deadline = Date.now() + timeoutMs;
+    let delay = 500;
+
+    while (Date.now() < deadline) {
+      const job = await this.request(statusUrl, { method: "GET" });
+      if (job.status === "completed") {
+        return job.result;
+      }
+      if (job.status === "failed") {
+        throw new Error(job.error || "Analysis job failed");
+      }
+      await new Promise((resolve) => setTimeout(resolve, delay));
+      delay = Math.min(delay * 2, 5000);
+    }
+    throw new Error("Timed out waiting for analysis job");
+  }
+
   // Analyze video with Gemini
   async analyzeVideo(formData) {
     const url = `${this.baseURL}/api/video/analyze`;
@@ -72,7 +163,9 @@ class APIClient {
         throw new Error(`HTTP error! status: ${response.status}`);
       }
 
-      return await response.json();
+      // The backend queues the analysis and answers 202 with a job to poll
+      const job = await response.json();
+      return await this.waitForJob(job.status_url);
     } catch (error) {
       console.error("Video analysis failed:", error);
       throw error;
@@ -91,22 +184,75 @@ class APIClient {
   }
 
   // Analyze chat history to extract diagnoses
-  async addDiagnosis(diagnosis) {
+  async addDiagnosis(diagnosis, userId = null) {
     console.log("in addDiagnosis", diagnosis);
     return this.request("/api/history/add", {
       method: "POST",
       body: JSON.stringify({
         diagnosis: diagnosis,
+        user_id: userId,
+      }),
+    });
+  }
+
+  // Save several diagnoses in one request; results[i] reports diagnoses[i]
+  async addDiagnoses(diagnoses, userId = null) {
+    return this.request("/api/history/bulk-add", {
+      method: "POST",
+      body: JSON.stringify({
+        diagnoses: diagnoses,
+        user_id: userId,
       }),
     });
   }
 
-  async getHistory() {
-    return this.request("/api/history", {
+  // One page of history, newest first. Pass the previous response's
+  // next_before as `before` to get the next page; view "summary" skips the
+  // recommendation and vision/voice fields.
+  async getHistory({ userId = null, limit = 50, before = null, view = "full" } = {}) {
+    const params = new URLSearchParams({ limit: String(limit), view });
+    if (userId) params.set("user_id", userId);
+    if (before) params.set("before", before);
+    return this.request(`/api/history?${params}`, {
       method: "GET",
     });
   }
 
+  // Export a user's whole history. onEntry receives each entry as its line
+  // arrives; resolves with the number of entries.
+  async exportHistory(userId, onEntry = () => {}) {
+    if (!userId) {
+      throw new Error("exportHistory requires a userId");
+    }
+    const params = new URLSearchParams({ user_id: userId });
+    const response = await fetch(`${this.baseURL}/api/history/export?${params}`);
+
+    if (!response.ok) {
+      throw new Error(`HTTP error! status: ${response.status}`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    let count = 0;
+
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      let newline;
+      while ((newline = buffer.indexOf("\n")) !== -1) {
+        const line = buffer.slice(0, newline);
+        buffer = buffer.slice(newline + 1);
+        if (!line) continue;
+        onEntry(JSON.parse(line));
+        count += 1;
+      }
+    }
+    return count;
+  }
+
   // Delete a medical history entry
   async deleteHistory(documentId) {
     return this.request(`/api/history/${documentId}`, {
@@ -114,6 +260,16 @@ class APIClient {
     });
   }
 
+  // Delete several medical history entries in one request
+  async deleteHistoryEntries(documentIds) {
+    return this.request("/api/history/bulk-delete", {
+      method: "POST",
+      body: JSON.stringify({
+        document_ids: documentIds,
+      }),
+    });
+  }
+
   // Upload document (for future use)
   async uploadDocument(file, userId = null) {
     const formData = new FormData();
@@ -134,7 +290,9 @@ class APIClient {
         throw new Error(`HTTP error! status: ${response.status}`);
       }
 
-      return await response.json();
+      // The backend queues the analysis and answers 202 with a job to poll
+      const job = await response.json();
+      return await this.waitForJob(job.status_url);
     } catch (error) {
       console.error("Document upload failed:", error);
       throw error;
@@ -225,16 +225,35 @@ const ChatInterface = () => {
     setIsProcessing(true);
 
     try {
-      const result = await apiClient.sendChatMessage(currentMessage);
-
-      const aiMessage = {
-        id: Date.now() + 1,
-        type: "ai",
-        content: result.response,
-        timestamp: new Date(),
+      const aiMessageId = Date.now() + 1;
+      let streamStarted = false;
+
+      // Show the AI message as soon as the first chunk arrives, then grow it
+      const showPartial = (content) => {
+        if (!streamStarted) {
+          streamStarted = true;
+          setIsProcessing(false);
+          setMessages((prev) => [
+            ...prev,
+            { id: aiMessageId, type: "ai", content, timestamp: new Date() },
+          ]);
+        } else {
+          setMessages((prev) =>
+            prev.map((msg) =>
+              msg.id === aiMessageId ? { ...msg, content } : msg
+            )
+          );
+        }
       };
 
-      setMessages((prev) => [...prev, aiMessage]);
+      const result = await apiClient.streamChatMessage(
+        currentMessage,
+        null,
+        showPartial
+      );
+
+      // Replace the partial text with the final (or error) response
+      showPartial(result.response);
 
       // Stop processing immediately after message is displayed
       setIsProcessing(false);